@@ -1,9 +1,56 @@
 import requests
 import json
+import os
 from datetime import datetime
 from typing import Optional
+import functools
+import tracing
+import deadline
+import bank_scheduler
+from metrics import observe_bank_call, bank_for_call
+
+# Шаблон адреса API банка. Для локального стенда (mock_bank.py):
+# BANK_BASE_URL_TEMPLATE="http://127.0.0.1:9000/{bank}"
+BANK_BASE_URL_TEMPLATE = os.environ.get("BANK_BASE_URL_TEMPLATE", "https://{bank}.open.bankingapi.ru")
+
+
+# Таймаут одного HTTP-запроса к банку (секунды); внутри запроса с дедлайном — не дольше остатка бюджета
+BANK_REQUEST_TIMEOUT = float(os.environ.get("BANK_REQUEST_TIMEOUT", "10"))
+
+
+def request_timeout() -> float:
+    """
+    Таймаут для очередного запроса к банку.
+
+    :raises deadline.DeadlineExceeded: Если бюджет текущего запроса уже исчерпан
+    """
+    return deadline.timeout(BANK_REQUEST_TIMEOUT)
+
+
+def bank_base_url(bank_name: str) -> str:
+    """Возвращает базовый URL API банка по его имени (например, abank -> https://abank.open.bankingapi.ru)."""
+    return BANK_BASE_URL_TEMPLATE.format(bank=bank_name)
+
+
+def bank_call(func):
+    """
+    Декоратор для запросов к API банка: ждёт слот в планировщике bank_scheduler (по классу приоритета),
+    записывает метрики латентности и открывает span трассировки с именем функции и банком.
+    """
+    observed = observe_bank_call(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bank = bank_for_call(func, kwargs)
+        with tracing.span(func.__name__, category="bank_call", bank=bank,
+                          priority=bank_scheduler.current_priority()):
+            with bank_scheduler.slot(bank):
+                return observed(*args, **kwargs)
+    return wrapper
+
 
 # 0
+@bank_call
 def CreateBankToken(
     client_id: str,
     client_secret: str,
@@ -27,11 +74,12 @@ def CreateBankToken(
         "accept": "application/json"
     }
 
-    response = requests.post(url, headers=headers, params=params, data='')
+    response = requests.post(url, headers=headers, params=params, data='', timeout=request_timeout())
     response.raise_for_status()
     return response.json()
 
 # 1.1
+@bank_call
 def AccountConsentsRequest(
     client_id: str,
     permissions: list,
@@ -75,11 +123,12 @@ def AccountConsentsRequest(
         "requesting_bank_name": requesting_bank_name
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=request_timeout())
     response.raise_for_status()  # вызовет исключение при HTTP ошибке
     return response.json()
 
 # 1.2
+@bank_call
 def GetConsentByID(
     consent_id: str,
     x_fapi_interaction_id: str = "team089",
@@ -105,11 +154,12 @@ def GetConsentByID(
         "Authorization": f"{token_type} {access_token}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = requests.get(url, headers=headers, timeout=request_timeout())
     response.raise_for_status()
     return response.json()
 
 # 2.1
+@bank_call
 def GetAccountsList(
     client_id: str,
     consent_id: str,
@@ -139,11 +189,12 @@ def GetAccountsList(
         "Authorization": f"{token_type} {access_token}"
     }
 
-    response = requests.get(url, params=params, headers=headers)
+    response = requests.get(url, params=params, headers=headers, timeout=request_timeout())
     response.raise_for_status()
     return response.json()
 
 # 2.2
+@bank_call
 def GetAccountDetails(
     account_id: str,
     consent_id: str,
@@ -172,11 +223,12 @@ def GetAccountDetails(
         "Authorization": f"{token_type} {access_token}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = requests.get(url, headers=headers, timeout=request_timeout())
     response.raise_for_status()
     return response.json()
 
 # 2.3
+@bank_call
 def GetAccountBalance(
     account_id: str,
     consent_id: str,
@@ -205,11 +257,12 @@ def GetAccountBalance(
         "Authorization": f"{token_type} {access_token}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = requests.get(url, headers=headers, timeout=request_timeout())
     response.raise_for_status()
     return response.json()
 
 # 2.4
+@bank_call
 def GetAccountTransactionHistory(
     account_id: str,
     consent_id: str,
@@ -254,6 +307,6 @@ def GetAccountTransactionHistory(
         "Authorization": f"{token_type} {access_token}"
     }
 
-    response = requests.get(url, headers=headers, params=params)
+    response = requests.get(url, headers=headers, params=params, timeout=request_timeout())
     response.raise_for_status()
     return response.json()
@@ -0,0 +1,188 @@
+import json
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+USERS_DB = "users.db"
+
+# БД, в которых схема уже создана/перенесена в этом процессе
+_ready_dbs = set()
+
+
+def _create_user_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_banks (
+            user_name TEXT NOT NULL,
+            bank_name TEXT NOT NULL,
+            consent_id TEXT,
+            is_active INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (user_name, bank_name)
+        )
+    """)
+    # Покрывающий индекс для запросов «активные банки пользователя с согласием»:
+    # все нужные столбцы берутся из индекса, без обращения к таблице
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_banks_active
+        ON user_banks (user_name, is_active, consent_id, bank_name)
+    """)
+    # Строка на каждый счёт: курсор синхронизации и время последней загрузки транзакций по счёту
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            user_name TEXT NOT NULL,
+            bank_name TEXT NOT NULL,
+            account_id TEXT NOT NULL,
+            consent_id TEXT,
+            listed_at INTEGER NOT NULL,
+            sync_cursor TEXT,
+            last_synced_at INTEGER,
+            PRIMARY KEY (user_name, bank_name, account_id)
+        ) WITHOUT ROWID
+    """)
+
+
+def _migrate_legacy_account_ids(cursor):
+    """
+    Переносит JSON-массивы из старого столбца user_banks.account_id в таблицу accounts
+    и пересоздаёт user_banks без этого столбца.
+    """
+    cursor.execute("PRAGMA table_info(user_banks)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "account_id" not in columns:
+        return
+
+    cursor.execute("SELECT user_name, bank_name, consent_id, account_id FROM user_banks WHERE account_id IS NOT NULL")
+    now = int(time.time())
+    rows = []
+    for user_name, bank_name, consent_id, account_ids_json in cursor.fetchall():
+        try:
+            account_ids = json.loads(account_ids_json)
+        except (json.JSONDecodeError, TypeError):
+            print(f"⚠️ Некорректный account_id для банка {bank_name} пользователя {user_name}: {account_ids_json}")
+            continue
+        rows.extend((user_name, bank_name, account_id, consent_id, now) for account_id in account_ids or [])
+
+    cursor.execute("ALTER TABLE user_banks RENAME TO user_banks_legacy")
+    # Индексы переезжают вместе с таблицей — освобождаем имя для новой
+    cursor.execute("DROP INDEX IF EXISTS idx_user_banks_active")
+    _create_user_tables(cursor)
+    cursor.execute("""
+        INSERT INTO user_banks (user_name, bank_name, consent_id, is_active)
+        SELECT user_name, bank_name, consent_id, is_active FROM user_banks_legacy
+    """)
+    cursor.executemany("""
+        INSERT OR IGNORE INTO accounts (user_name, bank_name, account_id, consent_id, listed_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
+    cursor.execute("DROP TABLE user_banks_legacy")
+    print(f"Таблица user_banks перенесена в новую схему: {len(rows)} счетов в таблице accounts")
+
+
+def ensure_user_tables(conn: sqlite3.Connection, db_path: str = USERS_DB):
+    """Создаёт таблицы user_banks и accounts (или переносит старую схему) один раз за процесс для каждой БД."""
+    if db_path in _ready_dbs:
+        return
+    cursor = conn.cursor()
+    # Схема проверяется и переносится под блокировкой записи: воркер, дождавшийся чужого переноса,
+    # заново читает PRAGMA table_info и видит уже новую схему, а сбой откатывает перенос целиком
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        _migrate_legacy_account_ids(cursor)
+        _create_user_tables(cursor)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    _ready_dbs.add(db_path)
+
+
+def replace_accounts(user_name: str, bank_name: str, consent_id: str, account_ids: List[str], db_path: str = USERS_DB):
+    """
+    Сохраняет список счетов банка из GetAccountsList.
+
+    Счета, которых больше нет в списке, удаляются; у остальных сохраняются курсоры синхронизации.
+    """
+    now = int(time.time())
+    with metrics.timed_connect(db_path) as conn:
+        ensure_user_tables(conn, db_path)
+        placeholders = ", ".join("?" for _ in account_ids)
+        conn.execute(f"""
+            DELETE FROM accounts
+            WHERE user_name = ? AND bank_name = ? AND account_id NOT IN ({placeholders})
+        """, (user_name, bank_name, *account_ids))
+        conn.executemany("""
+            INSERT INTO accounts (user_name, bank_name, account_id, consent_id, listed_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_name, bank_name, account_id) DO UPDATE SET
+                consent_id = excluded.consent_id,
+                listed_at = excluded.listed_at
+        """, [(user_name, bank_name, account_id, consent_id, now) for account_id in account_ids])
+        conn.commit()
+
+
+def bank_accounts(user_name: str, db_path: str = USERS_DB) -> Dict[str, List[str]]:
+    """Счета пользователя по банкам (поиск по префиксу первичного ключа): bank_name -> [account_id]."""
+    result: Dict[str, List[str]] = {}
+    with metrics.timed_connect(db_path) as conn:
+        ensure_user_tables(conn, db_path)
+        rows = conn.execute("""
+            SELECT bank_name, account_id FROM accounts WHERE user_name = ? ORDER BY bank_name, account_id
+        """, (user_name,)).fetchall()
+    for bank_name, account_id in rows:
+        result.setdefault(bank_name, []).append(account_id)
+    return result
+
+
+def active_bank_accounts(user_name: str, db_path: str = USERS_DB) -> List[Tuple[str, str, List[str]]]:
+    """
+    Счета активных банков пользователя с действующим согласием (consent-...), одним запросом.
+
+    :return: Список (bank_name, consent_id, [account_id]); банки без счетов не попадают
+    """
+    result: Dict[Tuple[str, str], List[str]] = {}
+    with metrics.timed_connect(db_path) as conn:
+        ensure_user_tables(conn, db_path)
+        rows = conn.execute("""
+            SELECT b.bank_name, b.consent_id, a.account_id
+            FROM user_banks AS b
+            JOIN accounts AS a ON a.user_name = b.user_name AND a.bank_name = b.bank_name
+            WHERE b.user_name = ? AND b.is_active = 1
+              AND b.consent_id IS NOT NULL AND b.consent_id LIKE 'consent-%'
+            ORDER BY b.bank_name, a.account_id
+        """, (user_name,)).fetchall()
+    for bank_name, consent_id, account_id in rows:
+        result.setdefault((bank_name, consent_id), []).append(account_id)
+    return [(bank_name, consent_id, account_ids) for (bank_name, consent_id), account_ids in result.items()]
+
+
+def record_account_syncs(user_name: str, syncs: List[Tuple[str, str, Optional[str]]], db_path: str = USERS_DB):
+    """
+    Отмечает загрузку транзакций по счетам: время синхронизации и курсор (последний bookingDateTime).
+    Курсор только растёт — загрузка более раннего периода не сдвигает его назад.
+
+    :param syncs: Список (bank_name, account_id, sync_cursor)
+    """
+    if not syncs:
+        return
+    now = int(time.time())
+    with metrics.timed_connect(db_path) as conn:
+        ensure_user_tables(conn, db_path)
+        conn.executemany("""
+            UPDATE accounts
+            SET last_synced_at = ?,
+                sync_cursor = CASE WHEN ? > COALESCE(sync_cursor, '') THEN ? ELSE sync_cursor END
+            WHERE user_name = ? AND bank_name = ? AND account_id = ?
+        """, [(now, cursor, cursor, user_name, bank_name, account_id) for bank_name, account_id, cursor in syncs])
+        conn.commit()
+
+
+def account_sync_state(user_name: str, db_path: str = USERS_DB) -> Dict[Tuple[str, str], Tuple[Optional[str], Optional[int]]]:
+    """(bank_name, account_id) -> (sync_cursor, last_synced_at) для всех счетов пользователя."""
+    with metrics.timed_connect(db_path) as conn:
+        ensure_user_tables(conn, db_path)
+        rows = conn.execute("""
+            SELECT bank_name, account_id, sync_cursor, last_synced_at FROM accounts WHERE user_name = ?
+        """, (user_name,)).fetchall()
+    return {(bank_name, account_id): (sync_cursor, last_synced_at)
+            for bank_name, account_id, sync_cursor, last_synced_at in rows}
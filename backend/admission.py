@@ -0,0 +1,120 @@
+"""
+Контроль допуска (admission control) для тяжёлых ручек API.
+
+У каждой тяжёлой ручки свой лимит одновременных запросов и ограниченная очередь ожидания.
+Когда очередь заполнена или ожидание дольше max_wait, запрос сразу отклоняется с Overloaded
+(в API — 503 с Retry-After), вместо того чтобы увеличивать задержку всем остальным.
+Лёгкие ручки через ограничители не проходят — для них это отдельная «полоса» без очереди.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Optional
+
+import metrics
+
+# Сколько запрос может ждать своей очереди, прежде чем получить 503 (секунды)
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "10"))
+
+
+class Overloaded(Exception):
+    """Ручка перегружена: очередь заполнена или ожидание превысило max_wait."""
+
+    def __init__(self, endpoint: str, retry_after: int):
+        super().__init__(f"Endpoint {endpoint} is overloaded, retry after {retry_after} s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    """
+    Ограничитель одновременных запросов одной ручки с очередью FIFO.
+
+    Работает в event loop воркера (не потокобезопасен). Освободившийся слот передаётся
+    первому ожидающему напрямую, поэтому новые запросы не обгоняют очередь.
+    """
+
+    def __init__(self, endpoint: str, max_concurrent: int, max_queue: int,
+                 max_wait: float = ADMISSION_MAX_WAIT_SECONDS):
+        self.endpoint = endpoint
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        # Сглаженная длительность обработки запроса — для оценки Retry-After
+        self._avg_duration = 1.0
+
+    def retry_after(self) -> int:
+        """Оценка (секунды), когда очередь рассосётся: ожидающие × средняя длительность / параллелизм."""
+        estimate = self._avg_duration * (len(self._waiters) + 1) / self.max_concurrent
+        return max(1, math.ceil(estimate))
+
+    def _reject(self, reason: str):
+        metrics.ADMISSION_DECISIONS.inc(endpoint=self.endpoint, result=reason)
+        raise Overloaded(self.endpoint, self.retry_after())
+
+    async def acquire(self) -> float:
+        """
+        Занимает слот, при необходимости ожидая в очереди.
+
+        :return: Момент (time.monotonic) начала обработки — передать в release
+        :raises Overloaded: Очередь заполнена или слот не освободился за max_wait
+        """
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            metrics.ADMISSION_DECISIONS.inc(endpoint=self.endpoint, result="admitted")
+            return time.monotonic()
+        if len(self._waiters) >= self.max_queue:
+            self._reject("rejected")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        metrics.ADMISSION_QUEUE.set(len(self._waiters), endpoint=self.endpoint)
+        try:
+            await asyncio.wait({waiter}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            # Клиент ушёл, пока ждал: если слот уже передан — возвращаем его следующему
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self._forget(waiter)
+            raise
+        if not waiter.done():
+            self._forget(waiter)
+            self._reject("timeout")
+        metrics.ADMISSION_DECISIONS.inc(endpoint=self.endpoint, result="queued")
+        return time.monotonic()
+
+    def _forget(self, waiter: asyncio.Future):
+        waiter.cancel()
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        metrics.ADMISSION_QUEUE.set(len(self._waiters), endpoint=self.endpoint)
+
+    def release(self, started: Optional[float] = None):
+        """Освобождает слот (передаёт его первому в очереди) и учитывает длительность обработки."""
+        if started is not None:
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.monotonic() - started)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                metrics.ADMISSION_QUEUE.set(len(self._waiters), endpoint=self.endpoint)
+                return
+        self.active -= 1
+        metrics.ADMISSION_QUEUE.set(0, endpoint=self.endpoint)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Слот на время блока: async with limiter.slot(): ..."""
+        started = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(started)
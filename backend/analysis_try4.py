@@ -1,14 +1,70 @@
 import itertools
+import os
+import numpy as np
 import pandas as pd
 from statistics import median
 import json
+import metrics
+import tracing
+import cashback_optimizer
+import optimizer_cache
+
+
+def month_index(month) -> int:
+    """
+    Переводит месяц (строку, Timestamp или datetime) в целочисленный индекс year * 12 + (month - 1),
+    чтобы смещения на n месяцев считались простым вычитанием.
+    """
+    ts = pd.Timestamp(month)
+    return ts.year * 12 + ts.month - 1
+
+
+def month_from_index(index: int) -> pd.Timestamp:
+    """Обратное преобразование к month_index: первый день месяца."""
+    return pd.Timestamp(year=index // 12, month=index % 12 + 1, day=1)
+
+
+def category_dtype(cashbacks_df, extra_categories=()):
+    """
+    Общий словарь категорий: категории каталога кешбеков (Title Case), затем встреченные вне каталога.
+    У пользователей с одним каталогом коды категорий совпадают, а groupby/merge работают по кодам, а не по строкам.
+    """
+    categories = sorted(set(cashbacks_df['category'].astype(str).str.strip().str.title()))
+    known = set(categories)
+    categories += sorted(set(extra_categories) - known)
+    return pd.CategoricalDtype(categories)
+
+
+def typed_transactions(months, categories, amounts, dtype=None):
+    """
+    DataFrame транзакций в компактном виде: month — int32 month_index, category — categorical, amount — float32.
+    """
+    return pd.DataFrame({
+        'month': np.asarray(months, dtype=np.int32),
+        'category': pd.Categorical(categories, dtype=dtype),
+        'amount': np.asarray(amounts, dtype=np.float32),
+    })
+
+
+def as_typed_transactions(data):
+    """Приводит DataFrame (month, category, amount) с месяцами-датами и строковыми категориями к виду typed_transactions."""
+    if pd.api.types.is_integer_dtype(data['month']) and isinstance(data['category'].dtype, pd.CategoricalDtype) \
+            and data['amount'].dtype == np.float32:
+        return data
+    months = data['month']
+    if not pd.api.types.is_integer_dtype(months):
+        months = pd.to_datetime(months)
+        months = months.dt.year * 12 + months.dt.month - 1
+    category = data['category']
+    dtype = category.dtype if isinstance(category.dtype, pd.CategoricalDtype) else None
+    return typed_transactions(months.to_numpy(), category, data['amount'].to_numpy(), dtype)
 
 
 def avg_based_prediction(data, month, n_of_months):
-    cutoff = pd.Timestamp(month) - pd.DateOffset(months=n_of_months)
+    target = month_index(month)
 
-    prediction = data[(data['month'] < month) & (data['month'] >= cutoff)]
-    prediction = prediction.groupby('category').agg(sum=('amount', 'sum')).reset_index()
+    prediction = data[(data['month'] < target) & (data['month'] >= target - n_of_months)]
+    prediction = prediction.groupby('category', observed=True).agg(sum=('amount', 'sum')).reset_index()
 
     name = f'pred_avg_{n_of_months}'
     prediction[name] = (prediction['sum'] / n_of_months)
@@ -23,8 +79,8 @@ def direct_model(data, month, w_3=0.6, w_6=0.3, w_12=0.1):
     data_12 = avg_based_prediction(data, month, 12)
 
     prediction = data_3.merge(data_6, on='category', how='outer').merge(data_12, on='category', how='outer')
-    prediction = prediction.fillna(0)
-    prediction['direct_prediction'] = w_3 * prediction['pred_avg_3'] + w_6 * prediction['pred_avg_3'] + \
+    prediction = prediction.fillna({'pred_avg_3': 0, 'pred_avg_6': 0, 'pred_avg_12': 0})
+    prediction['direct_prediction'] = w_3 * prediction['pred_avg_3'] + w_6 * prediction['pred_avg_6'] + \
                                       w_12 * prediction['pred_avg_12']
     prediction['direct_prediction'] = prediction['direct_prediction']
 
@@ -34,10 +90,11 @@ def direct_model(data, month, w_3=0.6, w_6=0.3, w_12=0.1):
 def total_expenses_prediction(data, month, weights=(0.6, 0.3, 0.1), cut_months=(1, 3, 12)):
     total_expenses = data.groupby('month').agg(total=('amount', 'sum')).reset_index()
 
+    target = month_index(month)
     res = 0
     for i in range(len(weights)):
-        cutoff = pd.Timestamp(month) - pd.DateOffset(months=cut_months[i])
-        tot_sum = sum(total_expenses[(total_expenses['month'] < month) & (total_expenses['month'] >= cutoff)]['total'])
+        cutoff = target - cut_months[i]
+        tot_sum = sum(total_expenses[(total_expenses['month'] < target) & (total_expenses['month'] >= cutoff)]['total'])
         tot_avg = tot_sum / cut_months[i]
         res += weights[i] * tot_avg
 
@@ -45,15 +102,15 @@ def total_expenses_prediction(data, month, weights=(0.6, 0.3, 0.1), cut_months=(
 
 
 def share_model(data, month, n_of_months=3, weights=(0.6, 0.3, 0.1), cut_months=(1, 3, 12)):
-    cutoff = pd.Timestamp(month) - pd.DateOffset(months=n_of_months)
-    prediction = data[(data['month'] < month) & (data['month'] >= cutoff)].copy()
+    target = month_index(month)
+    prediction = data[(data['month'] < target) & (data['month'] >= target - n_of_months)].copy()
 
     prediction['month_total'] = prediction.groupby('month')['amount'].transform('sum')
-    prediction = prediction.groupby(['month', 'month_total', 'category']).agg(cat_month_total=('amount', 'sum'))
+    prediction = prediction.groupby(['month', 'month_total', 'category'], observed=True).agg(cat_month_total=('amount', 'sum'))
     prediction = prediction.reset_index()
     prediction['cat_month_share'] = prediction['cat_month_total'] / prediction['month_total']
 
-    prediction = prediction.groupby('category')['cat_month_share'].apply(list).reset_index(name='share_list')
+    prediction = prediction.groupby('category', observed=True)['cat_month_share'].apply(list).reset_index(name='share_list')
     prediction['share_list'] = prediction['share_list'].apply(lambda lst: lst + [0] * (n_of_months - len(lst)))
     prediction['cat_share'] = prediction['share_list'].apply(median)
     prediction['cat_share'] = prediction['cat_share'] / sum(prediction['cat_share'])
@@ -64,17 +121,89 @@ def share_model(data, month, n_of_months=3, weights=(0.6, 0.3, 0.1), cut_months=
     return prediction[['category', 'share_prediction']]
 
 
+@metrics.timed(metrics.ANALYSIS_STAGE_LATENCY, stage="prediction_model")
+@tracing.traced()
 def prediction_model(data, month, w_share=0.7, w_direct=0.3):
+    if not isinstance(data, pd.DataFrame):
+        # Агрегированное состояние (prediction_state.PredictionState) считает прогноз по своим месячным суммам
+        return data.prediction(month, w_share=w_share, w_direct=w_direct)
+
+    data = as_typed_transactions(data)
     share_data = share_model(data, month)
     direct_data = direct_model(data, month)
 
-    prediction = share_data.merge(direct_data, on='category', how='outer').fillna(0)
+    prediction = share_data.merge(direct_data, on='category', how='outer').fillna({'share_prediction': 0, 'direct_prediction': 0})
     prediction['predicted_amount'] = w_share * prediction['share_prediction'] + w_direct * prediction[
         'direct_prediction']
+    # Траты хранятся в float32, прогноз отдаётся в float64 — как его ждут оптимизатор и кеш
+    prediction['predicted_amount'] = prediction['predicted_amount'].astype(np.float64)
     return prediction[['category', 'predicted_amount']]
 
 
-def choose_best_cashback(prediction_df, cashback_df):
+@metrics.timed(metrics.ANALYSIS_STAGE_LATENCY, stage="choose_best_cashback")
+@tracing.traced()
+def choose_best_cashback(prediction_df, cashback_df, mode='per_bank', use_cache=None):
+    """
+    Выбирает категории кешбека по прогнозу трат.
+
+    :param mode: 'per_bank' — каждый банк отдельно (прогноз категории учитывается в каждом банке, который её выбрал);
+                 'joint' — траты категории уходят в одну карту, выбор по всем банкам сразу (cashback_optimizer);
+                 'split' — как 'joint', но траты сверх лимитов переносятся на следующую карту,
+                 в результате есть колонка recommended_spend
+    :param use_cache: Брать выбор категорий из optimizer_cache по (версия каталога, банки, квантованный прогноз)
+                      и пересчитывать его кешбек по точному прогнозу; по умолчанию — OPTIMIZER_CACHE_ENABLED
+    """
+    if mode not in ('per_bank', 'joint', 'split'):
+        raise ValueError(f"Неизвестный режим выбора кешбека: {mode}")
+    if use_cache is None:
+        use_cache = optimizer_cache.OPTIMIZER_CACHE_ENABLED
+    if use_cache:
+        return optimizer_cache.memoized(mode, prediction_df, cashback_df,
+                                        lambda prediction, cashbacks: _best_cashback(prediction, cashbacks, mode),
+                                        lambda rows, prediction, cashbacks: _selection_cashback(rows, prediction, cashbacks, mode))
+    return _best_cashback(prediction_df, cashback_df, mode)
+
+
+def _best_cashback(prediction_df, cashback_df, mode):
+    if mode == 'joint':
+        return cashback_optimizer.joint_best_cashback(prediction_df, cashback_df)
+    if mode == 'split':
+        return cashback_optimizer.split_best_cashback(prediction_df, cashback_df).to_dataframe()
+    return per_bank_best_cashback(prediction_df, cashback_df)
+
+
+def _selection_cashback(rows_df, prediction_df, cashback_df, mode):
+    """Кешбек уже сделанного выбора категорий (строки результата choose_best_cashback) по другому прогнозу."""
+    if mode == 'joint':
+        return cashback_optimizer.joint_selection_cashback(rows_df, prediction_df, cashback_df)
+    if mode == 'split':
+        return cashback_optimizer.split_selection_cashback(rows_df, prediction_df, cashback_df)
+    return per_bank_selection_cashback(rows_df, prediction_df, cashback_df)
+
+
+def per_bank_selection_cashback(rows_df, prediction_df, cashback_df):
+    """Кешбек категорий, выбранных per_bank_best_cashback, для другого прогноза (суммы — как в переборе)."""
+    terms = {t.name: t for t in cashback_optimizer.catalog_terms(cashback_df)}
+    spend = cashback_optimizer.prediction_spend(prediction_df)
+    total_spend = prediction_df['predicted_amount'].sum()
+    results = []
+    for bank, category in zip(rows_df['bank'], rows_df['category']):
+        t = terms.get(bank)
+        if t is None:
+            continue
+        if t.all_rule is not None and category == t.all_rule[0]:
+            cb_amount = min(total_spend * t.all_rule[1] / 100, t.all_rule[2], t.bank_limit)
+        elif category in t.rules:
+            percent, category_limit = t.rules[category]
+            cb_amount = min(spend.get(category, 0) * percent / 100, category_limit)
+        else:
+            continue
+        results.append({'bank': bank, 'category': category, 'total_cb': cb_amount})
+    return pd.DataFrame(results)
+
+
+def per_bank_best_cashback(prediction_df, cashback_df):
+    """Перебор комбинаций категорий отдельно в каждом банке."""
     results = []
     total_spend = prediction_df['predicted_amount'].sum()
 
@@ -139,18 +268,70 @@ def choose_best_cashback(prediction_df, cashback_df):
     return pd.DataFrame(results)
 
 
+# Категории, которые не участвуют в прогнозе трат
+EXCLUDED_CATEGORIES = ['Зарплата', 'Other Payments', 'Платеж По Кредиту', 'Payment', 'Transfer', 'Salary']
+
+
+def excluded_category_set(exclude_categories=None):
+    """Множество исключаемых категорий в формате Title Case."""
+    if exclude_categories is None:
+        exclude_categories = EXCLUDED_CATEGORIES
+    return {cat.strip().title() for cat in exclude_categories}
+
+
 def filter_out_categories(df, exclude_categories=None):
     """
     Удаляет строки с категориями из списка exclude_categories.
     """
-    if exclude_categories is None:
-        exclude_categories = ['Зарплата', 'Other Payments', 'Платеж По Кредиту', 'Payment', 'Transfer', 'Salary']
 
-    exclude_set = {cat.strip().title() for cat in exclude_categories}
+    exclude_set = excluded_category_set(exclude_categories)
     return df[~df['category'].isin(exclude_set)].reset_index(drop=True)
 
 
 
+def transaction_category(tx, known_categories_for_matching):
+    """
+    Определяет категорию транзакции в формате Title Case.
+
+    :param tx: Транзакция из GetAccountTransactionHistory
+    :param known_categories_for_matching: Категории из кешбеков (Title Case) для сопоставления transactionInformation
+    """
+    # 1. Из merchant.category
+    if tx.get("merchant") and tx["merchant"].get("category"):
+        category = tx["merchant"]["category"]
+
+    # 2. Если merchant нет, но transactionInformation совпадает с известной категорией
+    elif tx.get("transactionInformation"):
+        info = tx["transactionInformation"].strip()
+        # Проверяем точное совпадение (регистронезависимо) с категориями из кешбэков
+        if info.title() in known_categories_for_matching:
+            category = info  # сохраняем оригинальный регистр из транзакции
+        else:
+            # Если не совпадает, помечаем как платеж
+            category = "other_payments"
+    else:
+        category = "other_payments"
+
+    # Приводим к единому формату: Title Case
+    return str(category).title().strip()
+
+
+def booking_month_index(booking_date_time: str) -> int:
+    """
+    month_index месяца транзакции по bookingDateTime.
+    Как и в parse_transactions_json_to_dataframe, берётся месяц по времени, записанному в строке (без перевода поясов).
+    Быстрый разбор — только для вида YYYY-MM[-...]; остальные форматы (например, 20250105) разбирает pandas.
+    """
+    text = booking_date_time
+    if isinstance(text, str) and len(text) >= 7 and text[4] == '-' and (len(text) == 7 or text[7] == '-') \
+            and text[0:4].isdigit() and text[5:7].isdigit() and 1 <= int(text[5:7]) <= 12:
+        return int(text[0:4]) * 12 + int(text[5:7]) - 1
+    booking_time = pd.to_datetime(booking_date_time)
+    if booking_time.tz is not None:
+        booking_time = booking_time.tz_localize(None)
+    return month_index(booking_time)
+
+
 def parse_transactions_json_to_dataframe(transactions_json_data, cashbacks_df):
     """
     Преобразует JSON-данные транзакций в DataFrame.
@@ -159,6 +340,7 @@ def parse_transactions_json_to_dataframe(transactions_json_data, cashbacks_df):
     - [...]
     
     Теперь принимает cashbacks_df для определения известных категорий.
+    Результат в компактном виде typed_transactions: month — month_index, category — categorical.
     """
     if isinstance(transactions_json_data, dict):
         raw_data = transactions_json_data.get("data", {}).get("transaction", [])
@@ -167,7 +349,7 @@ def parse_transactions_json_to_dataframe(transactions_json_data, cashbacks_df):
     else:
         raw_data = []
 
-    records = []
+    months, categories, amounts = [], [], []
 
     # Извлекаем категории из cashbacks_df
     # Предполагаем, что колонка с категорией называется 'category'
@@ -182,64 +364,67 @@ def parse_transactions_json_to_dataframe(transactions_json_data, cashbacks_df):
         if tx.get("status") != "completed":
             continue
 
-        category = None
-
-        # 1. Из merchant.category
-        if tx.get("merchant") and tx["merchant"].get("category"):
-            category = tx["merchant"]["category"]
-
-        # 2. Если merchant нет, но transactionInformation совпадает с известной категорией
-        elif tx.get("transactionInformation"):
-            info = tx["transactionInformation"].strip()
-            # Проверяем точное совпадение (регистронезависимо) с категориями из кешбэков
-            if info.title() in known_categories_for_matching:
-                category = info  # сохраняем оригинальный регистр из транзакции
-            else:
-                # Если не совпадает, помечаем как платеж
-                category = "other_payments"
-        else:
-            category = "other_payments"
+        # Только Debit-операции (расходы)
+        if tx.get("creditDebitIndicator") == "Debit":
+            months.append(booking_month_index(tx["bookingDateTime"]))
+            categories.append(transaction_category(tx, known_categories_for_matching))
+            amounts.append(abs(float(tx["amount"]["amount"])))
 
-        # Приводим к единому формату: Title Case
-        category = str(category).title().strip()
+    # Словарь категорий общий для всех пользователей с этим каталогом (см. category_dtype)
+    return typed_transactions(months, categories, amounts, category_dtype(cashbacks_df, categories))
 
-        # Сумма
-        amount = float(tx["amount"]["amount"])
-        if tx.get("creditDebitIndicator") == "Debit":
-            amount = -amount
+# Прочитанные каталоги: путь -> (mtime файла, DataFrame)
+_catalog_cache = {}
 
-        booking_time = pd.to_datetime(tx["bookingDateTime"])
-        if booking_time.tz is not None:
-            booking_time = booking_time.tz_localize(None)
-        month = booking_time.to_period('M').to_timestamp()
 
-        # Только Debit-операции (расходы)
-        if tx.get("creditDebitIndicator") == "Debit":
-            records.append({
-                "month": month,
-                "category": category,
-                "amount": abs(amount)
-            })
+def read_cashbacks_excel(cashbacks_name='Cashbacks.xlsx'):
+    """
+    Каталог кешбеков из Excel как есть. Разбор xlsx дорогой, поэтому файл перечитывается
+    только после изменения (по mtime); возвращается копия.
+    """
+    mtime = os.stat(cashbacks_name).st_mtime_ns
+    cached = _catalog_cache.get(cashbacks_name)
+    if cached is not None and cached[0] == mtime:
+        metrics.cache_hit("catalog")
+        return cached[1].copy()
+    metrics.cache_miss("catalog")
+    catalog = pd.read_excel(cashbacks_name)
+    _catalog_cache[cashbacks_name] = (mtime, catalog)
+    return catalog.copy()
 
-    df = pd.DataFrame(records) if records else pd.DataFrame(columns=["month", "category", "amount"])
-    return df
 
 # Обновлённая версия функции json_transactions_to_best_cashbacks
+def load_cashbacks(cashbacks_name='Cashbacks.xlsx'):
+    """Загружает каталог кешбеков и приводит его к внутреннему формату."""
+    cashbacks = read_cashbacks_excel(cashbacks_name)
+    # Приводим категории в кешбэках к title() для внутреннего согласования
+    cashbacks['category'] = cashbacks['category'].astype(str).str.strip().str.title()
+    cashbacks['category_limit'] = cashbacks['category_limit'].fillna(float('inf'))
+    return cashbacks
+
+
 def json_transactions_to_best_cashbacks(transactions_json_data, cashbacks_name='Cashbacks.xlsx', month='2025-11-01'):
     """
     Аналог previous_transactions_to_best_cashbacks, но принимает JSON-данные транзакций.
     """
     # Загружаем кешбэки
-    cashbacks = pd.read_excel(cashbacks_name)
-    # Приводим категории в кешбэках к title() для внутреннего согласования
-    cashbacks['category'] = cashbacks['category'].astype(str).str.strip().str.title()
-    cashbacks['category_limit'] = cashbacks['category_limit'].fillna(float('inf'))
+    cashbacks = load_cashbacks(cashbacks_name)
 
     # Передаём cashbacks_df в parse_transactions_json_to_dataframe
     transactions = parse_transactions_json_to_dataframe(transactions_json_data, cashbacks)
 
     # Фильтруем ненужные категории
-    exclude_cats = ['Зарплата', 'Other Payments', 'Платеж По Кредиту', 'Payment', 'Transfer', 'Salary']
-    transactions = filter_out_categories(transactions, exclude_cats)
+    transactions = filter_out_categories(transactions, EXCLUDED_CATEGORIES)
 
     return choose_best_cashback(prediction_model(transactions, month), cashbacks)
+
+
+def state_to_best_cashbacks(state, cashbacks_name='Cashbacks.xlsx', month='2025-11-01', mode='split'):
+    """
+    То же, что json_transactions_to_best_cashbacks, но прогноз строится по агрегированному
+    состоянию пользователя (prediction_state.PredictionState), а не по полной истории транзакций.
+
+    :param mode: Режим choose_best_cashback
+    """
+    cashbacks = load_cashbacks(cashbacks_name)
+    return choose_best_cashback(prediction_model(state, month), cashbacks, mode)
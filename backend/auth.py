@@ -0,0 +1,184 @@
+"""
+Проверка паролей и сессионные токены.
+
+argon2 намеренно дорогой по CPU, поэтому проверка пароля идёт в отдельном ограниченном пуле потоков
+(argon2-cffi отпускает GIL на время хеширования) и выполняется один раз на сессию: после входа клиент
+получает подписанный HMAC токен, проверка которого стоит микросекунды.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+import metrics
+import tracing
+
+USERS_DB = "users.db"
+
+# Параметры argon2id (по умолчанию — рекомендация OWASP: 19 MiB, 2 прохода, 1 поток).
+# Хеши со старыми параметрами пересчитываются при следующем успешном входе.
+ARGON2_TIME_COST = int(os.environ.get("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.environ.get("ARGON2_MEMORY_COST", "19456"))
+ARGON2_PARALLELISM = int(os.environ.get("ARGON2_PARALLELISM", "1"))
+
+# Сколько проверок паролей выполняется одновременно: остальные ждут в очереди и не отнимают CPU у API
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+
+# Время жизни сессионного токена и файл с секретом подписи (общий для всех воркеров uvicorn).
+# SESSION_SECRET из окружения имеет приоритет над файлом.
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", str(12 * 3600)))
+SESSION_SECRET_FILE = os.environ.get("SESSION_SECRET_FILE", "session_secret.key")
+
+_hasher = PasswordHasher(
+    time_cost=ARGON2_TIME_COST,
+    memory_cost=ARGON2_MEMORY_COST,
+    parallelism=ARGON2_PARALLELISM,
+)
+_hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="argon2")
+
+# Хеш для проверки несуществующих логинов: ответ приходит за то же время, что и для существующих
+_dummy_hash: Optional[str] = None
+_session_secret: Optional[bytes] = None
+
+
+# --- Пользователи ---
+
+def init_users_db(db_path: str = USERS_DB):
+    """Создаёт таблицу users и пользователя по умолчанию, если пользователей ещё нет."""
+    with metrics.timed_connect(db_path) as conn:
+        cursor = conn.cursor()
+        # В столбце password хранится argon2-хеш пароля
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                login TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL
+            )
+        ''')
+
+        cursor.execute('SELECT COUNT(*) FROM users')
+        if cursor.fetchone()[0] == 0:
+            default_login = "testuser"
+            default_password = "testpass"  # Смените пароль перед деплоем!
+            cursor.execute('INSERT INTO users (login, password) VALUES (?, ?)',
+                           (default_login, hash_password(default_password)))
+            print(f"Добавлен пользователь по умолчанию: {default_login}")
+        conn.commit()
+
+
+def hash_password(password: str) -> str:
+    return _hasher.hash(password)
+
+
+def verify_user(login: str, password: str, db_path: str = USERS_DB) -> bool:
+    """
+    Проверяет логин и пароль по таблице users (синхронно, нагружает CPU — вызывать через verify_user_async).
+    Хеш с устаревшими параметрами argon2 после успешной проверки заменяется новым.
+    """
+    global _dummy_hash
+    with metrics.timed_connect(db_path) as conn:
+        row = conn.execute('SELECT password FROM users WHERE login = ?', (login,)).fetchone()
+
+    if row is None:
+        if _dummy_hash is None:
+            _dummy_hash = hash_password(secrets.token_hex(16))
+        try:
+            _hasher.verify(_dummy_hash, password)
+        except VerificationError:
+            pass
+        return False
+
+    stored_hash = row[0]
+    try:
+        _hasher.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+    if _hasher.check_needs_rehash(stored_hash):
+        with metrics.timed_connect(db_path) as conn:
+            conn.execute('UPDATE users SET password = ? WHERE login = ?', (hash_password(password), login))
+            conn.commit()
+    return True
+
+
+async def verify_user_async(login: str, password: str, db_path: str = USERS_DB) -> bool:
+    """Проверка пароля в пуле PASSWORD_HASH_WORKERS потоков, не блокируя event loop."""
+    # Время включает ожидание свободного потока: рост — признак очереди на вход
+    with metrics.PASSWORD_VERIFY_LATENCY.time():
+        return await asyncio.wrap_future(tracing.submit(_hash_pool, verify_user, login, password, db_path))
+
+
+# --- Сессионные токены ---
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _load_session_secret() -> bytes:
+    """Секрет подписи: из SESSION_SECRET или из файла (создаётся при первом запуске)."""
+    global _session_secret
+    if _session_secret is not None:
+        return _session_secret
+
+    secret = os.environ.get("SESSION_SECRET")
+    if secret:
+        _session_secret = secret.encode("utf-8")
+        return _session_secret
+
+    try:
+        # O_EXCL: если воркеры стартуют одновременно, файл создаст только один из них
+        fd = os.open(SESSION_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as file:
+            file.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+    with open(SESSION_SECRET_FILE, encoding="utf-8") as file:
+        _session_secret = file.read().strip().encode("utf-8")
+    return _session_secret
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_load_session_secret(), payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def issue_session_token(login: str, ttl_seconds: int = SESSION_TTL_SECONDS) -> str:
+    """Подписанный токен сессии вида <payload>.<hmac-sha256>; payload — логин и срок действия."""
+    payload = _b64encode(json.dumps({"sub": login, "exp": int(time.time()) + ttl_seconds}).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_session_token(token: Optional[str]) -> Optional[str]:
+    """
+    Проверяет подпись и срок действия токена (без обращения к БД и argon2).
+
+    :return: Логин пользователя или None, если токен недействителен
+    """
+    if not token or token.count(".") != 1:
+        return None
+    payload, signature = token.split(".")
+    try:
+        expected = _sign(payload)
+    except UnicodeEncodeError:
+        return None
+    if not hmac.compare_digest(signature.encode("utf-8"), expected.encode("ascii")):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, json.JSONDecodeError):
+        return None
+    if not isinstance(claims, dict) or claims.get("exp", 0) < time.time():
+        return None
+    return claims.get("sub")
@@ -1,11 +1,22 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 import asyncio
 import random
 import logging
 import json
-from process_user import *
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+# Только лёгкие модули: pandas/openpyxl подгружаются в warm_up или при первом анализе
+from preparation import fetch_all_transactions, filter_transactions_last_31_days, format_transaction_date
+from process_user import analyze_best_cashbacks, analyze_best_cashbacks_progressive, push_consents_to_banks, warm_up
+import admission
+import auth
+import consent_scheduler
+import deadline
+import metrics
 from datetime import datetime, timedelta
 
 from fastapi.middleware.cors import CORSMiddleware
@@ -15,7 +26,82 @@ import random
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Прогревать ли модули анализа в фоне после старта (0 — грузить их только при первом анализе)
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") == "1"
+
+# Бюджет времени запросов, которые ходят в банки (секунды): банки, не успевшие к дедлайну, пропускаются
+ANALYSIS_DEADLINE_SECONDS = float(os.environ.get("ANALYSIS_DEADLINE_SECONDS", "20"))
+
+# Требовать сессионный токен из /api/login на ручках пользователя (0 — для клиентов, которые ещё не входят)
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "0") == "1"
+
+# Лимиты тяжёлых ручек на воркер: одновременно выполняемые и ожидающие в очереди запросы.
+# Лишние тяжёлые запросы сразу получают 503 с Retry-After.
+analysis_limiter = admission.AdmissionLimiter(
+    "analysis_results",
+    int(os.environ.get("ANALYSIS_MAX_CONCURRENT", "4")),
+    int(os.environ.get("ANALYSIS_MAX_QUEUE", "16")),
+)
+select_banks_limiter = admission.AdmissionLimiter(
+    "select_banks",
+    int(os.environ.get("SELECT_BANKS_MAX_CONCURRENT", "4")),
+    int(os.environ.get("SELECT_BANKS_MAX_QUEUE", "16")),
+)
+confirm_limiter = admission.AdmissionLimiter(
+    "confirm_cashbacks",
+    int(os.environ.get("CONFIRM_MAX_CONCURRENT", "2")),
+    int(os.environ.get("CONFIRM_MAX_QUEUE", "8")),
+)
+
+# Пул потоков asyncio.to_thread задаётся явно: по умолчанию в нём min(32, CPU + 4) потоков, и на 1–2 CPU
+# тяжёлые ручки заняли бы его целиком. Сверх суммы их лимитов API_LIGHT_THREADS потоков всегда остаются
+# лёгким ручкам (optimal_pay, bank_status, login, metrics) и фоновым задачам.
+API_LIGHT_THREADS = int(os.environ.get("API_LIGHT_THREADS", "8"))
+API_THREAD_POOL_SIZE = API_LIGHT_THREADS + sum(
+    limiter.max_concurrent for limiter in (analysis_limiter, select_banks_limiter, confirm_limiter)
+)
+
+
+async def warm_up_in_background():
+    try:
+        await asyncio.to_thread(warm_up)
+        logger.info("Analysis modules are warmed up")
+    except Exception as e:
+        logger.warning(f"Warm-up failed, modules will be loaded on first analysis: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=API_THREAD_POOL_SIZE, thread_name_prefix="api")
+    )
+    # Таблица пользователей для /api/login
+    await asyncio.to_thread(auth.init_users_db)
+    # Фоновая задача измеряет, насколько синхронный код блокирует event loop
+    background = [asyncio.create_task(metrics.monitor_event_loop())]
+    if WARMUP_ENABLED:
+        # Воркер принимает запросы сразу, тяжёлые импорты идут параллельно в потоке
+        background.append(asyncio.create_task(warm_up_in_background()))
+    if consent_scheduler.CONSENT_SCHEDULER_ENABLED:
+        # Согласия продлеваются до истечения, а не на пути пользовательского запроса
+        background.append(asyncio.create_task(consent_scheduler.run_scheduler()))
+    yield
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(admission.Overloaded)
+async def overloaded_handler(request, exc: admission.Overloaded):
+    logger.warning(f"Shedding request to {exc.endpoint}, retry after {exc.retry_after} s")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is busy, please retry later"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 # Add CORS middleware
 app.add_middleware(
@@ -47,6 +133,7 @@ class AnalysisResult(BaseModel):
     percent: float
     choosen: str  # "yes", "no"
     total_cb: Optional[float]
+    recommended_spend: Optional[float] = None  # сколько трат категории нести на эту карту
 
 class ConfirmationRequest(BaseModel):
     user_login: str
@@ -126,33 +213,64 @@ def mock_analyze_spends(user_login: str, selected_banks: List[str]) -> List[Anal
             ))
     return results
 
+def authorize(user_login: str, authorization: Optional[str]):
+    """
+    Проверяет сессионный токен (Authorization: Bearer <token>) для ручек пользователя user_login.
+    Только HMAC-подпись и срок — argon2 выполняется один раз при входе.
+    """
+    if not AUTH_REQUIRED:
+        return
+    token = authorization[7:] if authorization and authorization.startswith("Bearer ") else None
+    session_login = auth.verify_session_token(token)
+    if session_login is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired session token")
+    if session_login != user_login:
+        raise HTTPException(status_code=403, detail="Session belongs to another user")
+
 # --- Ручки API ---
 
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
 @app.post("/api/login")
 async def login(credentials: LoginRequest):
-    # Проверка логина и пароля (в реальной жизни - проверка в БД или через OAuth)
-    # Для затычки принимаем любые непустые данные
     if not credentials.login or not credentials.password:
         raise HTTPException(status_code=400, detail="Login and password are required")
 
+    # argon2 — в ограниченном пуле потоков, event loop продолжает обслуживать остальные запросы
+    if not await auth.verify_user_async(credentials.login, credentials.password):
+        logger.info(f"Failed login attempt for '{credentials.login}'.")
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
     logger.info(f"User '{credentials.login}' logged in.")
 
-    return {"detail": "Login successful", "user_login": credentials.login}
+    return {
+        "detail": "Login successful",
+        "user_login": credentials.login,
+        "session_token": auth.issue_session_token(credentials.login),
+        "expires_in": auth.SESSION_TTL_SECONDS,
+    }
 
 
 @app.post("/api/select_banks")
-async def select_banks(request: BankSelectionRequest):
+async def select_banks(request: BankSelectionRequest, authorization: Optional[str] = Header(None)):
     user_login = request.user_login
     selected_banks = request.selected_banks
+    authorize(user_login, authorization)
 
     logger.info(f"User '{user_login}' selected banks: {selected_banks}")
 
-    current_statuses = push_consents_to_banks(user_login, selected_banks) 
+    # Выполняем в пуле потоков, чтобы не блокировать event loop и дать одновременным запросам объединиться
+    async with select_banks_limiter.slot():
+        current_statuses = await asyncio.to_thread(push_consents_to_banks, user_login, selected_banks)
     return {"statuses": current_statuses}
 
 
 @app.get("/api/bank_status/{user_login}")
-async def get_bank_status(user_login: str):
+async def get_bank_status(user_login: str, authorization: Optional[str] = Header(None)):
+    authorize(user_login, authorization)
     logger.info(f"Fetching bank status for user '{user_login}'")
     if user_login not in user_bank_auth_status:
         raise HTTPException(status_code=404, detail="User not found")
@@ -176,7 +294,8 @@ async def get_bank_status(user_login: str):
 
 
 @app.get("/api/analysis_results/{user_login}")
-async def get_analysis_results(user_login: str):
+async def get_analysis_results(user_login: str, authorization: Optional[str] = Header(None)):
+    authorize(user_login, authorization)
     logger.info(f"Fetching analysis results for user '{user_login}'")
     #if user_login not in user_analysis_results:
         # Проверяем, может быть анализ ещё не завершён?
@@ -188,11 +307,71 @@ async def get_analysis_results(user_login: str):
         #else:
             #raise HTTPException(status_code=404, detail="User not found or analysis not started")
 
-    results = analyze_best_cashbacks(user_login)
-    return {"results": results}
+    # Дедлайн доходит до вызовов банков через contextvars (asyncio.to_thread копирует контекст)
+    skipped_banks = []
+    async with analysis_limiter.slot():
+        with deadline.budget(ANALYSIS_DEADLINE_SECONDS):
+            results = await asyncio.to_thread(analyze_best_cashbacks, user_login, skipped_banks)
+    if skipped_banks:
+        logger.warning(f"Partial analysis for user '{user_login}', skipped banks: {skipped_banks}")
+    return {"results": results, "partial": bool(skipped_banks), "skipped_banks": skipped_banks}
+
+@app.get("/api/analysis_results/{user_login}/stream")
+async def stream_analysis_results(user_login: str, authorization: Optional[str] = Header(None)):
+    """
+    Потоковый вариант /api/analysis_results в формате NDJSON (строка JSON на событие).
+
+    Первая строка — рекомендации по сохранённому состоянию (stage=cached), далее — уточнённые после
+    каждого ответившего банка (stage=bank), последняя — итог с partial и skipped_banks (stage=final).
+    """
+    authorize(user_login, authorization)
+    logger.info(f"Streaming analysis results for user '{user_login}'")
+    loop = asyncio.get_running_loop()
+    updates: asyncio.Queue = asyncio.Queue()
+    skipped_banks = []
+
+    def on_update(update: dict):
+        # Вызывается из потока анализа — передаём событие в event loop
+        loop.call_soon_threadsafe(updates.put_nowait, update)
+
+    # Слот занимается до начала ответа, чтобы при перегрузке вернуть 503, а не оборванный поток
+    started = await analysis_limiter.acquire()
+
+    async def run_analysis():
+        try:
+            with deadline.budget(ANALYSIS_DEADLINE_SECONDS):
+                results = await asyncio.to_thread(analyze_best_cashbacks_progressive, user_login, on_update, skipped_banks)
+            final = {"stage": "final", "results": results, "partial": bool(skipped_banks), "skipped_banks": skipped_banks}
+        except Exception as e:
+            logger.error(f"Streaming analysis failed for user '{user_login}': {e}")
+            final = {"stage": "error", "detail": "Analysis failed"}
+        finally:
+            analysis_limiter.release(started)
+        updates.put_nowait(final)
+
+    # Анализ доводится до конца, даже если клиент отключился: он сохраняет состояние прогноза
+    analysis = asyncio.create_task(run_analysis())
+
+    async def stream():
+        while True:
+            update = await updates.get()
+            yield json.dumps(update, ensure_ascii=False) + "\n"
+            if update["stage"] in ("final", "error"):
+                break
+        await analysis
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 
 @app.post("/api/confirm_cashbacks")
-async def confirm_cashbacks(request: ConfirmationRequest):
+async def confirm_cashbacks(request: ConfirmationRequest, authorization: Optional[str] = Header(None)):
+    authorize(request.user_login, authorization)
+    # Загрузка транзакций и разбор идут целиком внутри слота ручки
+    async with confirm_limiter.slot():
+        return await _confirm_cashbacks(request)
+
+
+async def _confirm_cashbacks(request: ConfirmationRequest):
     user_login = request.user_login
     # Парсим строку JSON из поля 'results'
     try:
@@ -225,7 +404,13 @@ async def confirm_cashbacks(request: ConfirmationRequest):
         to_date = last_day_previous_month.strftime('%Y-%m-%dT23:59:59Z')
 
         logger.info(f"Fetching transactions for user '{user_login}' from {from_date} to {to_date}")
-        all_transactions = fetch_all_transactions(user_login, from_date=from_date, to_date=to_date)
+        skipped_banks = []
+        with deadline.budget(ANALYSIS_DEADLINE_SECONDS):
+            all_transactions = await asyncio.to_thread(
+                fetch_all_transactions, user_login, from_date=from_date, to_date=to_date, skipped_banks=skipped_banks
+            )
+        if skipped_banks:
+            logger.warning(f"Transactions of user '{user_login}' are incomplete, skipped banks: {skipped_banks}")
         
         # Дополнительная обработка на всякий случай
         all_transactions = filter_transactions_last_31_days(all_transactions)
@@ -362,14 +547,15 @@ async def confirm_cashbacks(request: ConfirmationRequest):
 
 
 @app.get("/api/optimal_pay")
-async def login(data: OptimalPay):
+async def login(data: OptimalPay, authorization: Optional[str] = Header(None)):
     if not data.user_login:
         raise HTTPException(status_code=400, detail="Login is required")
+    authorize(data.user_login, authorization)
 
     logger.info(f"User '{data.user_login}' optimal_pay gotten.")
 
     tuple_list = []
-    with sqlite3.connect("users.db") as conn:
+    with metrics.timed_connect("users.db") as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT bank_name FROM user_banks WHERE user_name = ? and is_active = 1",
@@ -0,0 +1,370 @@
+"""
+Бэктестинг prediction_model на многих месяцах и пользователях.
+
+Вместо повторного запуска pandas-пайплайна на каждый целевой месяц история пользователя один раз
+сворачивается в матрицу (категория × месяц), после чего прогнозы для всех целевых месяцев считаются
+скользящими окнами по накопленным суммам. Формулы совпадают с share_model / direct_model / prediction_model.
+
+  python backtest.py --synthetic-users 20 --from 2025-04-01 --to 2025-12-01
+  python backtest.py --transactions user1.json user2.json --cashbacks Cashbacks.xlsx
+  python backtest.py --synthetic-users 20 --mode joint
+  python backtest.py --archive transactions_archive
+  python backtest.py --bank-users testuser
+"""
+import os
+
+os.environ.setdefault("TRACING_ENABLED", "0")
+# Оптимизатор должен считать на точных суммах, а не брать квантованный результат из кеша
+os.environ.setdefault("OPTIMIZER_CACHE_ENABLED", "0")
+
+import argparse
+import functools
+import json
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from analysis_try4 import (
+    as_typed_transactions,
+    choose_best_cashback,
+    filter_out_categories,
+    load_cashbacks,
+    month_from_index,
+    month_index,
+    parse_transactions_json_to_dataframe,
+)
+from cashback_optimizer import catalog_terms
+import transaction_archive
+
+# Параметры по умолчанию — те же, что у prediction_model / share_model / direct_model
+DEFAULT_PARAMS = {
+    "w_3": 0.6,
+    "w_6": 0.3,
+    "w_12": 0.1,
+    "share_n_of_months": 3,
+    "share_weights": (0.6, 0.3, 0.1),
+    "cut_months": (1, 3, 12),
+    "w_share": 0.7,
+    "w_direct": 0.3,
+}
+
+
+class HistoryMatrix:
+    """
+    Траты пользователя в виде плотной матрицы amounts[категория, месяц].
+
+    :ivar categories: Список категорий (строки матрицы)
+    :ivar first_month: month_index первого столбца
+    :ivar amounts: np.ndarray формы (n_categories, n_months)
+    """
+
+    def __init__(self, categories: List[str], first_month: int, amounts: np.ndarray):
+        self.categories = categories
+        self.first_month = first_month
+        self.amounts = amounts
+
+    @classmethod
+    def from_dataframe(cls, data: pd.DataFrame) -> "HistoryMatrix":
+        """Строит матрицу из DataFrame с колонками month (month_index или дата), category, amount."""
+        if data.empty:
+            return cls([], 0, np.zeros((0, 0)))
+
+        months = as_typed_transactions(data)['month'].to_numpy(dtype=np.int64)
+        first_month = int(months.min())
+        n_months = int(months.max()) - first_month + 1
+
+        codes, categories = pd.factorize(data['category'], sort=True)
+        amounts = np.zeros((len(categories), n_months))
+        np.add.at(amounts, (codes, months - first_month), data['amount'].to_numpy(dtype=float))
+        return cls(list(categories), first_month, amounts)
+
+    @property
+    def n_months(self) -> int:
+        return self.amounts.shape[1]
+
+    def actual(self, target_month: int) -> np.ndarray:
+        """Фактические траты по категориям в target_month (нули, если месяц вне истории)."""
+        column = target_month - self.first_month
+        if 0 <= column < self.n_months:
+            return self.amounts[:, column]
+        return np.zeros(len(self.categories))
+
+
+def _window_sums(cumulative: np.ndarray, targets: np.ndarray, n: int) -> np.ndarray:
+    """
+    Суммы по окну [t - n, t) для каждого целевого столбца t.
+
+    :param cumulative: Накопленные суммы с ведущим нулевым столбцом: cumulative[..., j] = сумма столбцов < j
+    :param targets: Индексы целевых месяцев относительно первого столбца (могут выходить за историю)
+    """
+    width = cumulative.shape[-1] - 1
+    high = np.clip(targets, 0, width)
+    low = np.clip(targets - n, 0, width)
+    return cumulative[..., high] - cumulative[..., low]
+
+
+def predict_all_months(history: HistoryMatrix, target_months: Sequence[int], params: Optional[dict] = None) -> np.ndarray:
+    """
+    Прогноз prediction_model сразу для всех целевых месяцев.
+
+    :param history: Матрица трат пользователя
+    :param target_months: month_index целевых месяцев
+    :param params: Параметры модели (см. DEFAULT_PARAMS)
+    :return: np.ndarray формы (n_categories, n_targets) с predicted_amount
+    """
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    amounts = history.amounts
+    n_categories = amounts.shape[0]
+    targets = np.asarray(target_months, dtype=int) - history.first_month
+    if n_categories == 0:
+        return np.zeros((0, len(targets)))
+
+    cumulative = np.concatenate([np.zeros((n_categories, 1)), np.cumsum(amounts, axis=1)], axis=1)
+
+    # direct_model: взвешенные средние за 3, 6 и 12 месяцев
+    direct = (
+        params["w_3"] * _window_sums(cumulative, targets, 3) / 3
+        + params["w_6"] * _window_sums(cumulative, targets, 6) / 6
+        + params["w_12"] * _window_sums(cumulative, targets, 12) / 12
+    )
+
+    # share_model: медиана месячных долей категории за n_of_months месяцев, нормированная на сумму долей
+    totals = amounts.sum(axis=0)
+    shares = np.divide(amounts, totals, out=np.zeros_like(amounts), where=totals > 0)
+    n_share = params["share_n_of_months"]
+    padded = np.concatenate([np.zeros((n_categories, n_share)), shares, np.zeros((n_categories, n_share))], axis=1)
+    # Окно [t - n, t) в координатах padded — столбцы t .. t + n - 1
+    columns = np.clip(targets, 0, history.n_months + n_share)[:, None] + np.arange(n_share)[None, :]
+    category_share = np.median(padded[:, columns], axis=2)
+    share_sum = category_share.sum(axis=0)
+    category_share = np.divide(category_share, share_sum, out=np.zeros_like(category_share), where=share_sum > 0)
+
+    # total_expenses_prediction: взвешенные средние месячного итога
+    totals_cumulative = np.concatenate([[0.0], np.cumsum(totals)])
+    total_expenses = np.zeros(len(targets))
+    for weight, cut in zip(params["share_weights"], params["cut_months"]):
+        total_expenses += weight * _window_sums(totals_cumulative, targets, cut) / cut
+
+    share = category_share * total_expenses[None, :]
+    return params["w_share"] * share + params["w_direct"] * direct
+
+
+def realized_cashback(selection: pd.DataFrame, spend: Dict[str, float], cashback_df: pd.DataFrame) -> float:
+    """
+    Кешбек, который принёс бы выбор категорий при фактических тратах spend.
+
+    Траты каждой категории уходят на одну карту: из банков, выбравших категорию, — туда, где кешбек больше;
+    траты категорий, не выбранных ни в одном банке, — на карту с "all" с наибольшим процентом.
+
+    :param selection: Результат choose_best_cashback (колонки bank, category)
+    :param spend: Фактические траты по категориям за месяц
+    :param cashback_df: Каталог кешбеков
+    :return: Суммарный кешбек по всем банкам с учётом category_limit и bank_limit
+    """
+    if selection is None or selection.empty:
+        return 0.0
+
+    terms = {t.name: t for t in catalog_terms(cashback_df)}
+    chosen: Dict[str, List[str]] = {}
+    all_cards = []
+    for bank, category in zip(selection['bank'], selection['category']):
+        if str(category).strip().lower() == 'all':
+            all_cards.append(bank)
+        elif category in terms[bank].rules:
+            chosen.setdefault(category, []).append(bank)
+
+    specific: Dict[str, float] = {}
+    on_all: Dict[str, float] = {}
+    all_card = max(all_cards, key=lambda bank: terms[bank].all_rule[1]) if all_cards else None
+    for category, amount in spend.items():
+        if amount <= 0:
+            continue
+        if category in chosen:
+            cashbacks = [
+                (min(amount * terms[bank].rules[category][0] / 100, terms[bank].rules[category][1]), bank)
+                for bank in chosen[category]
+            ]
+            value, bank = max(cashbacks)
+            specific[bank] = specific.get(bank, 0.0) + value
+        elif all_card is not None:
+            on_all[all_card] = on_all.get(all_card, 0.0) + amount * terms[all_card].all_rule[1] / 100
+
+    total = 0.0
+    for bank, t in terms.items():
+        bank_cb = specific.get(bank, 0.0)
+        if bank in on_all:
+            bank_cb += min(on_all[bank], t.all_rule[2])
+        total += min(bank_cb, t.bank_limit)
+    return total
+
+
+def backtest_user(
+    data: pd.DataFrame,
+    cashback_df: pd.DataFrame,
+    target_months: Sequence,
+    params: Optional[dict] = None,
+    optimizer: Callable = choose_best_cashback,
+    history: Optional[HistoryMatrix] = None
+) -> List[dict]:
+    """
+    Бэктест одного пользователя по нескольким целевым месяцам.
+
+    :param data: Транзакции после parse_transactions_json_to_dataframe и filter_out_categories
+    :param cashback_df: Каталог кешбеков (как в json_transactions_to_best_cashbacks)
+    :param target_months: Целевые месяцы (строки, Timestamp или month_index)
+    :param params: Параметры модели (см. DEFAULT_PARAMS)
+    :param optimizer: Функция выбора категорий (prediction_df, cashback_df) -> DataFrame
+    :param history: Готовая матрица трат (если уже построена)
+    :return: Список метрик по месяцам
+    """
+    history = history or HistoryMatrix.from_dataframe(data)
+    targets = [t if isinstance(t, (int, np.integer)) else month_index(t) for t in target_months]
+    predictions = predict_all_months(history, targets, params)
+
+    rows = []
+    for i, target in enumerate(targets):
+        predicted = predictions[:, i] if len(history.categories) else np.zeros(0)
+        actual = history.actual(target)
+        abs_error = np.abs(predicted - actual).sum()
+        actual_total = actual.sum()
+
+        prediction_df = pd.DataFrame({'category': history.categories, 'predicted_amount': predicted})
+        actual_df = pd.DataFrame({'category': history.categories, 'predicted_amount': actual})
+        spend = dict(zip(history.categories, actual))
+
+        chosen = optimizer(prediction_df, cashback_df)
+        optimal = optimizer(actual_df, cashback_df)
+        realized = realized_cashback(chosen, spend, cashback_df)
+        best = realized_cashback(optimal, spend, cashback_df)
+
+        rows.append({
+            "month": month_from_index(target).strftime("%Y-%m"),
+            "actual_total": float(actual_total),
+            "predicted_total": float(predicted.sum()),
+            "mae": float(abs_error / len(actual)) if len(actual) else 0.0,
+            "wape": float(abs_error / actual_total) if actual_total else None,
+            "bias": float((predicted.sum() - actual_total) / actual_total) if actual_total else None,
+            "realized_cashback": float(realized),
+            "optimal_cashback": float(best),
+            "cashback_ratio": float(realized / best) if best else None,
+        })
+    return rows
+
+
+def summarize(rows: List[dict]) -> dict:
+    """Сводные метрики по всем (пользователь, месяц)."""
+    def mean(values):
+        values = [v for v in values if v is not None]
+        return float(np.mean(values)) if values else None
+
+    realized = sum(row["realized_cashback"] for row in rows)
+    optimal = sum(row["optimal_cashback"] for row in rows)
+    actual = sum(row["actual_total"] for row in rows)
+    abs_errors = sum(row["mae"] for row in rows)
+    return {
+        "observations": len(rows),
+        "mean_mae": mean([row["mae"] for row in rows]),
+        "mean_wape": mean([row["wape"] for row in rows]),
+        "mean_bias": mean([row["bias"] for row in rows]),
+        "total_actual_spend": actual,
+        "realized_cashback": realized,
+        "optimal_cashback": optimal,
+        "cashback_ratio": realized / optimal if optimal else None,
+        "sum_mae": abs_errors,
+    }
+
+
+def backtest_population(
+    users: Dict[str, pd.DataFrame],
+    cashback_df: pd.DataFrame,
+    target_months: Sequence,
+    params: Optional[dict] = None,
+    optimizer: Callable = choose_best_cashback
+) -> dict:
+    """
+    Бэктест для набора пользователей.
+
+    :param users: user_name -> транзакции (month, category, amount)
+    :return: {"summary": ..., "users": {user_name: [метрики по месяцам]}}
+    """
+    per_user = {}
+    all_rows = []
+    for user_name, data in users.items():
+        rows = backtest_user(data, cashback_df, target_months, params, optimizer)
+        per_user[user_name] = rows
+        all_rows.extend(rows)
+    return {"summary": summarize(all_rows), "users": per_user}
+
+
+def prepare_history(transactions_json_data, cashback_df: pd.DataFrame) -> pd.DataFrame:
+    """Сырые транзакции -> DataFrame (month, category, amount), как в боевом пайплайне."""
+    return filter_out_categories(parse_transactions_json_to_dataframe(transactions_json_data, cashback_df))
+
+
+def month_range(from_month: str, to_month: str) -> List[int]:
+    return list(range(month_index(from_month), month_index(to_month) + 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бэктест prediction_model по многим месяцам")
+    parser.add_argument("--transactions", nargs="*", default=[], help="JSON-файлы с транзакциями пользователей")
+    parser.add_argument("--archive", help="Колоночный архив транзакций (transaction_archive): берутся все пользователи")
+    parser.add_argument("--bank-users", nargs="*", default=[], help="Загрузить историю пользователей из подключённых банков")
+    parser.add_argument("--synthetic-users", type=int, default=0, help="Сгенерировать N синтетических пользователей")
+    parser.add_argument("--synthetic-size", type=int, default=2000, help="Транзакций на синтетического пользователя")
+    parser.add_argument("--cashbacks", default="Cashbacks.xlsx", help="Каталог кешбеков (для синтетики генерируется, если файла нет)")
+    parser.add_argument("--from", dest="from_month", default="2025-04-01")
+    parser.add_argument("--to", dest="to_month", default="2025-12-01")
+    parser.add_argument("--params", help="JSON с параметрами модели, например '{\"w_share\": 0.5, \"w_direct\": 0.5}'")
+    parser.add_argument("--mode", choices=("per_bank", "joint"), default="per_bank", help="Режим choose_best_cashback")
+    parser.add_argument("--output", help="Сохранить подробный отчёт в JSON")
+    args = parser.parse_args()
+
+    from synthetic_data import DEFAULT_BANKS, category_names, generate_cashback_catalog, generate_user
+
+    if os.path.exists(args.cashbacks):
+        cashbacks = load_cashbacks(args.cashbacks)
+    else:
+        cashbacks = pd.DataFrame(generate_cashback_catalog(DEFAULT_BANKS, categories_per_bank=8, categories=category_names(16)))
+        cashbacks['category'] = cashbacks['category'].astype(str).str.strip().str.title()
+        cashbacks['category_limit'] = cashbacks['category_limit'].fillna(float('inf'))
+
+    users = {}
+    for path in args.transactions:
+        with open(path, encoding="utf-8") as file:
+            users[os.path.basename(path)] = prepare_history(json.load(file), cashbacks)
+    if args.archive:
+        if not transaction_archive.available():
+            parser.error("Для --archive нужен pyarrow")
+        # Один проход по архиву: читаются только колонки user/month_index/category/amount
+        spend = transaction_archive.spend_by_month(root=args.archive)
+        for user_name, frame in spend.groupby('user'):
+            users[user_name] = as_typed_transactions(frame.rename(columns={'month_index': 'month'}))
+    if args.bank_users:
+        import bank_scheduler
+        from preparation import fetch_all_transactions
+        # Пакетная загрузка: забирает только свободную квоту банков, не мешая пользователям API
+        with bank_scheduler.priority(bank_scheduler.BATCH):
+            for user_name in args.bank_users:
+                users[user_name] = prepare_history(fetch_all_transactions(user_name), cashbacks)
+    for i in range(args.synthetic_users):
+        users[f"synthetic-{i + 1}"] = prepare_history(generate_user(args.synthetic_size, seed=i), cashbacks)
+
+    if not users:
+        parser.error("Нужно указать --transactions, --archive, --bank-users или --synthetic-users")
+
+    params = json.loads(args.params) if args.params else None
+    optimizer = functools.partial(choose_best_cashback, mode=args.mode)
+    report = backtest_population(users, cashbacks, month_range(args.from_month, args.to_month), params, optimizer)
+
+    for key, value in report["summary"].items():
+        print(f"{key:<22} {value}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Общий планировщик исходящих запросов к банкам.
+
+Все запросы идут от одного клиента (team089), и песочницы банков ограничивают его нагрузку,
+поэтому фоновые задачи не должны отнимать квоту у пользователя, который ждёт ответа в интерфейсе.
+
+На каждый банк (хост API) — не больше BANK_MAX_CONCURRENT_CALLS одновременных запросов.
+Запросы делятся на классы приоритета (interactive > renewal > batch), которые задаются через
+contextvars (with priority("renewal"): ...) и наследуются потоками tracing.submit и asyncio.to_thread.
+Свободный слот получает класс с наименьшим виртуальным временем (weighted fair queuing):
+при конкуренции классы получают слоты пропорционально весам, а когда пользовательских запросов нет,
+фоновые забирают всю свободную ёмкость. Последние слоты банка зарезервированы за interactive,
+поэтому пользовательский запрос не ждёт, пока освободятся фоновые.
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Optional
+
+import deadline
+import metrics
+
+# Сколько запросов одновременно отправляется в один банк (на процесс)
+BANK_MAX_CONCURRENT_CALLS = int(os.environ.get("BANK_MAX_CONCURRENT_CALLS", "16"))
+
+INTERACTIVE = "interactive"
+RENEWAL = "renewal"
+BATCH = "batch"
+
+# Класс -> (вес в справедливой очереди, сколько последних слотов банка этому классу недоступно)
+PRIORITY_CLASSES: Dict[str, tuple] = {
+    INTERACTIVE: (16, 0),
+    RENEWAL: (4, 1),
+    BATCH: (1, 2),
+}
+
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("bank_call_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def priority(priority_class: str):
+    """Задаёт класс приоритета для всех запросов к банкам внутри блока."""
+    if priority_class not in PRIORITY_CLASSES:
+        raise ValueError(f"Неизвестный класс приоритета: {priority_class}")
+    token = _priority.set(priority_class)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+class _Ticket:
+    """Ожидающий запрос: поток ждёт event, пока планировщик не выдаст ему слот."""
+
+    __slots__ = ("event", "granted")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+
+class HostScheduler:
+    """Слоты одного банка и очереди ожидания по классам приоритета."""
+
+    def __init__(self, host: str, max_concurrent: int = BANK_MAX_CONCURRENT_CALLS):
+        self.host = host
+        self.max_concurrent = max_concurrent
+        self._lock = threading.Lock()
+        self.active = 0
+        self.active_by_class = {name: 0 for name in PRIORITY_CLASSES}
+        self._queues: Dict[str, Deque[_Ticket]] = {name: deque() for name in PRIORITY_CLASSES}
+        # Виртуальное время: finish tag последней выдачи каждого класса и системное (последней выдачи вообще)
+        self._finish = {name: 0.0 for name in PRIORITY_CLASSES}
+        self._virtual_now = 0.0
+
+    def _capacity(self, priority_class: str) -> int:
+        return max(1, self.max_concurrent - PRIORITY_CLASSES[priority_class][1])
+
+    def _dispatch(self):
+        """Раздаёт свободные слоты ожидающим (вызывается под self._lock)."""
+        while self.active < self.max_concurrent:
+            best = None
+            for name, queue in self._queues.items():
+                if not queue or self.active >= self._capacity(name):
+                    continue
+                # Класс, простаивавший в очереди, не копит «кредит»: начинает не раньше системного времени
+                start = max(self._finish[name], self._virtual_now)
+                if best is None or start < best[1]:
+                    best = (name, start)
+            if best is None:
+                return
+            name, start = best
+            ticket = self._queues[name].popleft()
+            self._virtual_now = start
+            self._finish[name] = start + 1.0 / PRIORITY_CLASSES[name][0]
+            self.active += 1
+            self.active_by_class[name] += 1
+            ticket.granted = True
+            ticket.event.set()
+
+    def acquire(self, priority_class: str, timeout: Optional[float] = None) -> bool:
+        """
+        Ждёт слот для запроса класса priority_class.
+
+        :return: False, если слот не выдан за timeout секунд
+        """
+        ticket = _Ticket()
+        with self._lock:
+            self._queues[priority_class].append(ticket)
+            self._dispatch()
+        if ticket.granted or ticket.event.wait(timeout):
+            return True
+        with self._lock:
+            if ticket.granted:
+                return True
+            self._queues[priority_class].remove(ticket)
+        return False
+
+    def release(self, priority_class: str):
+        with self._lock:
+            self.active -= 1
+            self.active_by_class[priority_class] -= 1
+            self._dispatch()
+
+
+_schedulers: Dict[str, HostScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(host: str) -> HostScheduler:
+    with _schedulers_lock:
+        scheduler = _schedulers.get(host)
+        if scheduler is None:
+            scheduler = HostScheduler(host)
+            _schedulers[host] = scheduler
+        return scheduler
+
+
+@contextmanager
+def slot(host: str):
+    """
+    Слот запроса к банку host с текущим классом приоритета на время блока.
+    Ожидание слота ограничено дедлайном текущего запроса.
+
+    :raises deadline.DeadlineExceeded: Слот не освободился до дедлайна
+    """
+    priority_class = current_priority()
+    scheduler = scheduler_for(host)
+    start = time.perf_counter()
+    if not scheduler.acquire(priority_class, deadline.remaining()):
+        raise deadline.DeadlineExceeded(f"Нет свободного слота для запроса к {host} до дедлайна")
+    metrics.BANK_CALL_QUEUE_WAIT.observe(time.perf_counter() - start, bank=host, priority=priority_class)
+    try:
+        yield
+    finally:
+        scheduler.release(priority_class)
@@ -1,7 +1,15 @@
 import requests
 import sqlite3
-from datetime import datetime, timedelta
+import metrics
+from VTBAPI_Requests import CreateBankToken, bank_base_url
+from datetime import datetime
 import json
+import time
+from singleflight import SingleFlight
+from token_store import TOKENS_DB, TOKEN_REFRESH_MARGIN_SECONDS, ensure_token_table, save_token, token_expirations
+
+# Объединение одновременных запросов токена для одного банка
+token_flight = SingleFlight("bank_token")
 
 def parse_banks_json(file_path: str):
     """
@@ -51,23 +59,10 @@ def parse_banks_json(file_path: str):
         return {}
 
 def ensure_table_exists():
-    """Создаёт таблицу tokens, если она не существует."""
+    """Создаёт таблицу tokens (или переносит старую в новую схему), если нужно."""
     try:
-        with sqlite3.connect('bank_tokens.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS tokens (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bank_name TEXT NOT NULL,
-                    access_token TEXT NOT NULL,
-                    token_type TEXT NOT NULL,
-                    client_id TEXT NOT NULL,
-                    algorithm TEXT,
-                    expires_in INTEGER,
-                    add_time DATETIME NOT NULL
-                )
-            ''')
-            conn.commit()
+        with metrics.timed_connect(TOKENS_DB) as conn:
+            ensure_token_table(conn, TOKENS_DB)
     except sqlite3.OperationalError as e:
         print(f"Ошибка при работе с базой данных: {e}")
             
@@ -76,24 +71,22 @@ def get_bank_access_token(bank: str, client_id: str, client_secret: str) -> bool
     """
     Предполагается, что эта функция реализована, как в предыдущем ответе.
     Она делает запрос к API банка и сохраняет токен в БД.
+    Одновременные запросы токена для одного (bank, client_id) выполняются один раз.
     """
+    return token_flight.do((bank, client_id), _request_bank_access_token, bank, client_id, client_secret)
+
+
+def _request_bank_access_token(bank: str, client_id: str, client_secret: str) -> bool:
+    """Запрашивает токен у банка и сохраняет его в БД."""
 
-    base_url = f"https://{bank}.open.bankingapi.ru/auth/bank-token"
-    params = {
-        'client_id': client_id,
-        'client_secret': client_secret
-    }
+    base_url = bank_base_url(bank)
 
     try:
-        response = requests.post(
-            url=base_url,
-            params=params,
-            headers={'accept': 'application/json'},
-            data=''
+        data = CreateBankToken(
+            client_id=client_id,
+            client_secret=client_secret,
+            base_url=base_url
         )
-        response.raise_for_status()
-
-        data = response.json()
 
         access_token = data.get('access_token')
         token_type = data.get('token_type')
@@ -104,36 +97,15 @@ def get_bank_access_token(bank: str, client_id: str, client_secret: str) -> bool
         if not all([access_token, token_type, retrieved_client_id, algorithm, expires_in]):
             print("Ошибка: Ответ API не содержит всех ожидаемых полей.")
             return False
+        # Токены ищутся по client_id из credentials.json — сохраняем только токен, выданный этому клиенту
+        if retrieved_client_id != client_id:
+            print(f"Ошибка: банк {bank} выдал токен для client_id {retrieved_client_id}, а не {client_id}.")
+            return False
 
-        add_time = datetime.now()
-
-        with sqlite3.connect('bank_tokens.db') as conn:
-            cursor = conn.cursor()
-
-            # Создаём таблицу, если она не существует
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS tokens (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bank_name TEXT NOT NULL,
-                    access_token TEXT NOT NULL,
-                    token_type TEXT NOT NULL,
-                    client_id TEXT NOT NULL,
-                    algorithm TEXT,
-                    expires_in INTEGER,
-                    add_time DATETIME NOT NULL
-                )
-            ''')
-
-            cursor.execute('''
-                INSERT OR REPLACE INTO tokens (
-                    bank_name, access_token, token_type, client_id, algorithm, expires_in, add_time
-                ) VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (bank, access_token, token_type, retrieved_client_id, algorithm, expires_in, add_time))
-
-            conn.commit()
-            print(f"Токен для банка {bank} успешно получен и сохранён/обновлён.")
-            return True
-
+        # Токен пары (bank, client_id) заменяется, старые строки не копятся
+        save_token(bank, client_id, access_token, token_type, algorithm, expires_in, TOKENS_DB)
+        print(f"Токен для банка {bank} успешно получен и сохранён/обновлён.")
+        return True
 
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при выполнении запроса для {bank}: {e}")
@@ -152,82 +124,37 @@ def get_bank_access_token(bank: str, client_id: str, client_secret: str) -> bool
 def update_expired_tokens():
     """
     Проверяет срок действия токенов в БД для поддерживаемых банков.
-    Если токен истёк, вызывает get_bank_access_token для его обновления.
+    Если токена нет или он истекает в ближайшие TOKEN_REFRESH_MARGIN_SECONDS, вызывает get_bank_access_token.
     """
-    # Ensure the table exists before any operations
-    ensure_table_exists()
-    
     # Получаем список поддерживаемых банков из словаря
     BANK_CREDENTIALS = parse_banks_json("credentials.json")
-    supported_banks = BANK_CREDENTIALS.keys()
 
     try:
-        for bank in supported_banks:
+        # Сроки всех токенов — одним запросом
+        expirations = token_expirations(TOKENS_DB)
+        refresh_before = int(time.time()) + TOKEN_REFRESH_MARGIN_SECONDS
+
+        for bank, credentials in BANK_CREDENTIALS.items():
             print(f"Проверяем токен для банка: {bank}")
-            
-            row = False
-            with sqlite3.connect('bank_tokens.db') as conn:
-                cursor = conn.cursor()
-                # Получаем информацию о токене из БД
-                cursor.execute('''
-                    SELECT expires_in, add_time FROM tokens WHERE bank_name = ?
-                ''', (bank,))
-
-                row = cursor.fetchone()
-
-            if row:
-                expires_in, add_time_str = row
-                # Преобразуем строку времени в объект datetime
-                try:
-                    # Пытаемся использовать fromisoformat (работает для стандартных форматов)
-                    add_time = datetime.fromisoformat(add_time_str.replace(' ', 'T'))
-                except ValueError:
-                    # Если fromisoformat не сработал, можно попробовать strptime с конкретным форматом
-                    # Например, если формат всегда такой: "%Y-%m-%d %H:%M:%S.%f"
-                    try:
-                        add_time = datetime.strptime(add_time_str, "%Y-%m-%d %H:%M:%S.%f")
-                    except ValueError:
-                        # Если и это не сработает, пробуем без микросекунд
-                        add_time = datetime.strptime(add_time_str, "%Y-%m-%d %H:%M:%S")
-
-                # Вычисляем время истечения
-                expiration_time = add_time + timedelta(seconds=expires_in)
-                current_time = datetime.now()
-
-                if current_time >= expiration_time:
-                    print(f"  -> Токен для {bank} истёк (истёк {expiration_time}). Обновляем...")
-                    credentials = BANK_CREDENTIALS.get(bank)
-                    if credentials:
-                        success = get_bank_access_token(
-                            bank=bank,
-                            client_id=credentials['client_id'],
-                            client_secret=credentials['client_secret']
-                        )
-                        if success:
-                            print(f"  -> Токен для {bank} успешно обновлён.")
-                        else:
-                            print(f"  -> Не удалось обновить токен для {bank}.")
-                    else:
-                        print(f"  -> Учётные данные для банка {bank} не найдены в BANK_CREDENTIALS.")
-                else:
-                    print(f"  -> Токен для {bank} действителен до {expiration_time}.")
-            else:
-                print(f"  -> Запись для банка {bank} не найдена в БД. Получаем новый токен...")
-                credentials = BANK_CREDENTIALS.get(bank)
-                if credentials:
-                    success = get_bank_access_token(
-                        bank=bank,
-                        client_id=credentials['client_id'],
-                        client_secret=credentials['client_secret']
-                    )
-                    if success:
-                        print(f"  -> Новый токен для {bank} успешно получен и сохранён.")
-                    else:
-                        print(f"  -> Не удалось получить токен для {bank}.")
-                else:
-                    print(f"  -> Учётные данные для банка {bank} не найдены в BANK_CREDENTIALS.")
+            expires_at = expirations.get((bank, credentials['client_id']))
 
-        conn.close()
+            if expires_at is None:
+                print(f"  -> Запись для банка {bank} не найдена в БД. Получаем новый токен...")
+            elif expires_at <= refresh_before:
+                print(f"  -> Токен для {bank} истёк или скоро истечёт ({datetime.fromtimestamp(expires_at)}). Обновляем...")
+            else:
+                print(f"  -> Токен для {bank} действителен до {datetime.fromtimestamp(expires_at)}.")
+                continue
+
+            success = get_bank_access_token(
+                bank=bank,
+                client_id=credentials['client_id'],
+                client_secret=credentials['client_secret']
+            )
+            if success:
+                print(f"  -> Токен для {bank} успешно обновлён.")
+            else:
+                print(f"  -> Не удалось обновить токен для {bank}.")
 
     except sqlite3.Error as e:
         print(f"Ошибка при работе с базой данных: {e}")
@@ -243,11 +170,11 @@ def print_bank_tokens():
     
     try:
         # Подключаемся к базе данных
-        conn = sqlite3.connect('bank_tokens.db')
+        conn = metrics.timed_connect(TOKENS_DB)
         cursor = conn.cursor()
 
         # Выполняем SELECT-запрос
-        cursor.execute('SELECT bank_name, access_token, token_type, client_id, algorithm, expires_in, add_time FROM tokens')
+        cursor.execute('SELECT bank_name, access_token, token_type, client_id, algorithm, expires_in, expires_at FROM tokens ORDER BY expires_at')
 
         # Получаем имена столбцов для заголовка
         column_names = [description[0] for description in cursor.description]
@@ -0,0 +1,324 @@
+"""
+Микробенчмарки движка анализа (analysis_try4 / cashbacks_process).
+
+Прогоняет функции на синтетических пользователях возрастающего размера и сохраняет результаты в JSON,
+чтобы сравнивать производительность между коммитами.
+
+  python bench_analysis.py                       # полный прогон, результат в bench_results/<commit>.json
+  python bench_analysis.py --quick               # уменьшенные размеры для быстрой проверки
+  python bench_analysis.py --compare old.json new.json
+
+choose_best_cashback (перебор C(n, k) комбинаций на банк) для больших каталогов целиком не прогнать:
+выше --max-combinations время оценивается по двум случайным выборкам комбинаций разного размера
+(постоянная часть + стоимость одной комбинации × C(n, k)); такие строки помечены "estimated".
+
+Масштабирование совместного выбора (joint_assignment) меряется на сетке банки × категории с тратами,
+упирающимися в bank_limit; для каждого случая сохраняется, успел ли перебор в MAX_SEARCH_SECONDS ("exact").
+"""
+import os
+
+# Бенчмарки не должны писать трассы на диск
+os.environ.setdefault("TRACING_ENABLED", "0")
+# Измеряется сам оптимизатор, а не кеш его результатов
+os.environ.setdefault("OPTIMIZER_CACHE_ENABLED", "0")
+
+import argparse
+import json
+import math
+import platform
+import random
+import statistics
+import subprocess
+import time
+import types
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+import analysis_try4
+import cashback_optimizer
+from analysis_try4 import (
+    avg_based_prediction,
+    choose_best_cashback,
+    direct_model,
+    filter_out_categories,
+    parse_transactions_json_to_dataframe,
+    prediction_model,
+    share_model,
+)
+from cashbacks_process import process_dataframe_and_rules
+from synthetic_data import category_names, generate_cashback_catalog, generate_user
+
+TARGET_MONTH = "2025-10-01"
+
+TRANSACTION_SIZES = (100, 1_000, 10_000, 100_000)
+CATEGORY_SIZES = (5, 10, 20, 50, 100, 200)
+K_VALUES = (1, 2, 3, 4, 5, 6)
+
+QUICK_TRANSACTION_SIZES = (100, 1_000, 10_000)
+QUICK_CATEGORY_SIZES = (5, 10, 20)
+QUICK_K_VALUES = (1, 2, 3)
+
+# choose_best_cashback перебирает C(n, k) комбинаций на банк; больше этого — оценка по выборке
+MAX_COMBINATIONS = 2_000
+# Размеры выборок комбинаций на банк для оценки времени полного перебора
+SAMPLE_COMBINATIONS = (100, 300)
+
+# Ограничение суммарного времени измерений одного случая, секунды
+CASE_TIME_BUDGET = 30.0
+
+BANKS = ("abank", "sbank", "vbank")
+
+# (банков, категорий на банк) для масштабирования joint_assignment
+SCALING_GRID = ((3, 10), (3, 20), (5, 20), (5, 30), (8, 30), (8, 50))
+QUICK_SCALING_GRID = ((3, 10), (3, 20), (5, 30))
+SCALING_SEEDS = (0, 1, 2)
+
+
+def measure(func: Callable, repeat: int, min_time: float = 0.2) -> Dict[str, float]:
+    """
+    Измеряет время вызова func: repeat серий, в каждой — столько вызовов, чтобы серия длилась не меньше min_time.
+
+    Медленные случаи получают меньше серий, чтобы уложиться в CASE_TIME_BUDGET.
+
+    :return: min/median на один вызов (секунды) и количество вызовов в серии
+    """
+    start = time.perf_counter()
+    func()
+    single = time.perf_counter() - start
+    number = max(1, int(min_time / single)) if single > 0 else 1000
+    if single > 0:
+        repeat = max(1, min(repeat, int(CASE_TIME_BUDGET / (single * number))))
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+
+    return {"min_s": min(timings), "median_s": statistics.median(timings), "number": number, "repeat": repeat}
+
+
+@contextmanager
+def sampled_combinations(sample: int, seed: int = 0):
+    """Подменяет перебор комбинаций в analysis_try4 случайной выборкой из sample комбинаций на банк."""
+    rng = random.Random(seed)
+
+    def combinations(items, k):
+        items = list(items)
+        for _ in range(sample):
+            yield tuple(rng.sample(items, k))
+
+    original = analysis_try4.itertools
+    analysis_try4.itertools = types.SimpleNamespace(combinations=combinations)
+    try:
+        yield
+    finally:
+        analysis_try4.itertools = original
+
+
+def estimate_full_search(func: Callable, combinations: int, repeat: int) -> Dict[str, float]:
+    """
+    Оценка времени func с полным перебором combinations комбинаций на банк.
+
+    Время измеряется на двух выборках; по ним находятся стоимость одной комбинации и постоянная часть
+    (разбор каталога, группировка по банкам), которые экстраполируются на полный перебор.
+    """
+    small, large = SAMPLE_COMBINATIONS
+    timings = {}
+    for sample in (small, large):
+        with sampled_combinations(sample):
+            timings[sample] = measure(func, min(repeat, 3))
+    per_combination = max(0.0, (timings[large]["median_s"] - timings[small]["median_s"]) / (large - small))
+    fixed = max(0.0, timings[small]["median_s"] - per_combination * small)
+    median = fixed + per_combination * combinations
+    return {
+        "min_s": median, "median_s": median, "estimated": True,
+        "per_combination_s": per_combination, "fixed_s": fixed, "sampled_combinations": list(SAMPLE_COMBINATIONS),
+    }
+
+
+def make_catalog(n_categories: int, k: int, seed: int = 0, banks=BANKS, with_all_category: bool = False) -> pd.DataFrame:
+    """Каталог кешбеков в том виде, в котором его готовит json_transactions_to_best_cashbacks."""
+    catalog = pd.DataFrame(generate_cashback_catalog(
+        banks, categories_per_bank=n_categories, max_categories_in_bank=k,
+        categories=category_names(n_categories), seed=seed, with_all_category=with_all_category
+    ))
+    catalog['category'] = catalog['category'].astype(str).str.strip().str.title()
+    catalog['category_limit'] = catalog['category_limit'].fillna(float('inf'))
+    return catalog
+
+
+def make_prediction(n_categories: int, seed: int = 0) -> pd.DataFrame:
+    """Прогноз трат по категориям для choose_best_cashback."""
+    rng = pd.Series(range(n_categories)).sample(frac=1, random_state=seed).to_numpy()
+    return pd.DataFrame({
+        "category": [name.title() for name in category_names(n_categories)],
+        "predicted_amount": [1000.0 + 137.0 * int(i) for i in rng],
+    })
+
+
+def make_heavy_spend(n_categories: int, seed: int = 0) -> Dict[str, float]:
+    """Прогноз трат с тяжёлым хвостом: лимиты банков ограничивают выбор, перебор не решается оценкой без лимитов."""
+    rng = random.Random(seed)
+    return {name.title(): rng.lognormvariate(0, 1) * 3000 for name in category_names(n_categories)}
+
+
+def bench_pipeline(sizes, repeat: int) -> List[dict]:
+    """Функции, зависящие от количества транзакций."""
+    results = []
+    catalog = make_catalog(20, 3)
+    for n in sizes:
+        raw = generate_user(n, banks=BANKS, categories=category_names(20), seed=n)
+        parsed = parse_transactions_json_to_dataframe(raw, catalog)
+        data = filter_out_categories(parsed)
+
+        cases = {
+            "parse_transactions_json_to_dataframe": lambda: parse_transactions_json_to_dataframe(raw, catalog),
+            "filter_out_categories": lambda: filter_out_categories(parsed),
+            "avg_based_prediction": lambda: avg_based_prediction(data, TARGET_MONTH, 3),
+            "share_model": lambda: share_model(data, TARGET_MONTH),
+            "direct_model": lambda: direct_model(data, TARGET_MONTH),
+            "prediction_model": lambda: prediction_model(data, TARGET_MONTH),
+        }
+        for name, func in cases.items():
+            timing = measure(func, repeat)
+            results.append({"function": name, "params": {"transactions": n}, **timing})
+            print(f"{name:<40} n={n:<7} {timing['median_s'] * 1000:10.3f} мс")
+    return results
+
+
+def bench_optimizer(category_sizes, k_values, repeat: int, max_combinations: int = MAX_COMBINATIONS) -> List[dict]:
+    """choose_best_cashback и process_dataframe_and_rules в зависимости от размера каталога и k."""
+    results = []
+    for n_categories in category_sizes:
+        prediction = make_prediction(n_categories)
+        for k in k_values:
+            catalog = make_catalog(n_categories, k)
+            combinations = math.comb(n_categories, min(k, n_categories))
+            params = {"categories_per_bank": n_categories, "k": k, "banks": len(BANKS), "combinations_per_bank": combinations}
+
+            # Совместный выбор по всем банкам (и с разделением трат) не перебирает комбинации и не пропускается
+            timing = measure(lambda: choose_best_cashback(prediction, catalog, mode='joint'), repeat)
+            results.append({"function": "choose_best_cashback_joint", "params": params, **timing})
+            print(f"{'choose_best_cashback_joint':<40} cats={n_categories:<4} k={k} {timing['median_s'] * 1000:10.3f} мс")
+            timing = measure(lambda: choose_best_cashback(prediction, catalog, mode='split'), repeat)
+            results.append({"function": "choose_best_cashback_split", "params": params, **timing})
+            print(f"{'choose_best_cashback_split':<40} cats={n_categories:<4} k={k} {timing['median_s'] * 1000:10.3f} мс")
+
+            if combinations > max_combinations:
+                timing = estimate_full_search(lambda: choose_best_cashback(prediction, catalog), combinations, repeat)
+                results.append({"function": "choose_best_cashback", "params": params, **timing})
+                print(f"{'choose_best_cashback':<40} cats={n_categories:<4} k={k} {timing['median_s'] * 1000:10.3f} мс"
+                      f" (оценка по выборке, {combinations} комбинаций)")
+                continue
+
+            timing = measure(lambda: choose_best_cashback(prediction, catalog), repeat)
+            results.append({"function": "choose_best_cashback", "params": params, **timing})
+            print(f"{'choose_best_cashback':<40} cats={n_categories:<4} k={k} {timing['median_s'] * 1000:10.3f} мс")
+
+        catalog = make_catalog(n_categories, 3)
+        # Вход того же вида, что у choose_best_cashback, но без полного перебора на больших каталогах
+        best = choose_best_cashback(prediction, catalog, mode='joint')
+        rules = catalog[['bank', 'category', 'percent']].to_dict(orient='records')
+        timing = measure(lambda: process_dataframe_and_rules(best, rules), repeat)
+        results.append({"function": "process_dataframe_and_rules", "params": {"categories_per_bank": n_categories}, **timing})
+        print(f"{'process_dataframe_and_rules':<40} cats={n_categories:<4} {timing['median_s'] * 1000:10.3f} мс")
+    return results
+
+
+def bench_joint_scaling(grid, repeat: int) -> List[dict]:
+    """Время и точность joint_assignment на сетке (банков, категорий) при k=3 и категории "All" в каждом банке."""
+    results = []
+    for n_banks, n_categories in grid:
+        banks = [f"bank{i}" for i in range(n_banks)]
+        for seed in SCALING_SEEDS:
+            terms = cashback_optimizer.catalog_terms(make_catalog(n_categories, 3, seed, banks, with_all_category=True))
+            spend = make_heavy_spend(n_categories, seed)
+            solution = cashback_optimizer.joint_assignment(spend, terms)
+            timing = measure(lambda: cashback_optimizer.joint_assignment(spend, terms), repeat)
+            params = {"banks": n_banks, "categories_per_bank": n_categories, "seed": seed,
+                      "max_search_seconds": cashback_optimizer.MAX_SEARCH_SECONDS}
+            results.append({"function": "joint_assignment_scaling", "params": params, **timing,
+                            "exact": solution.exact, "value": solution.value})
+            print(f"{'joint_assignment_scaling':<40} banks={n_banks:<3} cats={n_categories:<4} seed={seed} "
+                  f"{timing['median_s'] * 1000:10.3f} мс{'' if solution.exact else ' (не точно)'}")
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_path: str, new_path: str):
+    """Печатает отношение времени new/old для совпадающих (function, params)."""
+    def index(path):
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        return {
+            (row["function"], json.dumps(row["params"], sort_keys=True)): row
+            for row in data["results"] if not row.get("skipped")
+        }
+
+    old, new = index(old_path), index(new_path)
+    print(f"{'Функция':<40} {'Параметры':<60} {'old, мс':>10} {'new, мс':>10} {'new/old':>8}")
+    for key in sorted(old.keys() & new.keys()):
+        old_ms = old[key]["median_s"] * 1000
+        new_ms = new[key]["median_s"] * 1000
+        ratio = new_ms / old_ms if old_ms else float('nan')
+        # ~ — хотя бы одно из значений оценено по выборке комбинаций
+        mark = "~" if old[key].get("estimated") or new[key].get("estimated") else ""
+        print(f"{key[0]:<40} {key[1]:<60} {old_ms:10.3f} {new_ms:10.3f} {ratio:8.2f}{mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки analysis_try4")
+    parser.add_argument("--quick", action="store_true", help="Уменьшенные размеры входных данных")
+    parser.add_argument("--repeat", type=int, default=5, help="Количество серий измерений")
+    parser.add_argument("--max-combinations", type=int, default=MAX_COMBINATIONS,
+                        help="Выше этого C(n, k) время choose_best_cashback оценивается по выборке комбинаций")
+    parser.add_argument("--output", help="Путь к JSON с результатами (по умолчанию bench_results/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Сравнить два файла результатов")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    sizes = QUICK_TRANSACTION_SIZES if args.quick else TRANSACTION_SIZES
+    category_sizes = QUICK_CATEGORY_SIZES if args.quick else CATEGORY_SIZES
+    k_values = QUICK_K_VALUES if args.quick else K_VALUES
+    scaling_grid = QUICK_SCALING_GRID if args.quick else SCALING_GRID
+
+    commit = git_commit()
+    results = (bench_pipeline(sizes, args.repeat)
+               + bench_optimizer(category_sizes, k_values, args.repeat, args.max_combinations)
+               + bench_joint_scaling(scaling_grid, args.repeat))
+
+    report = {
+        "commit": commit,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "max_combinations": args.max_combinations,
+        "results": results,
+    }
+
+    output = args.output or os.path.join("bench_results", f"{commit}{'-quick' if args.quick else ''}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,986 @@
+"""
+Выбор категорий кешбека сразу по всем банкам пользователя.
+
+choose_best_cashback в analysis_try4 оптимизирует каждый банк отдельно и считает, что весь прогноз трат
+категории уйдёт в каждый банк, который её выбрал. Здесь траты категории относятся к одной карте:
+ищется назначение «категория → банк», максимизирующее суммарный кешбек с учётом max_categories_in_bank,
+category_limit и bank_limit.
+
+Режим с разделением трат (split_assignment) дополнительно переносит траты сверх category_limit
+на следующую по выгодности карту и возвращает рекомендуемое распределение трат по картам.
+
+Точный поиск — ветви и границы по категориям (от самых выгодных) с отсечением по верхней оценке
+и отбрасыванием состояний, которые не лучше уже просмотренных. Верхней оценкой и часто готовым ответом
+служит та же задача без bank_limit — максимальное b-паросочетание, которое решается точно за полиномиальное время.
+Перебор ограничен по узлам и по времени (MAX_SEARCH_SECONDS, но не дольше дедлайна запроса):
+при остановке возвращается лучшее найденное решение, не хуже жадного.
+"""
+import itertools
+import os
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import deadline
+
+INF = float('inf')
+
+# Предел узлов перебора: при превышении возвращается лучшее найденное решение
+MAX_SEARCH_NODES = 50_000
+# Предел времени перебора одного выбора, секунды: расчёт идёт на пути запроса
+MAX_SEARCH_SECONDS = float(os.environ.get("OPTIMIZER_MAX_SEARCH_SECONDS", "0.5"))
+# Шаги уточнения оценки с лимитами банков (_lagrangian_bound) перед перебором
+LAGRANGIAN_ITERATIONS = 10
+# Сколько несравнимых состояний запоминается на одну пару (категория, занятые слоты)
+MAX_STATES_PER_KEY = 16
+
+
+class BankTerms:
+    """Условия кешбека одного банка из каталога."""
+
+    def __init__(self, name: str, max_categories: int, bank_limit: float,
+                 rules: Dict[str, Tuple[float, float]], all_rule: Optional[Tuple[str, float, float]]):
+        self.name = name
+        self.max_categories = max_categories
+        self.bank_limit = bank_limit
+        # category -> (percent, category_limit)
+        self.rules = rules
+        # (написание категории "all" в каталоге, percent, category_limit) или None
+        self.all_rule = all_rule
+
+
+class JointSolution:
+    """Результат совместного выбора категорий."""
+
+    def __init__(self, value: float, rows: List[dict], assignment: Dict[str, str], exact: bool,
+                 all_banks: Iterable[str] = ()):
+        # Суммарный кешбек с учётом всех лимитов
+        self.value = value
+        # Строки в формате choose_best_cashback: bank, category, total_cb
+        self.rows = rows
+        # category -> bank, в который уходят траты категории
+        self.assignment = assignment
+        # False, если перебор остановлен по MAX_SEARCH_NODES или MAX_SEARCH_SECONDS
+        self.exact = exact
+        # Банки, выбравшие категорию "all"
+        self.all_banks = set(all_banks)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.rows, columns=['bank', 'category', 'total_cb'])
+
+
+def _limit(value) -> float:
+    """Пустой лимит в каталоге означает отсутствие ограничения."""
+    return INF if value is None or pd.isna(value) else float(value)
+
+
+def catalog_terms(cashback_df: pd.DataFrame) -> List[BankTerms]:
+    """
+    Разбирает каталог кешбеков (после load_cashbacks) по банкам.
+    Как и в choose_best_cashback, max_categories_in_bank и bank_limit берутся из первой строки банка,
+    а для повторяющихся категорий — первая строка.
+    """
+    terms = []
+    for bank, df_bank in cashback_df.groupby("bank"):
+        rules = {}
+        all_rule = None
+        for category, percent, category_limit in zip(df_bank['category'], df_bank['percent'], df_bank['category_limit']):
+            if str(category).strip().lower() == 'all':
+                if all_rule is None:
+                    all_rule = (category, float(percent), _limit(category_limit))
+            elif category not in rules:
+                rules[category] = (float(percent), _limit(category_limit))
+        terms.append(BankTerms(
+            bank, int(df_bank['max_categories_in_bank'].iloc[0]), _limit(df_bank['bank_limit'].iloc[0]), rules, all_rule
+        ))
+    return terms
+
+
+def prediction_spend(prediction_df: pd.DataFrame) -> Dict[str, float]:
+    """category -> прогноз трат (для повторов — первая строка, как в choose_best_cashback)."""
+    spend = {}
+    for category, amount in zip(prediction_df['category'], prediction_df['predicted_amount']):
+        spend.setdefault(category, float(amount))
+    return spend
+
+
+def max_weight_assignment(values: List[List[float]], capacities: List[int]) -> Tuple[float, List[int]]:
+    """
+    Назначение категорий банкам с максимальной суммой values без учёта bank_limit
+    (максимальное b-паросочетание методом последовательных кратчайших путей).
+
+    Увеличивающий путь «свободная категория → банк → перенос одной из его категорий в другой банк → ...»
+    ищется в графе только на банках: ребро a → c — лучший перенос категории из банка a в банк c.
+    Пути добавляются, пока они увеличивают сумму.
+
+    :return: (сумма values по назначению, банк для каждой категории или -1)
+    """
+    n_items, n_banks = len(values), len(capacities)
+    assignment = [-1] * n_items
+    members: List[List[int]] = [[] for _ in range(n_banks)]
+    # Категории банка по убыванию кешбека: назначенная категория свободной больше не становится,
+    # поэтому лучшая свободная находится сдвигом указателя
+    ranked = [sorted((i for i in range(n_items) if values[i][b] > 0), key=lambda i: -values[i][b]) for b in range(n_banks)]
+    pointers = [0] * n_banks
+    move = [[(-INF, -1)] * n_banks for _ in range(n_banks)]
+    # Переносы пересчитываются только для банков, потерявших категорию; для пополнившихся
+    # достаточно проверить новые категории (при равенстве, как и при полном обходе, остаётся более ранняя)
+    shrunk_banks = set()
+    added: Dict[int, List[int]] = {}
+
+    while True:
+        # Вход в банк: лучшая свободная категория
+        gain = [-INF] * n_banks
+        enter = [-1] * n_banks
+        for b in range(n_banks):
+            k = pointers[b]
+            while k < len(ranked[b]) and assignment[ranked[b][k]] >= 0:
+                k += 1
+            pointers[b] = k
+            if k < len(ranked[b]):
+                enter[b] = ranked[b][k]
+                gain[b] = values[enter[b]][b]
+        # Перенос a -> c: одна из категорий банка a уходит в банк c
+        for a in shrunk_banks:
+            move[a] = [(-INF, -1)] * n_banks
+            added[a] = members[a]
+        for a, new_members in added.items():
+            for i in new_members:
+                row = values[i]
+                for c in range(n_banks):
+                    if c != a and row[c] > 0 and row[c] - row[a] > move[a][c][0]:
+                        move[a][c] = (row[c] - row[a], i)
+        shrunk_banks = set()
+        added = {}
+
+        # Лучший путь до каждого банка (Беллман — Форд с очередью: ребра проверяются только у банков,
+        # чей прирост изменился); циклов с положительным приростом нет
+        parent = [-1] * n_banks
+        queue = deque(b for b in range(n_banks) if gain[b] != -INF)
+        queued = [gain[b] != -INF for b in range(n_banks)]
+        while queue:
+            a = queue.popleft()
+            queued[a] = False
+            for c in range(n_banks):
+                step = move[a][c][0]
+                if step != -INF and gain[a] + step > gain[c] + 1e-12:
+                    gain[c] = gain[a] + step
+                    parent[c] = a
+                    if not queued[c]:
+                        queued[c] = True
+                        queue.append(c)
+
+        best_gain, target = 0.0, -1
+        for b in range(n_banks):
+            if len(members[b]) < capacities[b] and gain[b] > best_gain + 1e-12:
+                best_gain, target = gain[b], b
+        if target < 0:
+            break
+
+        # Применяем путь с конца: в target переносится категория из parent[target] и т.д.
+        c = target
+        while parent[c] >= 0:
+            a = parent[c]
+            i = move[a][c][1]
+            members[a].remove(i)
+            members[c].append(i)
+            assignment[i] = c
+            shrunk_banks.add(a)
+            added.setdefault(c, []).append(i)
+            c = a
+        i = enter[c]
+        members[c].append(i)
+        assignment[i] = c
+        added.setdefault(c, []).append(i)
+
+    total = sum(values[i][b] for i, b in enumerate(assignment) if b >= 0)
+    return total, assignment
+
+
+def _candidate_values(values: List[List[float]], capacities: List[int], groups: List[int]) -> List[List[float]]:
+    """
+    Обнуляет заведомо ненужные варианты: банк b выбирает только из своих
+    capacities[b] + (ёмкость остальных банков) лучших категорий —
+    иначе среди них найдётся свободная категория не хуже, и замена не уменьшит кешбек.
+    """
+    n_items = len(values)
+    group_capacity: Dict[int, int] = {}
+    for b, group in enumerate(groups):
+        group_capacity[group] = max(group_capacity.get(group, 0), capacities[b])
+    result = [row[:] for row in values]
+    for b, capacity in enumerate(capacities):
+        keep = capacity + sum(c for group, c in group_capacity.items() if group != groups[b])
+        if keep >= n_items:
+            continue
+        ranked = sorted(range(n_items), key=lambda i: -values[i][b])
+        for i in ranked[keep:]:
+            result[i][b] = 0.0
+    return result
+
+
+def _limited_value(values: List[List[float]], assignment: List[int], limits: List[float]) -> float:
+    """Кешбек назначения с учётом limits."""
+    totals = [0.0] * len(limits)
+    for i, bank in enumerate(assignment):
+        if bank >= 0:
+            totals[bank] += values[i][bank]
+    return sum(min(limit, total) for limit, total in zip(limits, totals))
+
+
+def _lagrangian_bound(values: List[List[float]], capacities: List[int], limits: List[float],
+                      assignment: List[int], bound: float, target: float, iterations: int) -> float:
+    """
+    Верхняя оценка задачи с лимитами: min(L, S) <= (1 - λ) * S + λ * L для λ из [0, 1], поэтому
+    max_weight_assignment по values[i][b] * (1 - λ[b]) плюс сумма λ[b] * limits[b] не меньше оптимума.
+    λ подбирается субградиентом: растёт у банков, которые в назначении превышают лимит, и падает у остальных.
+
+    :param assignment: Решение max_weight_assignment без лимитов (оценка при λ = 0 равна bound)
+    :param target: Значение, ниже которого оценку опускать незачем (лучшее известное решение)
+    """
+    n_banks = len(capacities)
+    finite = [limit != INF for limit in limits]
+    multipliers = [0.0] * n_banks
+    factor = 1.0
+    for _ in range(iterations):
+        if bound <= target + 1e-9:
+            break
+        totals = [0.0] * n_banks
+        for i, b in enumerate(assignment):
+            if b >= 0:
+                totals[b] += values[i][b]
+        excess = [totals[b] - limits[b] if finite[b] else 0.0 for b in range(n_banks)]
+        # Субградиент с шагом Поляка: направлен на уменьшение оценки до target; шаг, не улучшивший оценку, уменьшается
+        norm = sum(e * e for b, e in enumerate(excess) if e > 0 or multipliers[b] > 0)
+        if norm <= 1e-12:
+            break
+        step = factor * (bound - target) / norm
+        multipliers = [min(1.0, max(0.0, multipliers[b] + step * excess[b])) for b in range(n_banks)]
+        scaled = [[value * (1 - multipliers[b]) for b, value in enumerate(row)] for row in values]
+        relaxed, assignment = max_weight_assignment(scaled, capacities)
+        value = relaxed + sum(m * limit for m, limit, f in zip(multipliers, limits, finite) if f)
+        if value < bound - 1e-9:
+            bound = value
+        else:
+            factor /= 2
+    return bound
+
+
+def solve_assignment(values: List[List[float]], capacities: List[int], limits: List[float],
+                     groups: Optional[List[int]] = None, max_nodes: int = MAX_SEARCH_NODES,
+                     lower_bound: float = 0.0, stop_at: Optional[float] = None) -> Tuple[float, List[int], bool]:
+    """
+    Назначает каждую категорию не более чем одному банку.
+
+    Ценность банка — min(limits[b], сумма values[i][b] по назначенным категориям),
+    в банк можно назначить не более capacities[b] категорий.
+
+    Сначала решается задача без лимитов и групп (max_weight_assignment) — это верхняя оценка;
+    если её решение допустимо и укладывается в лимиты, оно оптимально. Иначе — ветви и границы.
+
+    :param values: values[i][b] — кешбек категории i в банке b (0 — категория банку недоступна)
+    :param groups: Взаимоисключающие варианты: из банков с одинаковой группой категории получает только один
+    :param lower_bound: Уже известное значение: решения не лучше него не ищутся
+    :param stop_at: Момент time.monotonic(), после которого перебор останавливается (None — без ограничения)
+    :return: (суммарный кешбек, банк для каждой категории или -1, найден ли точный оптимум)
+    """
+    n_banks = len(capacities)
+    groups = list(range(n_banks)) if groups is None else groups
+    rivals = [[other for other in range(n_banks) if other != b and groups[other] == groups[b]] for b in range(n_banks)]
+
+    values = _candidate_values(values, capacities, groups)
+
+    relaxed_value, relaxed = max_weight_assignment(values, capacities)
+    active: Dict[int, int] = {}
+    relaxed_feasible = all(active.setdefault(groups[b], b) == b for b in relaxed if b >= 0)
+    relaxed_limited = _limited_value(values, relaxed, limits) if relaxed_feasible else 0.0
+    if relaxed_feasible and relaxed_limited >= relaxed_value - 1e-9:
+        return relaxed_limited, relaxed, True
+    if relaxed_value <= lower_bound + 1e-9:
+        # Даже без лимитов не лучше уже известного решения
+        return relaxed_limited, relaxed if relaxed_feasible else [-1] * len(values), True
+    relaxed_value = _lagrangian_bound(values, capacities, limits, relaxed, relaxed_value,
+                                      max(lower_bound, relaxed_limited), LAGRANGIAN_ITERATIONS)
+    if relaxed_value <= lower_bound + 1e-9:
+        return relaxed_limited, relaxed if relaxed_feasible else [-1] * len(values), True
+
+    # Перебираем категории от самых выгодных: хорошее решение находится рано и сильнее отсекает
+    order = sorted((i for i in range(len(values)) if max(values[i], default=0.0) > 0),
+                   key=lambda i: -max(values[i]))
+    items = [values[i] for i in order]
+    n = len(items)
+    matrix = np.array(items, dtype=float).reshape(n, n_banks)
+    limit_array = np.array(limits, dtype=float)
+
+    # suffix_best[i] — кешбек категорий i.. при выборе лучшего банка для каждой
+    suffix_best = [0.0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        suffix_best[i] = suffix_best[i + 1] + max(items[i])
+
+    # top_sums[b, i, r] — сумма r лучших значений банка b среди категорий i.. (r не больше ёмкости банка)
+    width = min(max(capacities, default=0), n) + 1
+    top_sums = np.zeros((n_banks, n + 1, width))
+    for b in range(n_banks):
+        current: List[float] = []
+        for i in range(n - 1, -1, -1):
+            if items[i][b] > 0:
+                current = sorted(current + [items[i][b]], reverse=True)[:width - 1]
+            sums = list(itertools.accumulate(current, initial=0.0))
+            top_sums[b, i] = sums + [sums[-1]] * (width - len(sums))
+
+    capacity_array = np.array(capacities)
+    group_index = np.unique(groups, return_inverse=True)[1]
+    n_groups = int(group_index.max()) + 1 if n_banks else 0
+    bank_range = np.arange(n_banks)
+
+    def upper_bound(i, used, acc):
+        if i == n:
+            return 0.0
+        used_array = np.array(used)
+        room = limit_array - np.array(acc)
+        slots = capacity_array - used_array
+        # Из группы вариантов остаётся выбранный, а если ни один не выбран — любой
+        active = np.zeros(n_groups, dtype=bool)
+        active[group_index[used_array > 0]] = True
+        open_banks = (~active[group_index] | (used_array > 0)) & (room > 0) & (slots > 0)
+        if not open_banks.any():
+            return 0.0
+        headroom = np.where(open_banks, np.minimum(room, top_sums[bank_range, i, np.minimum(slots, width - 1)]), 0.0)
+        group_headroom = np.zeros(n_groups)
+        np.maximum.at(group_headroom, group_index, headroom)
+        group_slots = np.zeros(n_groups, dtype=int)
+        np.maximum.at(group_slots, group_index, np.where(open_banks, slots, 0))
+        # Категория даёт не больше, чем в лучшем из открытых банков (и не больше его запаса до лимита),
+        # а назначить можно не больше слотов открытых групп — одна категория не учитывается в нескольких банках
+        rest = np.minimum(matrix[i:, open_banks], room[open_banks]).max(axis=1)
+        total_slots = int(group_slots.sum())
+        if total_slots < len(rest):
+            rest = np.partition(rest, len(rest) - total_slots)[len(rest) - total_slots:]
+        return min(suffix_best[i], float(group_headroom.sum()), float(rest.sum()))
+
+    def eligible(b, row, used, acc):
+        return (row[b] > 0 and used[b] < capacities[b] and acc[b] < limits[b]
+                and not any(used[other] for other in rivals[b]))
+
+    # Начальное решение — жадное назначение в банк с наибольшим приростом (или решение без лимитов)
+    used = [0] * n_banks
+    acc = [0.0] * n_banks
+    greedy = [-1] * n
+    for i, row in enumerate(items):
+        best_gain, best_bank = 0.0, -1
+        for b in range(n_banks):
+            if eligible(b, row, used, acc):
+                gain = min(limits[b], acc[b] + row[b]) - acc[b]
+                if gain > best_gain:
+                    best_gain, best_bank = gain, b
+        if best_bank >= 0:
+            greedy[i] = best_bank
+            used[best_bank] += 1
+            acc[best_bank] += row[best_bank]
+
+    best = {"value": max(sum(min(limits[b], acc[b]) for b in range(n_banks)), lower_bound), "assignment": greedy}
+    if relaxed_limited > best["value"] + 1e-9:
+        best = {"value": relaxed_limited, "assignment": [relaxed[i] for i in order]}
+    nodes = 0
+    exact = True
+    # (i, занятые слоты) -> накопленный кешбек банков в уже просмотренных состояниях
+    seen: Dict[tuple, List[Tuple[float, ...]]] = {}
+    path = [-1] * n
+
+    def search(i, used, acc, value):
+        nonlocal nodes, exact
+        if not exact:
+            return
+        if value > best["value"] + 1e-9:
+            best["value"] = value
+            best["assignment"] = path[:i] + [-1] * (n - i)
+        if i == n or value + upper_bound(i, used, acc) <= best["value"] + 1e-9:
+            return
+        # Достигнута оценка без лимитов — лучше не будет
+        if best["value"] >= relaxed_value - 1e-9:
+            return
+        nodes += 1
+        if nodes > max_nodes or (stop_at is not None and nodes % 64 == 0 and time.monotonic() > stop_at):
+            exact = False
+            return
+
+        # При тех же занятых слотах состояние с не меньшим кешбеком в каждом банке не хуже:
+        # запас до лимита меньше ровно настолько, насколько больше уже набранный кешбек
+        states = seen.setdefault((i, tuple(used)), [])
+        current = tuple(min(acc[b], limits[b]) for b in range(n_banks))
+        if any(all(a >= c - 1e-9 for a, c in zip(state, current)) for state in states):
+            return
+        if len(states) < MAX_STATES_PER_KEY:
+            states.append(current)
+
+        row = items[i]
+        options = sorted(
+            (-(min(limits[b], acc[b] + row[b]) - acc[b]), b) for b in range(n_banks) if eligible(b, row, used, acc)
+        )
+        for gain, b in options:
+            path[i] = b
+            used[b] += 1
+            acc[b] += row[b]
+            search(i + 1, used, acc, value - gain)
+            used[b] -= 1
+            acc[b] -= row[b]
+        path[i] = -1
+        # Пропускать категорию бессмысленно, если её можно отдать уже выбранному варианту банка,
+        # где места хватит на все оставшиеся
+        if not any(capacities[b] - used[b] >= n - i and (used[b] or not rivals[b]) for _, b in options):
+            search(i + 1, used, acc, value)
+
+    search(0, [0] * n_banks, [0.0] * n_banks, 0.0)
+
+    assignment = [-1] * len(values)
+    for position, bank in enumerate(best["assignment"]):
+        assignment[order[position]] = bank
+    return _limited_value(values, assignment, limits), assignment, exact
+
+
+def _option_arrays(options: List[Tuple[BankTerms, bool]], terms: List[BankTerms], spend: Dict[str, float],
+                   categories: List[str]):
+    """Ёмкости, лимиты, группы и кешбек по категориям для вариантов банков (условия, режим "all")."""
+    capacities, limits, groups = [], [], []
+    for t, use_all in options:
+        groups.append(terms.index(t))
+        if use_all:
+            capacities.append(len(categories))
+            limits.append(min(t.all_rule[2], t.bank_limit))
+        else:
+            capacities.append(min(t.max_categories, len(t.rules)))
+            limits.append(t.bank_limit)
+
+    values = []
+    for category in categories:
+        row = []
+        for t, use_all in options:
+            if use_all:
+                row.append(spend[category] * t.all_rule[1] / 100)
+            elif category in t.rules:
+                percent, category_limit = t.rules[category]
+                row.append(min(spend[category] * percent / 100, category_limit))
+            else:
+                row.append(0.0)
+        values.append(row)
+    return capacities, limits, groups, values
+
+
+def joint_assignment(spend: Dict[str, float], terms: List[BankTerms],
+                     max_nodes: int = MAX_SEARCH_NODES, max_seconds: float = MAX_SEARCH_SECONDS) -> JointSolution:
+    """
+    Совместный выбор категорий по всем банкам.
+
+    Банк с категорией "all" либо выбирает только её и получает траты всех отнесённых к нему категорий
+    (с общим лимитом min(category_limit, bank_limit)), либо выбирает обычные категории.
+    Режимы таких банков фиксируются ветвлением: оценка — решение без лимитов, в котором оба режима доступны;
+    если в нём банк использует оба режима, перебираются оба варианта.
+
+    :param spend: category -> прогноз трат
+    :param terms: Условия банков (catalog_terms)
+    :param max_seconds: Предел времени перебора (внутри deadline.budget — не дольше остатка бюджета)
+    """
+    categories = [category for category, amount in spend.items() if amount > 0]
+    left = deadline.remaining()
+    stop_at = time.monotonic() + (max_seconds if left is None else min(max_seconds, left))
+
+    best_value, best_options, best_assignment, best_values = -1.0, [], [], []
+    exact = True
+    # Зафиксированные режимы: bank -> режим "all"; обычный режим проверяется первым и выигрывает при равенстве
+    stack: List[Dict[str, bool]] = [{}]
+    while stack:
+        if best_options and time.monotonic() > stop_at:
+            # Время вышло: остальные режимы банков не проверяются
+            exact = False
+            break
+        fixed = stack.pop()
+        options = [
+            (t, use_all) for t in terms for use_all in (False, True)
+            if (not use_all or t.all_rule is not None) and fixed.get(t.name, use_all) == use_all
+        ]
+        capacities, limits, groups, values = _option_arrays(options, terms, spend, categories)
+
+        relaxed_value, relaxed = max_weight_assignment(values, capacities)
+        if relaxed_value <= best_value + 1e-9:
+            continue
+        used = {}
+        conflict = None
+        for b in relaxed:
+            if b >= 0 and used.setdefault(groups[b], b) != b:
+                conflict = options[b][0]
+                break
+        if conflict is not None:
+            stack.append({**fixed, conflict.name: True})
+            stack.append({**fixed, conflict.name: False})
+            continue
+
+        value, assignment, solved_exactly = solve_assignment(values, capacities, limits, groups, max_nodes,
+                                                             max(best_value, 0.0), stop_at)
+        exact = exact and solved_exactly
+        if value > best_value + 1e-9:
+            best_value, best_options, best_assignment, best_values = value, options, assignment, values
+
+    if not exact:
+        print(f"⚠️ Перебор категорий остановлен по лимиту ({max_nodes} узлов, {max_seconds} с), "
+              f"решение может быть неоптимальным")
+
+    rows = []
+    assigned = {}
+    all_banks = set()
+    for b, (t, use_all) in enumerate(best_options):
+        chosen = [i for i, bank in enumerate(best_assignment) if bank == b]
+        if not chosen:
+            continue
+        for i in chosen:
+            assigned[categories[i]] = t.name
+        if use_all:
+            all_banks.add(t.name)
+            rows.append({'bank': t.name, 'category': t.all_rule[0],
+                         'total_cb': min(sum(best_values[i][b] for i in chosen), min(t.all_rule[2], t.bank_limit))})
+        else:
+            rows.extend({'bank': t.name, 'category': categories[i], 'total_cb': best_values[i][b]}
+                        for i in sorted(chosen, key=lambda i: -best_values[i][b]))
+    return JointSolution(max(best_value, 0.0), rows, assigned, exact, all_banks)
+
+
+def joint_best_cashback(prediction_df: pd.DataFrame, cashback_df: pd.DataFrame,
+                        max_nodes: int = MAX_SEARCH_NODES) -> pd.DataFrame:
+    """
+    Аналог choose_best_cashback, в котором траты каждой категории уходят в одну карту.
+
+    В банк попадает меньше max_categories_in_bank категорий, если остальные не добавляют кешбека
+    (их траты уже отнесены к другим картам или упёрлись в bank_limit).
+    """
+    return joint_assignment(prediction_spend(prediction_df), catalog_terms(cashback_df), max_nodes).to_dataframe()
+
+
+class SplitSolution:
+    """Выбор категорий вместе с рекомендуемым распределением трат по картам."""
+
+    def __init__(self, value: float, rows: List[dict], split: List[dict]):
+        # Суммарный кешбек с учётом всех лимитов
+        self.value = value
+        # Выбранные категории: bank, category, total_cb, recommended_spend
+        self.rows = rows
+        # Распределение трат: bank, category, amount, cashback (для карты с "all" — по каждой категории)
+        self.split = split
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.rows, columns=['bank', 'category', 'total_cb', 'recommended_spend'])
+
+    def split_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.split, columns=['bank', 'category', 'amount', 'cashback'])
+
+
+def _max_linear(objective: List[float], rows: List[List[float]], bounds: List[float],
+                max_iterations: int = 10_000) -> Tuple[List[float], Optional[List[float]]]:
+    """
+    Максимум objective · x при rows · x <= bounds, x >= 0 (bounds >= 0) — симплекс-метод по таблице
+    с правилом Бланда (без зацикливания на вырожденных вершинах). Задачи распределения трат маленькие:
+    десятки переменных и ограничений.
+
+    :return: (x, двойственные цены ограничений или None, если симплекс не сошёлся)
+    """
+    n_rows, n_vars = len(rows), len(objective)
+    tableau = np.zeros((n_rows + 1, n_vars + n_rows + 1))
+    if n_rows:
+        tableau[:n_rows, :n_vars] = rows
+        tableau[:n_rows, n_vars:n_vars + n_rows] = np.eye(n_rows)
+        tableau[:n_rows, -1] = bounds
+    tableau[n_rows, :n_vars] = -np.asarray(objective, dtype=float)
+    basis = list(range(n_vars, n_vars + n_rows))
+
+    converged = False
+    for _ in range(max_iterations):
+        entering = np.flatnonzero(tableau[n_rows, :-1] < -1e-12)
+        if not len(entering):
+            converged = True
+            break
+        col = entering[0]
+        column = tableau[:n_rows, col]
+        positive = np.flatnonzero(column > 1e-12)
+        if not len(positive):
+            raise ValueError("Задача распределения трат не ограничена")
+        ratios = tableau[positive, -1] / column[positive]
+        tied = positive[ratios <= ratios.min() + 1e-9]
+        row = min(tied, key=lambda r: basis[r])
+
+        tableau[row] /= tableau[row, col]
+        factors = tableau[:, col].copy()
+        factors[row] = 0.0
+        tableau -= np.outer(factors, tableau[row])
+        basis[row] = col
+    else:
+        print(f"⚠️ Распределение трат не сошлось за {max_iterations} итераций")
+
+    solution = [0.0] * n_vars
+    for row, var in enumerate(basis):
+        if var < n_vars:
+            solution[var] = max(0.0, float(tableau[row, -1]))
+    # В оптимальной таблице под дополнительными переменными стоят двойственные цены ограничений
+    duals = [max(0.0, float(price)) for price in tableau[n_rows, n_vars:n_vars + n_rows]] if converged else None
+    return solution, duals
+
+
+def _category_segments(category: str, selection: Dict[str, List[str]], all_banks: Iterable[str],
+                       terms: Dict[str, BankTerms]) -> List[Tuple[str, float, float]]:
+    """Карты, на которые можно нести траты категории: (bank, percent, точка излома category_limit * 100 / percent)."""
+    segments = []
+    for bank, categories in selection.items():
+        if category in categories:
+            percent, category_limit = terms[bank].rules[category]
+            if percent > 0:
+                segments.append((bank, percent, category_limit * 100 / percent))
+    for bank in sorted(all_banks):
+        percent = terms[bank].all_rule[1]
+        if percent > 0:
+            segments.append((bank, percent, INF))
+    return segments
+
+
+def _fill_by_rate(amount: float, segments: List[Tuple[str, float, float]]) -> Tuple[List[Tuple[str, float, float]], float]:
+    """
+    Траты одной категории без учёта bank_limit: на карты по убыванию процента, на каждую — до её точки излома.
+
+    :return: ([(bank, сумма трат, кешбек)], кешбек с последнего рубля трат категории — 0, если траты не поместились)
+    """
+    entries = []
+    rate = 0.0
+    for bank, percent, breakpoint in sorted(segments, key=lambda segment: -segment[1]):
+        if amount <= 0:
+            break
+        part = min(amount, breakpoint)
+        if part > 0:
+            entries.append((bank, part, part * percent / 100))
+            amount -= part
+            rate = percent / 100
+    return entries, rate if amount <= 0 else 0.0
+
+
+def _bank_room(bank: str, all_banks: Iterable[str], terms: Dict[str, BankTerms]) -> float:
+    t = terms[bank]
+    return min(t.bank_limit, t.all_rule[2]) if bank in all_banks else t.bank_limit
+
+
+# Двойственные цены распределения: (category -> цена рубля трат категории, bank -> цена рубля кешбека карты)
+Prices = Tuple[Dict[str, float], Dict[str, float]]
+
+
+def _allocate(spend: Dict[str, float], selection: Dict[str, List[str]], all_banks: Iterable[str],
+              terms: Dict[str, BankTerms]) -> Tuple[float, Dict[Tuple[str, str], Tuple[float, float]], bool, Optional[Prices]]:
+    """
+    allocate_spend, дополнительно возвращающий, упёрлось ли распределение в bank_limit (решалось линейное
+    программирование), и двойственные цены (None, если симплекс не сошёлся).
+    """
+    remaining = {category: amount for category, amount in spend.items() if amount > 0}
+    by_category = {category: _category_segments(category, selection, all_banks, terms) for category in remaining}
+
+    # Без bank_limit задача распадается по категориям, и заполнение по проценту оптимально;
+    # если при нём ни одна карта не выходит за лимит, это и есть ответ
+    allocation: Dict[Tuple[str, str], Tuple[float, float]] = {}
+    totals: Dict[str, float] = {}
+    category_prices: Dict[str, float] = {}
+    for category, segments in by_category.items():
+        entries, category_prices[category] = _fill_by_rate(remaining[category], segments)
+        for bank, amount, cashback in entries:
+            allocation[(bank, category)] = (amount, cashback)
+            totals[bank] = totals.get(bank, 0.0) + cashback
+    if all(total <= _bank_room(bank, all_banks, terms) + 1e-9 for bank, total in totals.items()):
+        return sum(totals.values()), allocation, False, (category_prices, {})
+
+    # Переменные: (bank, category, percent, точка излома)
+    segments = [(bank, category, percent, breakpoint)
+                for category, options in by_category.items() for bank, percent, breakpoint in options]
+    rows, bounds, keys = [], [], []
+
+    def constraint(key, coefficients: Dict[int, float], bound: float):
+        if bound == INF:
+            return
+        row = [0.0] * len(segments)
+        for index, coefficient in coefficients.items():
+            row[index] = coefficient
+        rows.append(row)
+        bounds.append(max(0.0, bound))
+        keys.append(key)
+
+    for category, amount in remaining.items():
+        constraint(('category', category), {i: 1.0 for i, segment in enumerate(segments) if segment[1] == category}, amount)
+    for bank in {segment[0] for segment in segments}:
+        constraint(('bank', bank), {i: segment[2] / 100 for i, segment in enumerate(segments) if segment[0] == bank},
+                   _bank_room(bank, all_banks, terms))
+    for i, (_, category, _, breakpoint) in enumerate(segments):
+        if breakpoint < remaining[category]:
+            constraint(('segment', i), {i: 1.0}, breakpoint)
+
+    amounts, duals = _max_linear([segment[2] / 100 for segment in segments], rows, bounds)
+
+    allocation = {}
+    total = 0.0
+    for (bank, category, percent, _), amount in zip(segments, amounts):
+        # Остатки округления симплекса — не рекомендация тратить копейки
+        if amount <= 1e-6:
+            continue
+        cashback = amount * percent / 100
+        total += cashback
+        allocation[(bank, category)] = (amount, cashback)
+    prices = None
+    if duals is not None:
+        prices = ({name: price for (kind, name), price in zip(keys, duals) if kind == 'category'},
+                  {name: price for (kind, name), price in zip(keys, duals) if kind == 'bank'})
+    return total, allocation, True, prices
+
+
+def allocate_spend(spend: Dict[str, float], selection: Dict[str, List[str]], all_banks: Iterable[str],
+                   terms: Dict[str, BankTerms]) -> Tuple[float, Dict[Tuple[str, str], Tuple[float, float]]]:
+    """
+    Распределяет прогноз трат по выбранным картам с максимальным кешбеком.
+
+    Траты x категории на карте дают x * percent / 100 кешбека, пока x не дошло до точки излома
+    category_limit * 100 / percent. Ограничения: траты категории по всем картам — не больше прогноза,
+    кешбек карты — не больше bank_limit (для "all" — ещё и её category_limit).
+    Сначала траты каждой категории раскладываются по картам в порядке убывания процента (_fill_by_rate) —
+    без bank_limit это оптимум. Если при этом какая-то карта выходит за лимит, решается задача линейного
+    программирования (_max_linear): жадный обход по проценту не оптимален, когда карту с большим процентом
+    ограничивает bank_limit.
+
+    :param selection: bank -> выбранные обычные категории
+    :param all_banks: Банки, в которых выбрана категория "all" (на них можно нести траты любой категории)
+    :return: (кешбек, (bank, category) -> (сумма трат, кешбек)); пары без трат не попадают
+    """
+    total, allocation, _, _ = _allocate(spend, selection, all_banks, terms)
+    return total, allocation
+
+
+def _with_category(spend: Dict[str, float], selection: Dict[str, List[str]], all_banks: Iterable[str],
+                   terms: Dict[str, BankTerms], allocation: Dict[Tuple[str, str], Tuple[float, float]],
+                   totals: Dict[str, float], category: str):
+    """
+    Распределение после добавления категории в selection, если предыдущее найдено без упора в bank_limit:
+    меняются только траты этой категории, остальные уже разложены оптимально.
+
+    :param totals: bank -> кешбек карты в allocation
+    :return: (прирост кешбека, распределение, новая цена трат категории) или None, если новая раскладка
+             выходит за bank_limit
+    """
+    entries, rate = _fill_by_rate(spend[category], _category_segments(category, selection, all_banks, terms))
+    new_totals = dict(totals)
+    gain = 0.0
+    for (bank, other), (_, cashback) in allocation.items():
+        if other == category:
+            new_totals[bank] -= cashback
+            gain -= cashback
+    for bank, _, cashback in entries:
+        new_totals[bank] = new_totals.get(bank, 0.0) + cashback
+        gain += cashback
+    if any(total > _bank_room(bank, all_banks, terms) + 1e-9 for bank, total in new_totals.items()):
+        return None
+    new_allocation = {key: item for key, item in allocation.items() if key[1] != category}
+    new_allocation.update({(bank, category): (amount, cashback) for bank, amount, cashback in entries})
+    return gain, new_allocation, rate
+
+
+def split_assignment(spend: Dict[str, float], terms: List[BankTerms],
+                     max_nodes: int = MAX_SEARCH_NODES) -> SplitSolution:
+    """
+    Выбор категорий с переносом трат сверх лимитов на следующую карту.
+
+    Начальный выбор — joint_assignment. Затем свободные слоты банков жадно заполняются категориями
+    (невыбранный банк с "all" может выбрать её): на каждом шаге добавляется кандидат с наибольшим
+    приростом кешбека после перераспределения трат — например, карта с большим процентом,
+    но маленьким category_limit, берёт траты до своего лимита, а остаток уходит на следующую карту.
+    Пока ни одна карта не упирается в bank_limit, прирост от новой категории считается по одной этой
+    категории (_with_category), иначе — полным пересчётом allocate_spend. Кандидаты перебираются
+    по убыванию оценки прироста сверху из двойственных цен текущего распределения.
+    Распределение точное, а назначение joint_assignment — одно из допустимых распределений,
+    поэтому результат не хуже режима 'joint'.
+
+    :param spend: category -> прогноз трат
+    """
+    by_name = {t.name: t for t in terms}
+    joint = joint_assignment(spend, terms, max_nodes)
+
+    selection: Dict[str, List[str]] = {t.name: [] for t in terms}
+    for category, bank in joint.assignment.items():
+        if bank not in joint.all_banks:
+            selection[bank].append(category)
+    all_banks = set(joint.all_banks)
+    value, allocation, limited, prices = _allocate(spend, selection, all_banks, by_name)
+
+    while True:
+        # Оценка прироста сверху: новая карта не даст больше своего кешбека, а по двойственным ценам
+        # текущего распределения (category_price, bank_price) рубль трат на ней прибавляет не больше
+        # percent / 100 * (1 - bank_price) - category_price
+        # (даже насыщенный по bank_limit банк может выиграть, отдав часть трат другим картам)
+        category_prices, bank_prices = prices if prices is not None else ({}, {})
+        candidates = []
+        for t in terms:
+            if t.name in all_banks:
+                continue
+            if not selection[t.name] and t.all_rule is not None:
+                percent = t.all_rule[1]
+                estimate = min(sum(amount for amount in spend.values() if amount > 0) * percent / 100,
+                               t.all_rule[2], t.bank_limit)
+                if prices is not None:
+                    estimate = min(estimate, sum(max(0.0, percent / 100 - category_prices.get(category, 0.0)) * amount
+                                                 for category, amount in spend.items() if amount > 0))
+                candidates.append((estimate, t.name, None))
+            if len(selection[t.name]) >= t.max_categories:
+                continue
+            for category, (percent, category_limit) in t.rules.items():
+                if spend.get(category, 0.0) > 0 and category not in selection[t.name]:
+                    estimate = min(spend[category] * percent / 100, category_limit, t.bank_limit)
+                    if prices is not None and percent > 0:
+                        rate = percent / 100 * (1 - bank_prices.get(t.name, 0.0)) - category_prices.get(category, 0.0)
+                        estimate = min(estimate, max(0.0, rate) * min(spend[category], category_limit * 100 / percent))
+                    candidates.append((estimate, t.name, category))
+        candidates.sort(key=lambda candidate: -candidate[0])
+
+        totals: Dict[str, float] = {}
+        for (bank, _), (_, cashback) in allocation.items():
+            totals[bank] = totals.get(bank, 0.0) + cashback
+
+        # Пересчитываем распределение для кандидатов, пока оценка может превзойти лучший найденный прирост
+        best_gain, best = 1e-9, None
+        for estimate, bank, category in candidates:
+            if estimate <= best_gain:
+                break
+            if category is None:
+                candidate = (selection, all_banks | {bank})
+            else:
+                candidate = ({**selection, bank: selection[bank] + [category]}, all_banks)
+            added = None
+            if category is not None and not limited:
+                added = _with_category(spend, *candidate, by_name, allocation, totals, category)
+            if added is not None:
+                gain, candidate_allocation, rate = added
+                candidate_state = (False, ({**category_prices, category: rate}, {}))
+            else:
+                candidate_value, candidate_allocation, *candidate_state = _allocate(spend, *candidate, by_name)
+                gain = candidate_value - value
+            if gain > best_gain:
+                best_gain, best = gain, (candidate, candidate_allocation, candidate_state)
+        if best is None:
+            break
+        (selection, all_banks), allocation, (limited, prices) = best
+        value += best_gain
+
+    rows, split = _split_rows(spend, terms, selection, all_banks, allocation)
+    return SplitSolution(value, rows, split)
+
+
+def _split_rows(spend: Dict[str, float], terms: List[BankTerms], selection: Dict[str, List[str]],
+                all_banks: Iterable[str], allocation: Dict[Tuple[str, str], Tuple[float, float]]) -> Tuple[List[dict], List[dict]]:
+    """Строки выбора (bank, category, total_cb, recommended_spend) и распределения трат по результату allocate_spend."""
+    # Выбранные категории, на которые не пришлось трат, не рекомендуются
+    rows = []
+    split = []
+    for t in terms:
+        if t.name in all_banks:
+            entries = [(category, *allocation[(t.name, category)]) for category in spend if (t.name, category) in allocation]
+            if not entries:
+                continue
+            split.extend({'bank': t.name, 'category': category, 'amount': amount, 'cashback': cashback}
+                         for category, amount, cashback in entries)
+            rows.append({'bank': t.name, 'category': t.all_rule[0],
+                         'total_cb': sum(entry[2] for entry in entries),
+                         'recommended_spend': sum(entry[1] for entry in entries)})
+            continue
+        for category in selection[t.name]:
+            if (t.name, category) not in allocation:
+                continue
+            amount, cashback = allocation[(t.name, category)]
+            split.append({'bank': t.name, 'category': category, 'amount': amount, 'cashback': cashback})
+            rows.append({'bank': t.name, 'category': category, 'total_cb': cashback, 'recommended_spend': amount})
+    return rows, split
+
+
+def split_best_cashback(prediction_df: pd.DataFrame, cashback_df: pd.DataFrame,
+                        max_nodes: int = MAX_SEARCH_NODES) -> SplitSolution:
+    """Выбор категорий и распределение трат для одного прогноза (см. split_assignment)."""
+    return split_assignment(prediction_spend(prediction_df), catalog_terms(cashback_df), max_nodes)
+
+
+def selection_from_rows(rows_df: pd.DataFrame, terms: List[BankTerms]) -> Tuple[Dict[str, List[str]], set]:
+    """
+    Выбор категорий из строк результата choose_best_cashback.
+
+    :return: (bank -> выбранные обычные категории в порядке строк, банки с выбранной категорией "all")
+    """
+    by_name = {t.name: t for t in terms}
+    selection: Dict[str, List[str]] = {t.name: [] for t in terms}
+    all_banks = set()
+    for bank, category in zip(rows_df['bank'], rows_df['category']):
+        t = by_name.get(bank)
+        if t is None:
+            continue
+        if t.all_rule is not None and category == t.all_rule[0]:
+            all_banks.add(bank)
+        elif category in t.rules and category not in selection[bank]:
+            selection[bank].append(category)
+    return selection, all_banks
+
+
+def joint_selection_cashback(rows_df: pd.DataFrame, prediction_df: pd.DataFrame,
+                             cashback_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Кешбек уже сделанного совместного выбора (строки joint_best_cashback) для другого прогноза трат.
+
+    Выбор не пересматривается: обычная категория остаётся в своём банке, остальные траты уходят на карту
+    с "all" с наибольшим процентом. Суммы считаются так же, как в joint_assignment.
+    """
+    terms = catalog_terms(cashback_df)
+    by_name = {t.name: t for t in terms}
+    spend = prediction_spend(prediction_df)
+    selection, all_banks = selection_from_rows(rows_df, terms)
+    chosen = {category for categories in selection.values() for category in categories}
+
+    all_totals: Dict[str, List[float]] = {bank: [] for bank in all_banks}
+    for category, amount in spend.items():
+        if amount > 0 and category not in chosen and all_banks:
+            bank = max(sorted(all_banks), key=lambda name: by_name[name].all_rule[1])
+            all_totals[bank].append(amount * by_name[bank].all_rule[1] / 100)
+
+    rows = []
+    for t in terms:
+        if t.name in all_banks:
+            if all_totals[t.name]:
+                rows.append({'bank': t.name, 'category': t.all_rule[0],
+                             'total_cb': min(sum(all_totals[t.name]), t.all_rule[2], t.bank_limit)})
+            continue
+        values = [
+            (category, min(spend[category] * t.rules[category][0] / 100, t.rules[category][1]))
+            for category in selection[t.name] if spend.get(category, 0.0) > 0
+        ]
+        rows.extend({'bank': t.name, 'category': category, 'total_cb': value}
+                    for category, value in sorted(values, key=lambda item: -item[1]))
+    return pd.DataFrame(rows, columns=['bank', 'category', 'total_cb'])
+
+
+def split_selection_cashback(rows_df: pd.DataFrame, prediction_df: pd.DataFrame,
+                             cashback_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Распределение трат другого прогноза по уже сделанному выбору (строки split_best_cashback):
+    выбор не пересматривается, траты распределяются точно (allocate_spend).
+    """
+    terms = catalog_terms(cashback_df)
+    spend = prediction_spend(prediction_df)
+    selection, all_banks = selection_from_rows(rows_df, terms)
+    value, allocation = allocate_spend(spend, selection, all_banks, {t.name: t for t in terms})
+    rows, split = _split_rows(spend, terms, selection, all_banks, allocation)
+    return SplitSolution(value, rows, split).to_dataframe()
+
+
+def split_best_cashback_batch(predictions: Iterable, cashback_df: pd.DataFrame,
+                              max_nodes: int = MAX_SEARCH_NODES) -> List[SplitSolution]:
+    """
+    split_assignment для многих пользователей с одним каталогом: каталог разбирается один раз.
+
+    :param predictions: Прогнозы — DataFrame (category, predicted_amount) или словари category -> сумма
+    """
+    terms = catalog_terms(cashback_df)
+    return [
+        split_assignment(prediction if isinstance(prediction, dict) else prediction_spend(prediction), terms, max_nodes)
+        for prediction in predictions
+    ]
@@ -10,8 +10,8 @@ def extract_columns_from_excel(file_path):
     :param file_path: путь к Excel-файлу
     :return: список словарей с ключами 'bank', 'category', 'percent'
     """
-    # Читаем Excel-файл
-    df = pd.read_excel(file_path)
+    # Читаем Excel-файл (повторные чтения — из кеша, пока файл не изменился)
+    df = read_cashbacks_excel(file_path)
 
     # Выбираем только нужные столбцы
     selected_columns = df[['bank', 'category', 'percent']]
@@ -29,9 +29,9 @@ def process_dataframe_and_rules(df, rules_list):
 
     Сравнение bank и category — без учёта регистра и пробелов по краям.
 
-    :param df: pandas DataFrame с колонками 'bank', 'category', 'total_cb'
+    :param df: pandas DataFrame с колонками 'bank', 'category', 'total_cb' (и, возможно, 'recommended_spend')
     :param rules_list: список словарей с ключами 'bank', 'category', 'percent'
-    :return: JSON-строка с результатом
+    :return: JSON-строка с результатом (recommended_spend — если есть в df)
     """
     # Создаём копию и нормализуем столбцы 'bank' и 'category'
     df_norm = df.copy()
@@ -40,9 +40,13 @@ def process_dataframe_and_rules(df, rules_list):
 
     # Создаём словарь для быстрого поиска: (bank_norm, category_norm) -> total_cb
     cb_map = {}
+    spend_map = {}
+    with_spend = 'recommended_spend' in df_norm.columns
     for _, row in df_norm.iterrows():
         key = (row['bank_norm'], row['category_norm'])
         cb_map[key] = row['total_cb']
+        if with_spend:
+            spend_map[key] = row['recommended_spend']
 
     result = []
     for rule in rules_list:
@@ -63,13 +67,16 @@ def process_dataframe_and_rules(df, rules_list):
             choosen = 'no'
             total_cb = None  # будет null в JSON
 
-        result.append({
+        item = {
             'bank_name': orig_bank,
             'category': orig_category,
             'percent': percent,
             'choosen': choosen,
             'total_cb': total_cb
-        })
+        }
+        if with_spend:
+            item['recommended_spend'] = spend_map.get(key)
+        result.append(item)
 
     return json.dumps(result, indent=2, ensure_ascii=False)
 
@@ -0,0 +1,198 @@
+"""
+Фоновое продление согласий до истечения expirationDateTime.
+
+refresh_user_consents кладёт каждое действующее согласие в таблицу consent_schedule
+(next_check_at = срок - CONSENT_RENEW_AHEAD_SECONDS). Планировщик раз в CONSENT_SCHEDULER_INTERVAL секунд
+берёт из начала индекса по next_check_at не больше CONSENT_RENEWALS_PER_TICK записей и продлевает их:
+запрашивает новое согласие и подменяет им старое, только когда новое авторизовано.
+Пока новое ждёт подтверждения, пользователь продолжает работать со старым.
+
+Планировщик запущен в каждом воркере uvicorn, поэтому записи захватываются атомарно: выбор и сдвиг
+next_check_at на CONSENT_CLAIM_LEASE_SECONDS идут одной транзакцией с блокировкой записи, и другой воркер
+возьмёт запись, только если захвативший её не успел обработать её за это время.
+Фоновое продление заканчивается со сроком старого согласия: неподтверждённый запрос передаётся
+в user_banks, и дальше его ведёт refresh_user_consents, как любое ожидающее согласие.
+"""
+import asyncio
+import os
+import time
+from typing import List, Optional, Tuple
+
+import bank_scheduler
+import metrics
+import tracing
+from banks_access import update_expired_tokens
+from preparation import (
+    _ensure_consent_schedule_table,
+    _request_consent,
+    _update_consent_in_db,
+    get_token_for_bank,
+    parse_expiration_datetime,
+    schedule_consent_renewal,
+)
+from VTBAPI_Requests import GetConsentByID, bank_base_url
+
+CONSENT_SCHEDULER_ENABLED = os.environ.get("CONSENT_SCHEDULER_ENABLED", "1") == "1"
+# Период проверки очереди и максимум продлений за один проход (ограничение нагрузки на банки)
+CONSENT_SCHEDULER_INTERVAL = float(os.environ.get("CONSENT_SCHEDULER_INTERVAL", "30"))
+CONSENT_RENEWALS_PER_TICK = int(os.environ.get("CONSENT_RENEWALS_PER_TICK", "10"))
+# Через сколько секунд перепроверять согласие, ожидающее подтверждения
+CONSENT_PENDING_RECHECK_SECONDS = 10 * 60
+# Задержка повтора после ошибки растёт с числом попыток, но не больше часа
+CONSENT_RETRY_BASE_SECONDS = 60
+CONSENT_RETRY_MAX_SECONDS = 3600
+# На сколько секунд захваченная запись скрыта от других воркеров (если захвативший упал — её возьмёт другой)
+CONSENT_CLAIM_LEASE_SECONDS = int(os.environ.get("CONSENT_CLAIM_LEASE_SECONDS", "600"))
+
+DueConsent = Tuple[str, str, str, Optional[str], int, int]
+
+
+def claim_due_consents(limit: int = CONSENT_RENEWALS_PER_TICK, now: Optional[int] = None,
+                       lease: int = CONSENT_CLAIM_LEASE_SECONDS, db_path: str = "users.db") -> List[DueConsent]:
+    """
+    Захватывает согласия, которые пора продлевать, от самых срочных (чтение из начала индекса по next_check_at).
+
+    Захваченным записям next_check_at сдвигается на lease секунд в той же транзакции,
+    поэтому одну запись не обработают два воркера; renew_consent затем переназначает или удаляет её.
+
+    :return: Список (user_name, bank_name, consent_id, pending_request_id, attempts, expires_at)
+    """
+    now = int(time.time()) if now is None else now
+    with metrics.timed_connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        _ensure_consent_schedule_table(cursor)
+        cursor.execute("""
+            SELECT user_name, bank_name, consent_id, pending_request_id, attempts, expires_at
+            FROM consent_schedule
+            WHERE next_check_at <= ?
+            ORDER BY next_check_at
+            LIMIT ?
+        """, (now, limit))
+        rows = cursor.fetchall()
+        cursor.executemany("""
+            UPDATE consent_schedule SET next_check_at = ? WHERE user_name = ? AND bank_name = ?
+        """, [(now + lease, user_name, bank_name) for user_name, bank_name, *_ in rows])
+        conn.commit()
+    return rows
+
+
+def _reschedule(user_name: str, bank_name: str, delay: int, pending_request_id: Optional[str], attempts: int, db_path: str):
+    with metrics.timed_connect(db_path) as conn:
+        conn.execute("""
+            UPDATE consent_schedule SET next_check_at = ?, pending_request_id = ?, attempts = ?
+            WHERE user_name = ? AND bank_name = ?
+        """, (int(time.time()) + delay, pending_request_id, attempts, user_name, bank_name))
+        conn.commit()
+
+
+def _drop(user_name: str, bank_name: str, db_path: str):
+    with metrics.timed_connect(db_path) as conn:
+        conn.execute("DELETE FROM consent_schedule WHERE user_name = ? AND bank_name = ?", (user_name, bank_name))
+        conn.commit()
+
+
+def _is_current(user_name: str, bank_name: str, consent_id: str, db_path: str) -> bool:
+    """Согласие по-прежнему действует у активного банка пользователя."""
+    with metrics.timed_connect(db_path) as conn:
+        row = conn.execute("""
+            SELECT 1 FROM user_banks
+            WHERE user_name = ? AND bank_name = ? AND is_active = 1 AND consent_id = ?
+        """, (user_name, bank_name, consent_id)).fetchone()
+    return row is not None
+
+
+def renew_consent(user_name: str, bank_name: str, consent_id: str, pending_request_id: Optional[str], attempts: int,
+                  expires_at: int, requesting_bank: str = "team089", db_path: str = "users.db",
+                  tokens_db_path: str = "bank_tokens.db") -> str:
+    """
+    Один шаг продления согласия.
+
+    :return: renewed — новое согласие авторизовано и сохранено; pending — ждёт подтверждения;
+             failed — ошибка, повтор позже; dropped — банк отключён или согласие уже сменилось;
+             expired — старое согласие истекло, фоновое продление прекращено
+    """
+    if not _is_current(user_name, bank_name, consent_id, db_path):
+        _drop(user_name, bank_name, db_path)
+        return "dropped"
+
+    if expires_at <= time.time():
+        # Продлевать больше нечего: ожидающий запрос (если есть) становится согласием банка в user_banks,
+        # его подтверждение проверит refresh_user_consents; без запроса новое согласие создаст update_missing_consents
+        if pending_request_id:
+            _update_consent_in_db(user_name, bank_name, pending_request_id, db_path)
+        print(f"⚠️ Согласие {consent_id} для {bank_name} пользователя {user_name} истекло до продления.")
+        _drop(user_name, bank_name, db_path)
+        return "expired"
+
+    retry_delay = min(CONSENT_RETRY_BASE_SECONDS * 2 ** attempts, CONSENT_RETRY_MAX_SECONDS)
+    try:
+        acc_token = get_token_for_bank(bank_name, tokens_db_path)
+        if not acc_token:
+            print(f"⚠️ Не найден access_token для банка {bank_name}. Продление согласия отложено.")
+            _reschedule(user_name, bank_name, retry_delay, pending_request_id, attempts + 1, db_path)
+            return "failed"
+
+        new_id = pending_request_id or _request_consent(user_name, bank_name, acc_token, requesting_bank)
+        if not new_id:
+            _reschedule(user_name, bank_name, retry_delay, None, attempts + 1, db_path)
+            return "failed"
+
+        data = GetConsentByID(
+            consent_id=new_id,
+            x_fapi_interaction_id=requesting_bank,
+            access_token=acc_token,
+            base_url=bank_base_url(bank_name)
+        ).get("data", {})
+        status = data.get("status")
+        actual_consent_id = data.get("consentId")
+        expiration_dt = parse_expiration_datetime(data.get("expirationDateTime"))
+
+        if status == "Authorized" and actual_consent_id and actual_consent_id.startswith("consent-") and expiration_dt:
+            _update_consent_in_db(user_name, bank_name, actual_consent_id, db_path)
+            schedule_consent_renewal(user_name, bank_name, actual_consent_id, expiration_dt, db_path)
+            print(f"✅ Согласие {consent_id} для {bank_name} пользователя {user_name} продлено: {actual_consent_id}")
+            return "renewed"
+
+        if status in ("AwaitingAuthorization", "Pending", "Initiated"):
+            _reschedule(user_name, bank_name, CONSENT_PENDING_RECHECK_SECONDS, new_id, attempts, db_path)
+            return "pending"
+
+        print(f"⚠️ Новое согласие для {bank_name} пользователя {user_name} в статусе '{status}'. Повторим позже.")
+        _reschedule(user_name, bank_name, retry_delay, None, attempts + 1, db_path)
+        return "failed"
+
+    except Exception as e:
+        print(f"❌ Ошибка при продлении согласия {consent_id} для банка {bank_name} пользователя {user_name}: {e}")
+        _reschedule(user_name, bank_name, retry_delay, pending_request_id, attempts + 1, db_path)
+        return "failed"
+
+
+def run_due_renewals(limit: int = CONSENT_RENEWALS_PER_TICK, db_path: str = "users.db",
+                     tokens_db_path: str = "bank_tokens.db") -> int:
+    """
+    Продлевает не больше limit согласий, срок проверки которых наступил.
+
+    :return: Количество обработанных записей очереди
+    """
+    due = claim_due_consents(limit, db_path=db_path)
+    if not due:
+        return 0
+    # Фоновые запросы к банкам уступают пользовательским квоту песочниц
+    with tracing.span("consent_renewals", due=len(due)), bank_scheduler.priority(bank_scheduler.RENEWAL):
+        update_expired_tokens()
+        for user_name, bank_name, consent_id, pending_request_id, attempts, expires_at in due:
+            result = renew_consent(user_name, bank_name, consent_id, pending_request_id, attempts, expires_at,
+                                   db_path=db_path, tokens_db_path=tokens_db_path)
+            metrics.CONSENT_RENEWALS.inc(result=result)
+    return len(due)
+
+
+async def run_scheduler(interval: float = CONSENT_SCHEDULER_INTERVAL):
+    """Фоновая задача API: раз в interval секунд обрабатывает очередь продления в потоке."""
+    while True:
+        try:
+            await asyncio.to_thread(run_due_renewals)
+        except Exception as e:
+            print(f"❌ Ошибка планировщика продления согласий: {e}")
+        await asyncio.sleep(interval)
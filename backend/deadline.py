@@ -0,0 +1,76 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# Момент (time.monotonic), к которому должен завершиться текущий запрос; None — без ограничения.
+# Значение наследуют asyncio.to_thread и tracing.submit, поэтому дедлайн эндпоинта доходит до вызовов банков.
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Бюджет времени запроса исчерпан — вызов к банку не выполняется."""
+
+
+@contextmanager
+def budget(seconds: float):
+    """
+    Ограничивает блок дедлайном через seconds секунд.
+    Вложенный бюджет не может продлить внешний — берётся более ранний дедлайн.
+    """
+    new_deadline = time.monotonic() + max(0.0, seconds)
+    current = _deadline.get()
+    if current is not None:
+        new_deadline = min(current, new_deadline)
+    token = _deadline.set(new_deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def reserve(seconds: float):
+    """Сдвигает текущий дедлайн на seconds раньше — запас времени на работу после блока (например, на расчёт)."""
+    current = _deadline.get()
+    if current is None:
+        yield
+        return
+    token = _deadline.set(current - seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def share(fraction: float):
+    """Отдаёт блоку долю fraction оставшегося бюджета (без дедлайна — ничего не ограничивает)."""
+    left = remaining()
+    if left is None:
+        yield
+        return
+    with budget(left * fraction):
+        yield
+
+
+def remaining() -> Optional[float]:
+    """Сколько секунд осталось до дедлайна (не меньше 0) или None, если дедлайна нет."""
+    current = _deadline.get()
+    if current is None:
+        return None
+    return max(0.0, current - time.monotonic())
+
+
+def timeout(default: float) -> float:
+    """
+    Таймаут для очередного вызова: default, но не дольше остатка бюджета.
+
+    :raises DeadlineExceeded: Если бюджет уже исчерпан
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("Бюджет времени запроса исчерпан")
+    return min(default, left)
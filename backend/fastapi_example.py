@@ -3,70 +3,18 @@ from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
-import sqlite3
-import hashlib
-import os
-from argon2 import PasswordHasher
-
-# --- Database Setup ---
-DB_NAME = "users.db"
-
-def init_db():
-    """Initialize the SQLite database, create the users table, and add a default user if none exist."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    # The 'password' column will store the SHA-256 hash of the user's password
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            login TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL
-        )
-    ''')
-    
-    # Check if any users exist
-    cursor.execute('SELECT COUNT(*) FROM users')
-    user_count = cursor.fetchone()[0]
-    
-    if user_count == 0:
-        # Hash the default password
-        default_login = "testuser"
-        default_password = "testpass" # Change this password before deploying!
-        hashed_password = hash_password(default_password)
-        
-        # Insert the default user
-        cursor.execute('INSERT INTO users (login, password) VALUES (?, ?)', (default_login, hashed_password))
-        print(f"Added default user: {default_login}")
-    
-    conn.commit()
-    conn.close()
-
-def hash_password(password: str) -> str:
-    ph = PasswordHasher()
-    return ph.hash(password)
-
-def verify_user(login: str, password: str) -> bool:
-    """Verify user credentials against the database."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT password FROM users WHERE login = ?', (login,))
-    row = cursor.fetchone()
-
-    if row is None:
-        return False
-    stored_hash = row[0]
-    ph = PasswordHasher()
-    try:
-        return ph.verify(stored_hash, password)
-    except Exception:
-        return False
-
-# Initialize the database on startup
-init_db()
+from contextlib import asynccontextmanager
+import asyncio
+import auth
 
 # --- FastAPI App ---
-app = FastAPI(title="Minimal Login API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize the database on startup, not at import time
+    await asyncio.to_thread(auth.init_users_db)
+    yield
+
+app = FastAPI(title="Minimal Login API", lifespan=lifespan)
 
 # IMPORTANT: Replace "http://localhost:3000" with your actual React frontend URL in production.
 # Using ["*"] for origins is convenient for development but insecure for production.
@@ -85,6 +33,7 @@ class LoginRequest(BaseModel):
 
 class LoginResponse(BaseModel):
     message: str
+    session_token: str
 
 # --- API Endpoint ---
 @app.post("/api/login", response_model=LoginResponse)
@@ -94,10 +43,9 @@ async def login(request: LoginRequest):
     Expects a JSON body with 'login' and 'password' fields.
     Checks credentials against the SQLite database.
     """
-    if verify_user(request.login, request.password):
-        # In a real app, you would generate and return a secure session token here.
-        # For this minimal example, we just confirm the login was successful.
-        return LoginResponse(message="Login successful")
+    # The argon2 check runs in auth's bounded thread pool, so it never blocks the event loop
+    if await auth.verify_user_async(request.login, request.password):
+        return LoginResponse(message="Login successful", session_token=auth.issue_session_token(request.login))
     else:
         # Return a 401 Unauthorized status if login fails
         raise HTTPException(status_code=401, detail="Invalid credentials")
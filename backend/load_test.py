@@ -0,0 +1,202 @@
+"""
+Нагрузочный прогон backend.py против локального стенда mock_bank.py.
+
+Каждый виртуальный пользователь выполняет сценарий фронтенда:
+  POST /api/select_banks  →  GET /api/analysis_results/{login}
+и повторяет его --iterations раз. В конце печатаются p50/p99 и пропускная способность по каждой ручке.
+
+Запуск с автоматическим поднятием стенда и backend во временной директории:
+  python load_test.py --spawn --users 20 --iterations 3
+
+Запуск против уже поднятых серверов:
+  python load_test.py --backend-url http://127.0.0.1:8000 --users 20
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+from synthetic_data import DEFAULT_BANKS, generate_cashback_catalog
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..100) методом ближайшего ранга."""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    rank = max(1, int(round(q / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class LoadStats:
+    """Потокобезопасный сбор латентностей и ошибок по ручкам."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, endpoint: str, latency: float, ok: bool):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def report(self, wall_time: float) -> dict:
+        report = {}
+        all_latencies = []
+        for endpoint, values in sorted(self.latencies.items()):
+            all_latencies.extend(values)
+            report[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors[endpoint],
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(max(values) * 1000, 1),
+                "rps": round(len(values) / wall_time, 2),
+            }
+        report["total"] = {
+            "requests": len(all_latencies),
+            "errors": sum(self.errors.values()),
+            "p50_ms": round(percentile(all_latencies, 50) * 1000, 1),
+            "p99_ms": round(percentile(all_latencies, 99) * 1000, 1),
+            "rps": round(len(all_latencies) / wall_time, 2),
+            "wall_time_s": round(wall_time, 2),
+        }
+        return report
+
+
+def run_user(backend_url: str, user_login: str, banks: List[str], iterations: int, stats: LoadStats, timeout: float):
+    """Сценарий одного виртуального пользователя."""
+    session = requests.Session()
+    for _ in range(iterations):
+        steps = [
+            ("select_banks", "post", f"{backend_url}/api/select_banks",
+             {"json": {"user_login": user_login, "selected_banks": banks}}),
+            ("analysis_results", "get", f"{backend_url}/api/analysis_results/{user_login}", {}),
+        ]
+        for endpoint, method, url, kwargs in steps:
+            start = time.perf_counter()
+            ok = False
+            try:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                pass
+            stats.record(endpoint, time.perf_counter() - start, ok)
+
+
+def run_load(backend_url: str, users: int, iterations: int, banks: List[str], client_prefix: str, timeout: float) -> dict:
+    """Запускает users виртуальных пользователей параллельно и возвращает отчёт."""
+    stats = LoadStats()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        futures = [
+            executor.submit(run_user, backend_url, f"{client_prefix}-{i + 1}", banks, iterations, stats, timeout)
+            for i in range(users)
+        ]
+        for future in futures:
+            future.result()
+    return stats.report(time.perf_counter() - start)
+
+
+def prepare_workdir(workdir: str, banks: List[str]):
+    """Создаёт в рабочей директории credentials.json и Cashbacks.xlsx для стенда (если их нет)."""
+    credentials_path = os.path.join(workdir, "credentials.json")
+    if not os.path.exists(credentials_path):
+        with open(credentials_path, "w", encoding="utf-8") as file:
+            json.dump([
+                {"bank_name": bank, "client_id": "team089", "client_secret": "mock-secret"} for bank in banks
+            ], file, ensure_ascii=False, indent=4)
+
+    cashbacks_path = os.path.join(workdir, "Cashbacks.xlsx")
+    if not os.path.exists(cashbacks_path):
+        import pandas as pd
+        pd.DataFrame(generate_cashback_catalog(banks, categories_per_bank=8)).to_excel(cashbacks_path, index=False)
+
+
+def wait_until_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Сервер {url} не поднялся за {timeout} с")
+
+
+def spawn_servers(workdir: str, mock_port: int, backend_port: int, extra_env: Optional[dict] = None) -> List[subprocess.Popen]:
+    """Поднимает mock_bank и backend через uvicorn с рабочей директорией workdir."""
+    env = dict(os.environ)
+    env.update(extra_env or {})
+    env["PYTHONPATH"] = BACKEND_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    env["BANK_BASE_URL_TEMPLATE"] = f"http://127.0.0.1:{mock_port}/{{bank}}"
+
+    processes = []
+    for module, port in (("mock_bank:app", mock_port), ("backend:app", backend_port)):
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", module, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=workdir, env=env,
+        ))
+    wait_until_ready(f"http://127.0.0.1:{mock_port}/docs")
+    wait_until_ready(f"http://127.0.0.1:{backend_port}/docs")
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон backend против mock_bank")
+    parser.add_argument("--backend-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=10, help="Количество одновременных пользователей")
+    parser.add_argument("--iterations", type=int, default=1, help="Сколько раз каждый пользователь проходит сценарий")
+    parser.add_argument("--banks", default=",".join(DEFAULT_BANKS))
+    parser.add_argument("--client-prefix", default="team089")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Таймаут одного HTTP-запроса, с")
+    parser.add_argument("--spawn", action="store_true", help="Поднять mock_bank и backend во временной директории")
+    parser.add_argument("--mock-port", type=int, default=9000)
+    parser.add_argument("--backend-port", type=int, default=8000)
+    parser.add_argument("--output", help="Сохранить отчёт в JSON-файл")
+    args = parser.parse_args()
+
+    banks = [bank.strip() for bank in args.banks.split(",") if bank.strip()]
+    backend_url = args.backend_url
+    processes = []
+    workdir = None
+
+    try:
+        if args.spawn:
+            workdir = tempfile.mkdtemp(prefix="vtb25-load-")
+            prepare_workdir(workdir, banks)
+            processes = spawn_servers(workdir, args.mock_port, args.backend_port)
+            backend_url = f"http://127.0.0.1:{args.backend_port}"
+            print(f"Стенд поднят, рабочая директория: {workdir}")
+
+        report = run_load(backend_url, args.users, args.iterations, banks, args.client_prefix, args.timeout)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    print(f"{'Ручка':<20} {'Запросов':>9} {'Ошибок':>7} {'p50, мс':>9} {'p99, мс':>9} {'RPS':>7}")
+    for endpoint, row in report.items():
+        print(f"{endpoint:<20} {row['requests']:>9} {row['errors']:>7} {row['p50_ms']:>9} {row['p99_ms']:>9} {row['rps']:>7}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
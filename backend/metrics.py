@@ -0,0 +1,395 @@
+import asyncio
+import bisect
+import functools
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+
+# Границы бакетов по умолчанию (секунды): от миллисекунд до десятков секунд
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames: Sequence[str], values: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    """Формирует строку меток в формате Prometheus: {a="1",b="2"}."""
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    """Базовый класс метрики с набором меток."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Gauge(_Metric):
+    """Значение, которое может как расти, так и уменьшаться."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Histogram(_Metric):
+    """Гистограмма с кумулятивными бакетами, суммой и количеством наблюдений."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [счётчики по бакетам (+Inf последним), сумма, количество]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Контекстный менеджер: измеряет длительность блока и записывает её в гистограмму."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса, отдаваемых на /metrics."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        """Возвращает все метрики в текстовом формате Prometheus (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- Метрики приложения ---
+
+BANK_API_LATENCY = Histogram(
+    "bank_api_request_duration_seconds",
+    "Длительность запросов к API банков по функциям VTBAPI_Requests",
+    ("function", "bank", "status"),
+)
+
+TRANSACTION_PAGES = Histogram(
+    "bank_transaction_pages_per_account",
+    "Количество страниц транзакций, загруженных по одному счёту",
+    ("bank",),
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100),
+)
+
+BANK_CALL_QUEUE_WAIT = Histogram(
+    "bank_call_queue_wait_seconds",
+    "Ожидание слота в планировщике запросов к банкам по классам приоритета",
+    ("bank", "priority"),
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+SQLITE_QUERY_LATENCY = Histogram(
+    "sqlite_query_duration_seconds",
+    "Длительность SQLite-запросов",
+    ("db", "operation"),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0),
+)
+
+ANALYSIS_STAGE_LATENCY = Histogram(
+    "analysis_stage_duration_seconds",
+    "Длительность этапов анализа (prediction_model, choose_best_cashback и т.д.)",
+    ("stage",),
+)
+
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Обращения к кешам и single-flight: result=hit|miss",
+    ("cache", "result"),
+)
+
+CONSENT_RENEWALS = Counter(
+    "consent_renewals_total",
+    "Фоновые продления согласий (consent_scheduler): result=renewed|pending|failed|dropped|expired",
+    ("result",),
+)
+
+ADMISSION_DECISIONS = Counter(
+    "admission_decisions_total",
+    "Решения контроля допуска тяжёлых ручек: result=admitted|queued|rejected|timeout",
+    ("endpoint", "result"),
+)
+
+ADMISSION_QUEUE = Gauge(
+    "admission_queue_length",
+    "Количество запросов, ожидающих слота тяжёлой ручки",
+    ("endpoint",),
+)
+
+PASSWORD_VERIFY_LATENCY = Histogram(
+    "password_verify_duration_seconds",
+    "Длительность проверки пароля (argon2) с учётом ожидания в пуле потоков",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Задержка пробуждения event loop относительно ожидаемой (время блокировки)",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+
+EVENT_LOOP_BLOCKED = Counter(
+    "event_loop_blocked_seconds_total",
+    "Суммарное время, на которое был заблокирован event loop",
+)
+
+
+def cache_hit(cache: str):
+    CACHE_REQUESTS.inc(cache=cache, result="hit")
+
+
+def cache_miss(cache: str):
+    CACHE_REQUESTS.inc(cache=cache, result="miss")
+
+
+def timed(histogram: Histogram, **labels):
+    """Декоратор: записывает длительность вызова функции в гистограмму."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bank_from_url(base_url: str) -> str:
+    """
+    Извлекает имя банка из base_url вида https://abank.open.bankingapi.ru
+    или http://127.0.0.1:9000/abank (локальный стенд mock_bank.py).
+    """
+    parsed = urlparse(base_url)
+    host = parsed.hostname or base_url
+    path = parsed.path.strip('/')
+    if path and (host == "localhost" or host.replace('.', '').isdigit()):
+        return path.split('/')[0]
+    return host.split('.')[0]
+
+
+def observe_bank_call(func):
+    """
+    Декоратор для функций VTBAPI_Requests: записывает длительность запроса
+    с метками function, bank (из base_url) и status (HTTP-код или error).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bank = bank_for_call(func, kwargs)
+        status = "error"
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            status = "ok"
+            return result
+        except Exception as e:
+            response = getattr(e, "response", None)
+            if response is not None and getattr(response, "status_code", None):
+                status = str(response.status_code)
+            raise
+        finally:
+            BANK_API_LATENCY.observe(time.perf_counter() - start, function=func.__name__, bank=bank, status=status)
+    return wrapper
+
+
+def bank_for_call(func, kwargs: dict) -> str:
+    """Определяет банк вызова по аргументу base_url (переданному или значению по умолчанию)."""
+    base_url = kwargs.get("base_url")
+    if base_url is None:
+        base_url = _default_arg(func, "base_url")
+    return bank_from_url(base_url) if base_url else "unknown"
+
+
+def _default_arg(func, name: str):
+    defaults = func.__defaults__ or ()
+    code = func.__code__
+    argnames = code.co_varnames[:code.co_argcount]
+    offset = len(argnames) - len(defaults)
+    for i, arg in enumerate(argnames):
+        if arg == name and i >= offset:
+            return defaults[i - offset]
+    return None
+
+
+# --- SQLite ---
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, записывающий длительность каждого запроса в SQLITE_QUERY_LATENCY."""
+
+    def _observe(self, sql: str, start: float):
+        operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "UNKNOWN"
+        SQLITE_QUERY_LATENCY.observe(time.perf_counter() - start, db=self.connection.db_label, operation=operation)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(sql, start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение SQLite, курсоры которого измеряют время запросов."""
+
+    db_label = "unknown"
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def timed_connect(db_path: str, **kwargs) -> sqlite3.Connection:
+    """Аналог sqlite3.connect, возвращающий соединение с измерением времени запросов."""
+    conn = sqlite3.connect(db_path, factory=TimedConnection, **kwargs)
+    conn.db_label = os.path.basename(str(db_path))
+    return conn
+
+
+# --- Event loop ---
+
+async def monitor_event_loop(interval: float = 0.1):
+    """
+    Фоновая задача: раз в interval секунд проверяет, насколько позже ожидаемого проснулся event loop.
+    Разница — время, в течение которого loop был заблокирован синхронным кодом.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        if lag > 0.001:
+            EVENT_LOOP_BLOCKED.inc(lag)
@@ -0,0 +1,196 @@
+"""
+Локальный стенд Open Banking API для нагрузочного тестирования.
+
+Реализует эндпоинты, которые использует VTBAPI_Requests.py, для любого банка по пути /{bank}/...:
+  POST /{bank}/auth/bank-token
+  POST /{bank}/account-consents/request
+  GET  /{bank}/account-consents/{consent_id}
+  GET  /{bank}/accounts
+  GET  /{bank}/accounts/{account_id}/transactions  (с пагинацией и meta/links)
+
+Запуск:
+  uvicorn mock_bank:app --port 9000
+  BANK_BASE_URL_TEMPLATE="http://127.0.0.1:9000/{bank}" uvicorn backend:app --port 8000
+
+Настройки (переменные окружения):
+  MOCK_LATENCY_MS          средняя задержка ответа, мс (по умолчанию 50)
+  MOCK_LATENCY_JITTER_MS   разброс задержки, мс (по умолчанию 20)
+  MOCK_ERROR_RATE          доля ответов 503 (по умолчанию 0)
+  MOCK_ACCOUNTS_PER_USER   количество счетов у клиента в банке (по умолчанию 2)
+  MOCK_TX_PER_ACCOUNT      количество транзакций на счёте (по умолчанию 500)
+  MOCK_MAX_PAGE_SIZE       максимальный limit страницы (по умолчанию 500)
+  MOCK_PAGE_SIZE_MODE      reject — 422 при limit больше максимума, clamp — молча урезать (по умолчанию reject)
+  MOCK_CONSENT_TTL_DAYS    срок действия согласия, дней (по умолчанию 365)
+  MOCK_SEED                зерно генератора данных (по умолчанию 0)
+  MOCK_BANK_OVERRIDES      JSON с настройками для отдельных банков, например
+                           '{"sbank": {"latency_ms": 2000, "error_rate": 0.2}}'
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+
+from synthetic_data import generate_transactions
+
+# --- Конфигурация ---
+
+CONFIG: Dict[str, Any] = {
+    "latency_ms": float(os.environ.get("MOCK_LATENCY_MS", "50")),
+    "latency_jitter_ms": float(os.environ.get("MOCK_LATENCY_JITTER_MS", "20")),
+    "error_rate": float(os.environ.get("MOCK_ERROR_RATE", "0")),
+    "accounts_per_user": int(os.environ.get("MOCK_ACCOUNTS_PER_USER", "2")),
+    "tx_per_account": int(os.environ.get("MOCK_TX_PER_ACCOUNT", "500")),
+    "max_page_size": int(os.environ.get("MOCK_MAX_PAGE_SIZE", "500")),
+    "page_size_mode": os.environ.get("MOCK_PAGE_SIZE_MODE", "reject"),
+    "consent_ttl_days": int(os.environ.get("MOCK_CONSENT_TTL_DAYS", "365")),
+    "seed": int(os.environ.get("MOCK_SEED", "0")),
+}
+
+BANK_OVERRIDES: Dict[str, Dict[str, Any]] = json.loads(os.environ.get("MOCK_BANK_OVERRIDES", "{}"))
+
+
+def bank_config(bank: str) -> Dict[str, Any]:
+    """Настройки для банка с учётом MOCK_BANK_OVERRIDES."""
+    return {**CONFIG, **BANK_OVERRIDES.get(bank, {})}
+
+
+# --- Состояние стенда ---
+
+# consent_id -> {bank, client_id, expires}
+consents: Dict[str, Dict[str, Any]] = {}
+
+
+@lru_cache(maxsize=4096)
+def account_transactions(bank: str, account_id: str, n_transactions: int, seed: int) -> tuple:
+    """Синтетическая история счёта; одинакова между запросами и перезапусками при том же seed."""
+    return tuple(generate_transactions(n_transactions, account_id=account_id, seed=seed))
+
+
+async def simulate_network(bank: str):
+    """Задержка и случайные ошибки согласно настройкам банка."""
+    config = bank_config(bank)
+    delay_ms = max(0.0, random.gauss(config["latency_ms"], config["latency_jitter_ms"]))
+    await asyncio.sleep(delay_ms / 1000)
+    if random.random() < config["error_rate"]:
+        raise HTTPException(status_code=503, detail="Service temporarily unavailable (mock)")
+
+
+def require_token(request: Request):
+    if not request.headers.get("authorization", "").startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+
+
+app = FastAPI(title="Mock Open Banking API")
+
+
+@app.post("/{bank}/auth/bank-token")
+async def bank_token(bank: str, client_id: str, client_secret: str):
+    await simulate_network(bank)
+    return {
+        "access_token": f"mock-{bank}-{uuid.uuid4().hex}",
+        "token_type": "bearer",
+        "client_id": client_id,
+        "algorithm": "HS256",
+        "expires_in": 86400,
+    }
+
+
+@app.post("/{bank}/account-consents/request")
+async def account_consents_request(bank: str, request: Request):
+    require_token(request)
+    await simulate_network(bank)
+    payload = await request.json()
+    consent_id = f"consent-{uuid.uuid4().hex[:12]}"
+    expires = datetime.now(timezone.utc) + timedelta(days=bank_config(bank)["consent_ttl_days"])
+    consents[consent_id] = {"bank": bank, "client_id": payload.get("client_id"), "expires": expires}
+    return {
+        "request_id": f"req-{uuid.uuid4().hex[:12]}",
+        "consent_id": consent_id,
+        "status": "approved",
+        "message": "Согласие одобрено автоматически (mock)",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "auto_approved": True,
+    }
+
+
+@app.get("/{bank}/account-consents/{consent_id}")
+async def get_consent(bank: str, consent_id: str, request: Request):
+    require_token(request)
+    await simulate_network(bank)
+    consent = consents.get(consent_id)
+    if consent is None:
+        raise HTTPException(status_code=404, detail="Consent not found")
+    return {
+        "data": {
+            "consentId": consent_id,
+            "status": "Authorized",
+            "creationDateTime": datetime.now(timezone.utc).isoformat(),
+            "expirationDateTime": consent["expires"].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "permissions": ["ReadAccountsDetail", "ReadBalances", "ReadTransactionsDetail"],
+        }
+    }
+
+
+@app.get("/{bank}/accounts")
+async def get_accounts(bank: str, client_id: str, request: Request):
+    require_token(request)
+    await simulate_network(bank)
+    accounts = [
+        {
+            "accountId": f"{bank}-{client_id}-acc-{i}",
+            "status": "Enabled",
+            "currency": "RUB",
+            "accountType": "Personal",
+            "nickname": f"Счёт {i + 1}",
+        }
+        for i in range(bank_config(bank)["accounts_per_user"])
+    ]
+    return {"data": {"account": accounts}}
+
+
+@app.get("/{bank}/accounts/{account_id}/transactions")
+async def get_transactions(
+    bank: str,
+    account_id: str,
+    request: Request,
+    from_booking_date_time: Optional[str] = None,
+    to_booking_date_time: Optional[str] = None,
+    page: int = 1,
+    limit: int = 50
+):
+    require_token(request)
+    await simulate_network(bank)
+    config = bank_config(bank)
+
+    if limit > config["max_page_size"]:
+        if config["page_size_mode"] == "reject":
+            raise HTTPException(status_code=422, detail=f"limit must be <= {config['max_page_size']}")
+        limit = config["max_page_size"]
+
+    transactions = account_transactions(bank, account_id, config["tx_per_account"], config["seed"])
+    if from_booking_date_time or to_booking_date_time:
+        low = from_booking_date_time or ""
+        high = to_booking_date_time or "9999"
+        # Даты в едином формате ISO 8601 UTC, поэтому сравниваем строки
+        transactions = [tx for tx in transactions if low <= tx["bookingDateTime"] <= high]
+
+    total = len(transactions)
+    total_pages = max(1, math.ceil(total / limit))
+    page_items = transactions[(page - 1) * limit: page * limit]
+
+    links = {"self": str(request.url.include_query_params(page=page))}
+    if page < total_pages:
+        links["next"] = str(request.url.include_query_params(page=page + 1))
+
+    return {
+        "data": {"transaction": [dict(tx) for tx in page_items]},
+        "links": links,
+        "meta": {"totalPages": total_pages, "totalRecords": total},
+    }
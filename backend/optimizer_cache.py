@@ -0,0 +1,194 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+import pandas as pd
+
+import metrics
+
+# Кеш результатов choose_best_cashback: включён ли, размер LRU, шаг квантования прогноза (в рублях)
+OPTIMIZER_CACHE_ENABLED = os.environ.get("OPTIMIZER_CACHE_ENABLED", "1") == "1"
+OPTIMIZER_CACHE_SIZE = int(os.environ.get("OPTIMIZER_CACHE_SIZE", "4096"))
+OPTIMIZER_CACHE_STEP = float(os.environ.get("OPTIMIZER_CACHE_STEP", "100"))
+# Путь к SQLite-файлу общего кеша (разделяется процессами и перезапусками); пусто — только память
+OPTIMIZER_CACHE_DB = os.environ.get("OPTIMIZER_CACHE_DB", "")
+# Сколько записей хранит общий кеш: лишние (самые старые) удаляются раз в OPTIMIZER_CACHE_DB_TRIM_EVERY записей
+OPTIMIZER_CACHE_DB_MAX_ROWS = int(os.environ.get("OPTIMIZER_CACHE_DB_MAX_ROWS", "100000"))
+OPTIMIZER_CACHE_DB_TRIM_EVERY = 256
+# Версия алгоритмов оптимизатора в ключе: после изменения результатов старые записи общего кеша не отдаются
+OPTIMIZER_VERSION = 2
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кеш ограниченного размера."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+
+_memory_cache = LRUCache(OPTIMIZER_CACHE_SIZE)
+
+# Записей в общий кеш с последней обрезки (в этом процессе)
+_disk_puts = 0
+_disk_puts_lock = threading.Lock()
+
+
+def catalog_version(cashback_df: pd.DataFrame) -> str:
+    """Версия каталога кешбеков — хеш его содержимого (меняется при любой правке Cashbacks.xlsx)."""
+    row_hashes = pd.util.hash_pandas_object(cashback_df, index=False).to_numpy()
+    columns = ",".join(map(str, cashback_df.columns))
+    return hashlib.sha1(columns.encode() + row_hashes.tobytes()).hexdigest()[:16]
+
+
+def quantize_prediction(prediction_df: pd.DataFrame, step: float = OPTIMIZER_CACHE_STEP) -> Tuple[Tuple[str, float], ...]:
+    """
+    Канонический вид прогноза: суммы округлены до step, категории отсортированы.
+    Для повторяющихся категорий берётся первая строка, как в choose_best_cashback.
+    """
+    spend = {}
+    for category, amount in zip(prediction_df['category'], prediction_df['predicted_amount']):
+        spend.setdefault(category, float(amount))
+    if step > 0:
+        spend = {category: round(amount / step) * step if math.isfinite(amount) else amount
+                 for category, amount in spend.items()}
+    return tuple(sorted(spend.items()))
+
+
+def cache_key(mode: str, prediction_df: pd.DataFrame, cashback_df: pd.DataFrame,
+              step: float = OPTIMIZER_CACHE_STEP) -> Tuple:
+    """(режим и версия оптимизатора, версия каталога, отсортированный набор банков, квантованный прогноз)."""
+    banks = tuple(sorted(map(str, cashback_df['bank'].unique())))
+    return f"{mode}:v{OPTIMIZER_VERSION}", catalog_version(cashback_df), banks, quantize_prediction(prediction_df, step)
+
+
+def _disk_key(key: Tuple) -> str:
+    return hashlib.sha1(json.dumps(key, ensure_ascii=False).encode()).hexdigest()
+
+
+def _ensure_cache_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS optimizer_cache (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    # Обрезка идёт от самых старых записей по индексу, без сортировки всей таблицы
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_optimizer_cache_created_at ON optimizer_cache (created_at)")
+
+
+def _disk_get(db_path: str, key: Tuple) -> Optional[pd.DataFrame]:
+    with metrics.timed_connect(db_path) as conn:
+        cursor = conn.cursor()
+        _ensure_cache_table(cursor)
+        cursor.execute("SELECT result FROM optimizer_cache WHERE key = ?", (_disk_key(key),))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    data = json.loads(row[0])
+    return pd.DataFrame(data["rows"], columns=data["columns"])
+
+
+def _disk_put(db_path: str, key: Tuple, result: pd.DataFrame, max_rows: int = OPTIMIZER_CACHE_DB_MAX_ROWS):
+    global _disk_puts
+    payload = json.dumps({"columns": list(result.columns), "rows": result.to_dict(orient='records')}, ensure_ascii=False)
+    with _disk_puts_lock:
+        _disk_puts += 1
+        trim = _disk_puts >= OPTIMIZER_CACHE_DB_TRIM_EVERY
+        if trim:
+            _disk_puts = 0
+    with metrics.timed_connect(db_path) as conn:
+        cursor = conn.cursor()
+        _ensure_cache_table(cursor)
+        cursor.execute(
+            "INSERT OR REPLACE INTO optimizer_cache (key, result, created_at) VALUES (?, ?, ?)",
+            (_disk_key(key), payload, int(time.time()))
+        )
+        if trim:
+            _trim(cursor, max_rows)
+        conn.commit()
+
+
+def _trim(cursor, max_rows: int):
+    """Удаляет из общего кеша самые старые записи сверх max_rows."""
+    cursor.execute("""
+        DELETE FROM optimizer_cache WHERE key IN (
+            SELECT key FROM optimizer_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+        )
+    """, (max_rows,))
+    if cursor.rowcount > 0:
+        print(f"Общий кеш оптимизатора обрезан до {max_rows} записей: удалено {cursor.rowcount}")
+
+
+def memoized(mode: str, prediction_df: pd.DataFrame, cashback_df: pd.DataFrame,
+             compute: Callable[[pd.DataFrame, pd.DataFrame], pd.DataFrame],
+             evaluate: Callable[[pd.DataFrame, pd.DataFrame, pd.DataFrame], pd.DataFrame],
+             step: float = OPTIMIZER_CACHE_STEP, db_path: Optional[str] = None) -> pd.DataFrame:
+    """
+    Результат compute(прогноз, каталог) из кеша или с вычислением.
+
+    Квантованный прогноз — только ключ: при промахе оптимизатор запускается на точном прогнозе,
+    а при попадании из кеша берётся выбор категорий, найденный для близких трат, и его кешбек
+    пересчитывается по точному прогнозу (evaluate) — без перебора, но с суммами именно этого пользователя.
+
+    :param compute: Оптимизатор (prediction_df, cashback_df) -> DataFrame
+    :param evaluate: Кешбек выбора (строки результата compute, prediction_df, cashback_df) -> DataFrame
+    :param step: Шаг квантования сумм прогноза
+    :param db_path: SQLite-файл общего кеша (по умолчанию OPTIMIZER_CACHE_DB; пусто — только память)
+    """
+    db_path = OPTIMIZER_CACHE_DB if db_path is None else db_path
+    key = cache_key(mode, prediction_df, cashback_df, step)
+
+    result = _memory_cache.get(key)
+    if result is not None:
+        metrics.cache_hit("optimizer")
+        return evaluate(result, prediction_df, cashback_df)
+
+    if db_path:
+        result = _disk_get(db_path, key)
+        if result is not None:
+            metrics.cache_hit("optimizer_disk")
+            _memory_cache.put(key, result)
+            return evaluate(result, prediction_df, cashback_df)
+        metrics.cache_miss("optimizer_disk")
+
+    metrics.cache_miss("optimizer")
+    result = compute(prediction_df, cashback_df)
+    _memory_cache.put(key, result)
+    if db_path:
+        _disk_put(db_path, key, result)
+    return result.copy()
+
+
+def clear():
+    """Очищает кеш в памяти (общий кеш на диске не трогается)."""
+    _memory_cache.clear()
@@ -0,0 +1,264 @@
+import json
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from analysis_try4 import (
+    booking_month_index,
+    excluded_category_set,
+    month_index,
+    transaction_category,
+)
+from backtest import DEFAULT_PARAMS, HistoryMatrix, predict_all_months
+
+# Сколько месяцев хранит кольцевой буфер (модели нужно 12 месяцев до целевого)
+RING_MONTHS = 24
+
+# Сколько последних месяцев счёта сверяется по transactionId: в этом окне учитываются
+# задним числом проведённые транзакции и транзакции со страниц, не загрузившихся в прошлый раз
+DEDUP_WINDOW_MONTHS = 2
+
+# Версия 1 хранила монотонный курсор без окна сверки — такое состояние пересобирается со следующей загрузки
+STATE_VERSION = 2
+
+
+class PredictionState:
+    """
+    Агрегированное состояние пользователя для prediction_model.
+
+    Хранит суммы трат по (категория, месяц) и месячные итоги в кольцевом буфере на RING_MONTHS месяцев,
+    а также курсоры синхронизации по счетам. Каждая новая транзакция добавляется за O(1),
+    а прогноз строится по буферу, поэтому его стоимость не зависит от длины истории.
+
+    Транзакции последних DEDUP_WINDOW_MONTHS месяцев счёта (от самого нового учтённого) сверяются
+    по transactionId, более старые считаются уже учтёнными.
+    """
+
+    def __init__(self, ring_months: int = RING_MONTHS):
+        self.ring_months = ring_months
+        # month_index самого нового месяца в буфере (None — буфер пуст)
+        self.head_month: Optional[int] = None
+        self.categories: Dict[str, List[float]] = {}
+        self.totals: List[float] = [0.0] * ring_months
+        # "bank:account" -> {"cursor": последний bookingDateTime, "seen": {id транзакции: её month_index}}
+        # (в seen — только транзакции окна DEDUP_WINDOW_MONTHS)
+        self.cursors: Dict[str, Dict[str, Any]] = {}
+
+    # --- Обновление ---
+
+    def _advance(self, month: int):
+        """Сдвигает голову буфера до month, обнуляя ячейки вытесняемых месяцев."""
+        if self.head_month is None:
+            self.head_month = month
+            return
+        steps = min(month - self.head_month, self.ring_months)
+        for offset in range(1, steps + 1):
+            slot = (self.head_month + offset) % self.ring_months
+            self.totals[slot] = 0.0
+            for values in self.categories.values():
+                values[slot] = 0.0
+        self.head_month = month
+
+    def add(self, month: int, category: str, amount: float) -> bool:
+        """
+        Добавляет трату в буфер.
+
+        :param month: month_index месяца траты
+        :return: False, если месяц старше окна буфера и трата отброшена
+        """
+        if self.head_month is None or month > self.head_month:
+            self._advance(month)
+        elif month <= self.head_month - self.ring_months:
+            return False
+
+        slot = month % self.ring_months
+        values = self.categories.get(category)
+        if values is None:
+            values = [0.0] * self.ring_months
+            self.categories[category] = values
+        values[slot] += amount
+        self.totals[slot] += amount
+        return True
+
+    @staticmethod
+    def _account_key(tx: dict) -> str:
+        return f"{tx.get('_bank_name')}:{tx.get('_account_id')}"
+
+    def _window_start(self, key: str) -> Optional[int]:
+        """Первый month_index окна сверки счёта (None — счёт ещё не встречался, новы все транзакции)."""
+        cursor = self.cursors.get(key)
+        if cursor is None:
+            return None
+        return booking_month_index(cursor["cursor"]) - DEDUP_WINDOW_MONTHS + 1
+
+    def _is_new(self, tx: dict, month: int, window_start: Optional[int]) -> bool:
+        """
+        Проверяет, что транзакция ещё не учтена, запоминает её id и сдвигает курсор счёта.
+
+        :param month: month_index транзакции
+        :param window_start: Начало окна сверки счёта на момент начала загрузки (_window_start)
+        """
+        if window_start is not None and month < window_start:
+            return False
+        key = self._account_key(tx)
+        booking = tx["bookingDateTime"]
+        # Без transactionId транзакцию узнаём по времени и сумме
+        tx_id = tx.get("transactionId") or f"{booking}:{tx['amount']['amount']}"
+        cursor = self.cursors.setdefault(key, {"cursor": booking, "seen": {}})
+        if tx_id in cursor["seen"]:
+            return False
+        cursor["seen"][tx_id] = month
+        if booking > cursor["cursor"]:
+            cursor["cursor"] = booking
+        return True
+
+    def _prune_seen(self, keys: Iterable[str]):
+        """Забывает id транзакций, выпавших из окна сверки своих счетов."""
+        for key in keys:
+            window_start = self._window_start(key)
+            seen = self.cursors[key]["seen"]
+            for tx_id in [tx_id for tx_id, month in seen.items() if month < window_start]:
+                del seen[tx_id]
+
+    def ingest(self, transactions: Iterable[dict], known_categories: Iterable[str]) -> int:
+        """
+        Учитывает новые транзакции (с мета-полями _bank_name/_account_id, как из fetch_all_transactions).
+        Уже учтённые транзакции (по id в окне сверки и все до него) пропускаются.
+
+        :param known_categories: Категории каталога кешбеков (Title Case)
+        :return: Количество добавленных транзакций
+        """
+        known = set(known_categories)
+        excluded = excluded_category_set()
+        added = 0
+        # Окно сверки считается от курсоров до загрузки: всё, что в него попадает, сверяется по id,
+        # даже если эта же загрузка сдвинет курсор дальше
+        window_starts: Dict[str, Optional[int]] = {}
+        for tx in transactions:
+            if tx.get("status") != "completed" or tx.get("creditDebitIndicator") != "Debit":
+                continue
+            if not tx.get("bookingDateTime"):
+                continue
+            key = self._account_key(tx)
+            if key not in window_starts:
+                window_starts[key] = self._window_start(key)
+            month = booking_month_index(tx["bookingDateTime"])
+            if not self._is_new(tx, month, window_starts[key]):
+                continue
+            category = transaction_category(tx, known)
+            if category in excluded:
+                continue
+            if self.add(month, category, abs(float(tx["amount"]["amount"]))):
+                added += 1
+        self._prune_seen(window_starts)
+        return added
+
+    # --- Чтение ---
+
+    def history(self) -> HistoryMatrix:
+        """Матрица (категория × месяц) по содержимому буфера, от старого месяца к новому."""
+        categories = sorted(self.categories)
+        if self.head_month is None or not categories:
+            return HistoryMatrix([], 0, np.zeros((0, 0)))
+        first_month = self.head_month - self.ring_months + 1
+        order = [(first_month + i) % self.ring_months for i in range(self.ring_months)]
+        amounts = np.array([[self.categories[category][slot] for slot in order] for category in categories])
+        return HistoryMatrix(categories, first_month, amounts)
+
+    def monthly_totals(self) -> Dict[int, float]:
+        """month_index -> сумма трат за месяц по содержимому буфера."""
+        if self.head_month is None:
+            return {}
+        return {
+            month: self.totals[month % self.ring_months]
+            for month in range(self.head_month - self.ring_months + 1, self.head_month + 1)
+        }
+
+    def prediction(self, month, w_share: float = 0.7, w_direct: float = 0.3, params: Optional[dict] = None) -> pd.DataFrame:
+        """
+        Прогноз трат на month в формате prediction_model (колонки category, predicted_amount).
+        """
+        history = self.history()
+        params = {**DEFAULT_PARAMS, **(params or {}), "w_share": w_share, "w_direct": w_direct}
+        predicted = predict_all_months(history, [month_index(month)], params)
+        return pd.DataFrame({
+            'category': history.categories,
+            'predicted_amount': predicted[:, 0] if len(history.categories) else [],
+        })
+
+    # --- Сериализация ---
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "version": STATE_VERSION,
+            "ring_months": self.ring_months,
+            "head_month": self.head_month,
+            "categories": self.categories,
+            "totals": self.totals,
+            "cursors": self.cursors,
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, payload: str) -> "PredictionState":
+        data = json.loads(payload)
+        if data.get("version") != STATE_VERSION:
+            return cls()
+        state = cls(data["ring_months"])
+        state.head_month = data["head_month"]
+        state.categories = data["categories"]
+        state.totals = data["totals"]
+        state.cursors = data["cursors"]
+        return state
+
+
+# --- Хранение в SQLite ---
+
+def _ensure_state_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS prediction_state (
+            user_name TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+
+
+def load_prediction_state(user_name: str, db_path: str = "users.db") -> PredictionState:
+    """Загружает состояние пользователя из БД (или возвращает пустое)."""
+    with metrics.timed_connect(db_path) as conn:
+        cursor = conn.cursor()
+        _ensure_state_table(cursor)
+        cursor.execute("SELECT state FROM prediction_state WHERE user_name = ?", (user_name,))
+        row = cursor.fetchone()
+    if row is None:
+        return PredictionState()
+    try:
+        return PredictionState.from_json(row[0])
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        print(f"⚠️ Некорректное состояние прогноза у {user_name}, начинаем заново: {e}")
+        return PredictionState()
+
+
+def save_prediction_state(user_name: str, state: PredictionState, db_path: str = "users.db"):
+    """Сохраняет состояние пользователя в БД."""
+    with metrics.timed_connect(db_path) as conn:
+        cursor = conn.cursor()
+        _ensure_state_table(cursor)
+        cursor.execute("""
+            INSERT INTO prediction_state (user_name, state, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_name) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+        """, (user_name, state.to_json(), int(time.time())))
+        conn.commit()
+
+
+def update_prediction_state(user_name: str, transactions: List[dict], known_categories: Iterable[str], db_path: str = "users.db") -> PredictionState:
+    """Загружает состояние, учитывает новые транзакции и сохраняет обратно."""
+    state = load_prediction_state(user_name, db_path)
+    added = state.ingest(transactions, known_categories)
+    if added:
+        save_prediction_state(user_name, state, db_path)
+    print(f"Состояние прогноза {user_name}: добавлено {added} новых транзакций")
+    return state
@@ -1,9 +1,33 @@
 import sqlite3
+import requests
+import functools
+import metrics
+import tracing
+import deadline
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from VTBAPI_Requests import *
+from singleflight import SingleFlight
+from deadline import DeadlineExceeded
+from token_store import get_token, get_tokens
+from accounts_store import (
+    account_sync_state,
+    active_bank_accounts,
+    bank_accounts,
+    ensure_user_tables,
+    record_account_syncs,
+    replace_accounts,
+)
 from datetime import datetime, timezone, timedelta
+import os
+import threading
+import time
 from typing import Optional
-import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Callable, Iterator
+
+# Объединение одинаковых одновременных запросов к банкам
+transactions_flight = SingleFlight("transactions")
+consent_check_flight = SingleFlight("consent_check")
+consent_request_flight = SingleFlight("consent_request")
 
 
 def get_token_for_bank(bank_name: str, db_path: str = "bank_tokens.db"):
@@ -15,19 +39,8 @@ def get_token_for_bank(bank_name: str, db_path: str = "bank_tokens.db"):
     :return: access_token или None, если не найден
     """
     try:
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.cursor()
-
-            cursor.execute("""
-                SELECT access_token
-                FROM tokens
-                WHERE bank_name = ?
-                ORDER BY add_time DESC
-                LIMIT 1
-            """, (bank_name,))
-
-            result = cursor.fetchone()
-            return result[0] if result else None
+        # Один токен на (bank_name, client_id), поиск по первичному ключу
+        return get_token(bank_name, db_path)
     except sqlite3.OperationalError as e:
         print(f"Ошибка при работе с базой данных: {e}")
         return None
@@ -41,21 +54,11 @@ def sync_user_banks(user_name: str, bank_list: List[str], db_path: str = "users.
     :param bank_list: Список названий банков, которые сейчас используются
     :param db_path: Путь к файлу SQLite (по умолчанию "users.db")
     """
-    conn = sqlite3.connect(db_path)
+    conn = metrics.timed_connect(db_path)
     cursor = conn.cursor()
 
-    # Создаём таблицу, если не существует (с поддержкой is_active)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_banks (
-            user_name TEXT NOT NULL,
-            bank_name TEXT NOT NULL,
-            account_id TEXT,
-            consent_id TEXT,
-            is_active INTEGER NOT NULL DEFAULT 1,
-            PRIMARY KEY (user_name, bank_name)
-        )
-    """)
-    conn.commit()
+    # Создаём таблицы user_banks и accounts, если не существуют (или переносим старую схему)
+    ensure_user_tables(conn, db_path)
 
     # Получаем текущие банки пользователя из БД
     cursor.execute("SELECT bank_name FROM user_banks WHERE user_name = ?", (user_name,))
@@ -79,7 +82,7 @@ def sync_user_banks(user_name: str, bank_list: List[str], db_path: str = "users.
         else:
             # Добавляем новый банк как активный
             cursor.execute(
-                "INSERT INTO user_banks (user_name, bank_name, account_id, consent_id, is_active) VALUES (?, ?, NULL, NULL, 1)",
+                "INSERT INTO user_banks (user_name, bank_name, consent_id, is_active) VALUES (?, ?, NULL, 1)",
                 (user_name, bank)
             )
 
@@ -89,17 +92,23 @@ def sync_user_banks(user_name: str, bank_list: List[str], db_path: str = "users.
 
 # Выбор только активных банков
 def get_active_banks(user_name: str, db_path: str = "users.db"):
-    conn = sqlite3.connect(db_path)
+    """:return: Список (bank_name, consent_id, [account_id]) активных банков пользователя"""
+    accounts = bank_accounts(user_name, db_path)
+    conn = metrics.timed_connect(db_path)
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT bank_name, consent_id, account_id FROM user_banks WHERE user_name = ? AND is_active = 1",
+        "SELECT bank_name, consent_id FROM user_banks WHERE user_name = ? AND is_active = 1",
         (user_name,)
     )
-    result = cursor.fetchall()
+    result = [(bank_name, consent_id, accounts.get(bank_name, [])) for bank_name, consent_id in cursor.fetchall()]
     conn.close()
     return result
 
 
+# Сколько согласий запрашивать одновременно (по одному запросу на банк)
+CONSENT_REQUEST_WORKERS = 8
+
+
 # Сделать запрос на получение согласия у активных банков, у которых consent_id=NULL
 def update_missing_consents(
     user_name: str,
@@ -110,11 +119,11 @@ def update_missing_consents(
     """
     Создаёт согласия для активных банков пользователя, у которых нет consent_id.
 
-    Запрос отправляется на https://{bank_name}.open.bankingapi.ru
+    Запрос отправляется на bank_base_url(bank_name) (по умолчанию https://{bank_name}.open.bankingapi.ru)
     от имени requesting_bank (например, team089).
     """
     banks_needing_consent = []
-    with sqlite3.connect(db_path) as conn:
+    with metrics.timed_connect(db_path) as conn:
         cursor = conn.cursor()
 
         # Получаем активные банки без consent_id
@@ -128,58 +137,88 @@ def update_missing_consents(
     if not banks_needing_consent:
         return
 
+    # Токены всех банков — одним запросом
+    try:
+        tokens = get_tokens(banks_needing_consent, tokens_db_path)
+    except sqlite3.OperationalError as e:
+        print(f"Ошибка при работе с базой данных токенов для пользователя {user_name}: {e}")
+        return
+
+    requests_to_send = []
     for bank_name in banks_needing_consent:
-        try:
-            # Получаем access_token для целевого банка из базы токенов
-            acc_token = get_token_for_bank(bank_name, tokens_db_path)
-            if not acc_token:
-                print(f"⚠️ Не найден access_token для банка {bank_name}. Пропускаем.")
-                continue
+        if not tokens.get(bank_name):
+            print(f"⚠️ Не найден access_token для банка {bank_name}. Пропускаем.")
+            continue
+        requests_to_send.append(bank_name)
+    if not requests_to_send:
+        return
 
-            # Формируем base_url для целевого банка
-            base_url = f"https://{bank_name}.open.bankingapi.ru"
-
-            # Отправляем запрос на согласие
-            print(f"Отправляем запрос на согласие {user_name} по адресу {base_url}, acc_token={acc_token}")
-            response = AccountConsentsRequest(
-                client_id=user_name,
-                permissions=["ReadAccountsDetail", "ReadBalances", "ReadTransactionsDetail"],
-                reason="Автоматическое согласие для подключённого банка",
-                requesting_bank=requesting_bank,          # например, "team089"
-                requesting_bank_name="Team 089 Bank",
-                x_requesting_bank=requesting_bank,        # "team089"
-                access_token=acc_token,
-                base_url=base_url                         # ← ключевое: URL целевого банка
-            )
+    # Банки отвечают независимо — запрашиваем согласия параллельно, время ≈ самый медленный банк
+    consents = []
+    with ThreadPoolExecutor(max_workers=min(CONSENT_REQUEST_WORKERS, len(requests_to_send))) as executor:
+        futures = {
+            tracing.submit(executor, _request_consent, user_name, bank_name, tokens[bank_name], requesting_bank): bank_name
+            for bank_name in requests_to_send
+        }
+        for future in as_completed(futures):
+            bank_name = futures[future]
+            try:
+                consents.append((future.result(), user_name, bank_name))
+            except Exception as e:
+                print(f"⚠️ Ошибка при создании согласия для банка {bank_name} пользователя {user_name}: {e}")
+
+    if not consents:
+        return
+
+    # Все полученные согласия записываем одной транзакцией
+    try:
+        with metrics.timed_connect(db_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                UPDATE user_banks
+                SET consent_id = ?
+                WHERE user_name = ? AND bank_name = ?
+            """, consents)
+            conn.commit()
+    except sqlite3.OperationalError as e:
+        print(f"Ошибка при работе с базой данных у пользователя {user_name} при сохранении согласий: {e}")
 
-            status = response.get("status")
-            request_id = response.get("request_id")
-            consent_id_from_response = response.get("consent_id")
-            print(f"status={status}, request_id={request_id}, consent_id_from_response={consent_id_from_response}")
 
-            # Определяем, что сохранить в consent_id
-            if status == "approved":
-                db_consent_value = consent_id_from_response
-            elif status == "pending":
-                db_consent_value = request_id
-            else:
-                db_consent_value = request_id or None
-
-            # Обновляем БД
-            with sqlite3.connect(db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE user_banks
-                    SET consent_id = ?
-                    WHERE user_name = ? AND bank_name = ?
-                """, (db_consent_value, user_name, bank_name))
-                conn.commit()
-        
-        except sqlite3.OperationalError as e:
-            print(f"Ошибка при работе с базой данных у пользователя {user_name} для банка {bank_name}: {e}")
-        except Exception as e:
-            print(f"⚠️ Ошибка при создании согласия для банка {bank_name} пользователя {user_name}: {e}")
-            continue
+def _request_consent(user_name: str, bank_name: str, acc_token: str, requesting_bank: str) -> Optional[str]:
+    """
+    Отправляет запрос на согласие в банк.
+
+    :return: Значение для user_banks.consent_id (consent_id, если согласие одобрено сразу, иначе request_id)
+    """
+    # Формируем base_url для целевого банка
+    base_url = bank_base_url(bank_name)
+
+    # Отправляем запрос на согласие
+    print(f"Отправляем запрос на согласие {user_name} по адресу {base_url}, acc_token={acc_token}")
+    response = consent_request_flight.do(
+        (bank_name, user_name),
+        AccountConsentsRequest,
+        client_id=user_name,
+        permissions=["ReadAccountsDetail", "ReadBalances", "ReadTransactionsDetail"],
+        reason="Автоматическое согласие для подключённого банка",
+        requesting_bank=requesting_bank,          # например, "team089"
+        requesting_bank_name="Team 089 Bank",
+        x_requesting_bank=requesting_bank,        # "team089"
+        access_token=acc_token,
+        base_url=base_url                         # ← ключевое: URL целевого банка
+    )
+
+    status = response.get("status")
+    request_id = response.get("request_id")
+    consent_id_from_response = response.get("consent_id")
+    print(f"status={status}, request_id={request_id}, consent_id_from_response={consent_id_from_response}")
+
+    # Определяем, что сохранить в consent_id
+    if status == "approved":
+        return consent_id_from_response
+    if status == "pending":
+        return request_id
+    return request_id or None
 
 
 def waiting_for_approval(user_name: str, bank_name: str, consent_id: str, statuses_list: list):
@@ -195,6 +234,69 @@ def waiting_for_approval(user_name: str, bank_name: str, consent_id: str, status
     })
 
 
+def parse_expiration_datetime(expiration_str: Optional[str]) -> Optional[datetime]:
+    """Разбирает expirationDateTime согласия (ISO 8601 с 'Z', до 9 цифр дробной части) в aware datetime."""
+    if not expiration_str:
+        return None
+    # Обработка ISO 8601 с 'Z'
+    dt_str = expiration_str.replace('Z', '+00:00')
+    if '.' in dt_str and dt_str.count('.') == 1:
+        # Обрезаем до 6 цифр микросекунд, если нужно
+        main_part, micro = dt_str.split('.')
+        micro = micro.split('+')[0][:6].ljust(6, '0')
+        dt_str = f"{main_part}.{micro}+00:00"
+    return datetime.fromisoformat(dt_str)
+
+
+# За сколько секунд до expirationDateTime согласие продлевается в фоне (consent_scheduler)
+CONSENT_RENEW_AHEAD_SECONDS = int(os.environ.get("CONSENT_RENEW_AHEAD_SECONDS", str(3 * 24 * 3600)))
+
+
+def _ensure_consent_schedule_table(cursor):
+    """
+    Очередь продления согласий: индекс по next_check_at работает как постоянная min-куча —
+    ближайшие проверки берутся из его начала без просмотра всей таблицы.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS consent_schedule (
+            user_name TEXT NOT NULL,
+            bank_name TEXT NOT NULL,
+            consent_id TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            next_check_at INTEGER NOT NULL,
+            pending_request_id TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_name, bank_name)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_consent_schedule_next_check ON consent_schedule (next_check_at)")
+
+
+def schedule_consent_renewal(user_name: str, bank_name: str, consent_id: str, expiration_dt: datetime, db_path: str = "users.db"):
+    """
+    Ставит действующее согласие в очередь продления на expiration_dt - CONSENT_RENEW_AHEAD_SECONDS.
+    Для уже известного согласия очередь не сбрасывается — её ведёт consent_scheduler.
+    """
+    expires_at = int(expiration_dt.timestamp())
+    with metrics.timed_connect(db_path) as conn:
+        cursor = conn.cursor()
+        _ensure_consent_schedule_table(cursor)
+        cursor.execute("""
+            INSERT INTO consent_schedule (user_name, bank_name, consent_id, expires_at, next_check_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_name, bank_name) DO UPDATE SET
+                expires_at = excluded.expires_at,
+                next_check_at = CASE WHEN consent_schedule.consent_id = excluded.consent_id
+                                     THEN consent_schedule.next_check_at ELSE excluded.next_check_at END,
+                pending_request_id = CASE WHEN consent_schedule.consent_id = excluded.consent_id
+                                          THEN consent_schedule.pending_request_id ELSE NULL END,
+                attempts = CASE WHEN consent_schedule.consent_id = excluded.consent_id
+                                THEN consent_schedule.attempts ELSE 0 END,
+                consent_id = excluded.consent_id
+        """, (user_name, bank_name, consent_id, expires_at, expires_at - CONSENT_RENEW_AHEAD_SECONDS))
+        conn.commit()
+
+
 # После этой функции повторно запускаем update_missing_consents для обработки случая истечения сроков согласия
 def refresh_user_consents(
     user_name: str,
@@ -213,7 +315,7 @@ def refresh_user_consents(
     if statuses_list is None:
         statuses_list = []
 
-    conn = sqlite3.connect(db_path)
+    conn = metrics.timed_connect(db_path)
     cursor = conn.cursor()
 
     # Получаем ВСЕ активные банки с НЕПУСТЫМ consent_id
@@ -244,9 +346,11 @@ def refresh_user_consents(
                 })
                 continue
 
-            base_url = f"https://{bank_name}.open.bankingapi.ru"
+            base_url = bank_base_url(bank_name)
 
-            response = GetConsentByID(
+            response = consent_check_flight.do(
+                (bank_name, consent_id),
+                GetConsentByID,
                 consent_id=consent_id,
                 x_fapi_interaction_id=your_bank_id,
                 access_token=acc_token,
@@ -258,18 +362,7 @@ def refresh_user_consents(
             status = data.get("status")
             expiration_str = data.get("expirationDateTime")
 
-            # Парсим expirationDateTime
-            expiration_dt = None
-            if expiration_str:
-                # Обработка ISO 8601 с 'Z'
-                dt_str = expiration_str.replace('Z', '+00:00')
-                if '.' in dt_str and dt_str.count('.') == 1:
-                    # Обрезаем до 6 цифр микросекунд, если нужно
-                    main_part, micro = dt_str.split('.')
-                    micro = micro.split('+')[0][:6].ljust(6, '0')
-                    tz_part = dt_str.split('+')[-1]
-                    dt_str = f"{main_part}.{micro}+00:00"
-                expiration_dt = datetime.fromisoformat(dt_str)
+            expiration_dt = parse_expiration_datetime(expiration_str)
 
             now = datetime.now(timezone.utc)
 
@@ -289,6 +382,9 @@ def refresh_user_consents(
                 # Используем actual_consent_id, даже если он отличается (например, был req-, стал consent-)
                 if actual_consent_id and actual_consent_id.startswith("consent-"):
                     _update_consent_in_db(user_name, bank_name, actual_consent_id, db_path)
+                    if expiration_dt:
+                        # Срок попадает в очередь consent_scheduler — продление пройдёт в фоне до истечения
+                        schedule_consent_renewal(user_name, bank_name, actual_consent_id, expiration_dt, db_path)
                     if actual_consent_id != consent_id:
                         print(f"✅ Согласие обновлено: {consent_id} → {actual_consent_id} для {bank_name}")
                     else:
@@ -335,29 +431,133 @@ def refresh_user_consents(
 
 def _update_consent_in_db(user_name: str, bank_name: str, new_consent_id: str | None, db_path: str):
     """Вспомогательная функция для обновления consent_id в БД."""
-    conn = sqlite3.connect(db_path)
+    conn = metrics.timed_connect(db_path)
     cursor = conn.cursor()
     cursor.execute("""
         UPDATE user_banks
         SET consent_id = ?
         WHERE user_name = ? AND bank_name = ?
     """, (new_consent_id, user_name, bank_name))
+    # Список счетов привязан к согласию — при смене согласия его нужно запросить заново
+    invalidate_accounts_cache(user_name, bank_name, keep_consent_id=new_consent_id)
+    if new_consent_id is None:
+        # Сброшенное согласие продлевать нечего — его заново создаст update_missing_consents
+        _ensure_consent_schedule_table(cursor)
+        cursor.execute("DELETE FROM consent_schedule WHERE user_name = ? AND bank_name = ?", (user_name, bank_name))
     conn.commit()
     conn.close()
 
 
+# Сколько банков опрашивать одновременно при загрузке счетов и транзакций
+BANK_FETCH_WORKERS = 8
+
+# Банк не уложился в таймаут запроса или в бюджет времени эндпоинта
+BANK_TIMEOUT_ERRORS = (requests.Timeout, DeadlineExceeded)
+
+
+def _report_skipped_bank(skipped_banks: Optional[list], bank_name: str, reason: str):
+    """Добавляет банк в список пропущенных (один раз на банк)."""
+    if skipped_banks is None or any(item['bank_name'] == bank_name for item in skipped_banks):
+        return
+    skipped_banks.append({'bank_name': bank_name, 'reason': reason})
+
+
+def _iter_banks(calls: Dict[str, Callable[[], Any]], skipped_banks: Optional[list] = None) -> Iterator[Tuple[str, Any]]:
+    """
+    Выполняет загрузки по банкам параллельно и выдаёт результаты по мере готовности, не дольше дедлайна запроса.
+
+    Банк, не успевший к дедлайну или упавший с ошибкой, попадает в skipped_banks
+    с причиной 'deadline' или 'error'; его поток дорабатывает в фоне (ограничен таймаутом запроса),
+    а результат отбрасывается.
+
+    :param calls: bank_name -> функция без аргументов, загружающая данные банка
+    :param skipped_banks: Список, куда добавляются словари {'bank_name', 'reason'}
+    :return: Итератор пар (bank_name, результат) в порядке завершения
+    """
+    if not calls:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=min(BANK_FETCH_WORKERS, len(calls)))
+    futures = {tracing.submit(executor, call): bank_name for bank_name, call in calls.items()}
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=deadline.remaining()):
+            pending.discard(future)
+            bank_name = futures[future]
+            try:
+                result = future.result()
+            except BANK_TIMEOUT_ERRORS as e:
+                print(f"⚠️ Банк {bank_name} не уложился в бюджет времени запроса: {e}")
+                _report_skipped_bank(skipped_banks, bank_name, 'deadline')
+                continue
+            except Exception as e:
+                print(f"❌ Ошибка при загрузке данных банка {bank_name}: {e}")
+                _report_skipped_bank(skipped_banks, bank_name, 'error')
+                continue
+            yield bank_name, result
+    except FuturesTimeoutError:
+        pass
+    finally:
+        # Не ждём зависшие банки: незапущенные задачи отменяются, запущенные завершатся по таймауту
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for future in pending:
+        bank_name = futures[future]
+        print(f"⚠️ Банк {bank_name} не ответил до дедлайна запроса, продолжаем без него")
+        _report_skipped_bank(skipped_banks, bank_name, 'deadline')
+
+
+# Сколько секунд сохранённый список счетов считается актуальным для того же согласия
+ACCOUNTS_CACHE_TTL_SECONDS = int(os.environ.get("ACCOUNTS_CACHE_TTL_SECONDS", "3600"))
+
+# (user_name, bank_name, consent_id) -> время (time.monotonic) загрузки списка счетов в таблицу accounts
+_accounts_fetched_at: Dict[Tuple[str, str, str], float] = {}
+_accounts_cache_lock = threading.Lock()
+
+
+def _accounts_cache_fresh(user_name: str, bank_name: str, consent_id: str) -> bool:
+    with _accounts_cache_lock:
+        fetched_at = _accounts_fetched_at.get((user_name, bank_name, consent_id))
+    return fetched_at is not None and time.monotonic() - fetched_at < ACCOUNTS_CACHE_TTL_SECONDS
+
+
+def _mark_accounts_fetched(user_name: str, bank_name: str, consent_id: str):
+    with _accounts_cache_lock:
+        _accounts_fetched_at[(user_name, bank_name, consent_id)] = time.monotonic()
+
+
+def invalidate_accounts_cache(user_name: str, bank_name: Optional[str] = None, keep_consent_id: Optional[str] = None):
+    """
+    Сбрасывает кеш списка счетов: следующий fetch_and_store_accounts запросит его у банка.
+
+    :param user_name: Имя пользователя
+    :param bank_name: Банк; None — все банки пользователя
+    :param keep_consent_id: Согласие, запись которого сохраняется (подтверждено то же согласие)
+    """
+    with _accounts_cache_lock:
+        for key in [k for k in _accounts_fetched_at
+                    if k[0] == user_name and (bank_name is None or k[1] == bank_name) and k[2] != keep_consent_id]:
+            del _accounts_fetched_at[key]
+
+
 # Заполняем номера счетов в БД (после проверок валидности consent_id)
 def fetch_and_store_accounts(
     user_name: str,
     your_bank_id: str = "team089",
     db_path: str = "users.db",
-    tokens_db_path: str = "bank_tokens.db"
+    tokens_db_path: str = "bank_tokens.db",
+    skipped_banks: list = None
 ):
     """
     Запрашивает список счетов у всех активных банков пользователя,
-    где consent_id начинается с 'consent-', и сохраняет accountId в БД.
+    где consent_id начинается с 'consent-', и сохраняет счета в таблицу accounts.
+
+    Если список для того же согласия загружен не раньше ACCOUNTS_CACHE_TTL_SECONDS назад,
+    запрос GetAccountsList к банку пропускается. Раньше срока список запрашивается заново только при смене
+    согласия и после ответа 403/404 по сохранённому счёту; новый счёт появится в списке не позже чем через TTL. Банки опрашиваются параллельно до дедлайна запроса;
+    не успевшие и упавшие банки добавляются в skipped_banks.
     """
-    conn = sqlite3.connect(db_path)
+    conn = metrics.timed_connect(db_path)
     cursor = conn.cursor()
 
     # Получаем активные банки с валидным consent_id
@@ -375,52 +575,352 @@ def fetch_and_store_accounts(
     if not valid_banks:
         return
 
+    stored_accounts = bank_accounts(user_name, db_path)
+    calls = {}
     for bank_name, consent_id in valid_banks:
-        try:
-            # Получаем access_token для целевого банка из базы токенов
-            acc_token = get_token_for_bank(bank_name, tokens_db_path)
-            if not acc_token:
-                print(f"⚠️ Не найден access_token для банка {bank_name}. Пропускаем получение счетов.")
+        if stored_accounts.get(bank_name) and _accounts_cache_fresh(user_name, bank_name, consent_id):
+            metrics.cache_hit("accounts")
+            continue
+        metrics.cache_miss("accounts")
+        calls[bank_name] = functools.partial(
+            _fetch_bank_accounts, user_name, bank_name, consent_id, your_bank_id, db_path, tokens_db_path
+        )
+
+    # Счета сохраняет сам _fetch_bank_accounts — здесь только ждём банки до дедлайна
+    for _ in _iter_banks(calls, skipped_banks):
+        pass
+
+
+def _fetch_bank_accounts(user_name: str, bank_name: str, consent_id: str, your_bank_id: str,
+                         db_path: str, tokens_db_path: str):
+    """Запрашивает список счетов одного банка и сохраняет его в таблицу accounts."""
+    # Получаем access_token для целевого банка из базы токенов
+    acc_token = get_token_for_bank(bank_name, tokens_db_path)
+    if not acc_token:
+        print(f"⚠️ Не найден access_token для банка {bank_name}. Пропускаем получение счетов.")
+        return
+
+    base_url = bank_base_url(bank_name)
+
+    # Запрашиваем счета
+    response = GetAccountsList(
+        client_id=user_name,
+        consent_id=consent_id,
+        x_requesting_bank=your_bank_id,
+        access_token=acc_token,
+        base_url=base_url
+    )
+
+    # Извлекаем accountId из ответа
+    accounts_data = response.get("data", {}).get("account", [])
+    account_ids = [acc.get("accountId") for acc in accounts_data if acc.get("accountId")]
+
+    # Обновляем БД: закрытые счета удаляются, курсоры остальных сохраняются
+    replace_accounts(user_name, bank_name, consent_id, account_ids, db_path)
+    _mark_accounts_fetched(user_name, bank_name, consent_id)
+    print(f"✅ Сохранено {len(account_ids)} счёт(ов) для банка {bank_name}: {account_ids}")
+
+
+# Размеры страницы, которые пробуем при запросе транзакций (от большего к меньшему)
+PAGE_SIZE_CANDIDATES = (1000, 500, 200, 100)
+
+# Количество потоков для параллельной загрузки страниц 2..N
+TRANSACTIONS_PREFETCH_WORKERS = 8
+
+# Запомненный максимальный limit для каждого банка: bank_name -> limit
+_bank_page_limits: Dict[str, int] = {}
+
+# Ответы банка на запрос по сохранённому счёту, после которых список счетов считается устаревшим
+ACCOUNT_GONE_STATUSES = (403, 404)
+
+
+class AccountUnavailable(Exception):
+    """Банк ответил 403/404 по сохранённому счёту: счёт закрыт или больше не входит в согласие."""
+
+
+def _find_pagination_meta(response: dict) -> dict:
+    """
+    Ищет блок метаданных пагинации в ответе банка.
+    Поддерживает варианты meta/Meta/pagination как на верхнем уровне, так и внутри data.
+    """
+    containers = [response, response.get("data") or {}]
+    for container in containers:
+        if not isinstance(container, dict):
+            continue
+        for key in ("meta", "Meta", "pagination"):
+            meta = container.get(key)
+            if isinstance(meta, dict):
+                return meta
+    return {}
+
+
+def _extract_total_pages(response: dict, limit: int) -> Optional[int]:
+    """
+    Определяет общее количество страниц по метаданным ответа.
+
+    :param response: Ответ GetAccountTransactionHistory
+    :param limit: Размер страницы, с которым был сделан запрос
+    :return: Количество страниц или None, если банк его не сообщает
+    """
+    meta = _find_pagination_meta(response)
+
+    for key in ("totalPages", "total_pages", "TotalPages"):
+        if meta.get(key) is not None:
+            try:
+                return int(meta[key])
+            except (TypeError, ValueError):
+                pass
+
+    for key in ("totalRecords", "total_records", "totalCount", "total_count", "total", "TotalRecords"):
+        if meta.get(key) is not None:
+            try:
+                total = int(meta[key])
+            except (TypeError, ValueError):
                 continue
+            return max(1, -(-total // limit))
 
-            base_url = f"https://{bank_name}.open.bankingapi.ru"
+    return None
 
-            # Запрашиваем счета
-            response = GetAccountsList(
-                client_id=user_name,
-                consent_id=consent_id,
-                x_requesting_bank=your_bank_id,
-                access_token=acc_token,
-                base_url=base_url
-            )
 
-            # Извлекаем accountId из ответа
-            accounts_data = response.get("data", {}).get("account", [])
-            account_ids = [acc.get("accountId") for acc in accounts_data if acc.get("accountId")]
+def _extract_total_records(response: dict) -> Optional[int]:
+    """Возвращает общее количество транзакций из метаданных, если банк его сообщает."""
+    meta = _find_pagination_meta(response)
+    for key in ("totalRecords", "total_records", "totalCount", "total_count", "total", "TotalRecords"):
+        if meta.get(key) is not None:
+            try:
+                return int(meta[key])
+            except (TypeError, ValueError):
+                continue
+    return None
 
-            # Сохраняем как JSON-строку (или NULL, если счетов нет)
-            account_ids_json = json.dumps(account_ids, ensure_ascii=False) if account_ids else None
 
-            # Обновляем БД
-            _update_account_ids_in_db(user_name, bank_name, account_ids_json, db_path)
-            print(f"✅ Сохранено {len(account_ids)} счёт(ов) для банка {bank_name}: {account_ids}")
+def _has_next_link(response: dict) -> Optional[bool]:
+    """
+    Проверяет наличие ссылки на следующую страницу (links.next / Links.Next).
 
-        except Exception as e:
-            print(f"❌ Ошибка при получении счетов для банка {bank_name}: {e}")
+    :return: True/False, если блок ссылок присутствует, иначе None
+    """
+    for container in (response, response.get("data") or {}):
+        if not isinstance(container, dict):
             continue
+        for key in ("links", "Links"):
+            links = container.get(key)
+            if isinstance(links, dict):
+                return bool(links.get("next") or links.get("Next"))
+    return None
+
+
+def _fetch_transactions_page(
+    bank_name: str,
+    acc_id: str,
+    consent_id: str,
+    from_date: str,
+    to_date: str,
+    page: int,
+    limit: int,
+    your_bank_id: str,
+    acc_token: str,
+    base_url: str
+) -> dict:
+    """Запрашивает одну страницу транзакций по счёту."""
+    return GetAccountTransactionHistory(
+        account_id=acc_id,
+        consent_id=consent_id,
+        from_booking_date_time=from_date,
+        to_booking_date_time=to_date,
+        page=page,
+        limit=limit,
+        x_requesting_bank=your_bank_id,
+        access_token=acc_token,
+        base_url=base_url
+    )
 
 
-def _update_account_ids_in_db(user_name: str, bank_name: str, account_ids_json: str | None, db_path: str):
-    """Вспомогательная функция для обновления account_id в БД."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE user_banks
-        SET account_id = ?
-        WHERE user_name = ? AND bank_name = ?
-    """, (account_ids_json, user_name, bank_name))
-    conn.commit()
-    conn.close()
+def _fetch_first_page_adaptive(
+    bank_name: str,
+    acc_id: str,
+    consent_id: str,
+    from_date: str,
+    to_date: str,
+    your_bank_id: str,
+    acc_token: str,
+    base_url: str,
+    page_size: Optional[int] = None
+):
+    """
+    Запрашивает первую страницу с максимальным limit, который принимает банк.
+
+    Если page_size не задан, начинаем с запомненного для банка значения (или с наибольшего кандидата)
+    и уменьшаем limit, пока банк отвечает 400/422. Если банк молча урезает страницу
+    (вернул меньше, чем просили, но по метаданным страниц больше), запоминаем фактический размер.
+
+    Короткая первая страница без метаданных и ссылок неоднозначна: данных может больше не быть,
+    а может быть, банк урезал limit. Тогда фактическим limit считается длина страницы, а подтвердить его
+    (и запомнить для банка) должна непустая вторая страница — см. _fetch_account_transactions.
+
+    :return: Кортеж (ответ, фактический limit, подтверждён ли limit)
+    """
+    if page_size:
+        candidates = [page_size]
+    else:
+        if bank_name in _bank_page_limits:
+            metrics.cache_hit("page_limit")
+        else:
+            metrics.cache_miss("page_limit")
+        start = _bank_page_limits.get(bank_name, PAGE_SIZE_CANDIDATES[0])
+        candidates = [start] + [c for c in PAGE_SIZE_CANDIDATES if c < start]
+
+    last_error = None
+    for limit in candidates:
+        try:
+            response = _fetch_transactions_page(
+                bank_name, acc_id, consent_id, from_date, to_date,
+                1, limit, your_bank_id, acc_token, base_url
+            )
+        except requests.HTTPError as e:
+            status_code = e.response.status_code if e.response is not None else None
+            if status_code in (400, 422) and limit != candidates[-1]:
+                print(f"⚠️ Банк {bank_name} не принял limit={limit}, пробуем меньше")
+                last_error = e
+                continue
+            raise
+
+        transactions = response.get("data", {}).get("transaction", [])
+        effective_limit = limit
+        confirmed = True
+        total_pages = _extract_total_pages(response, limit)
+        has_next = _has_next_link(response)
+        if transactions and len(transactions) < limit:
+            if (total_pages or 1) > 1 or has_next:
+                # Банк урезал страницу до своего максимума
+                effective_limit = len(transactions)
+            elif total_pages is None and has_next is None and _bank_page_limits.get(bank_name) != limit:
+                # Без метаданных конец данных не отличить от урезанной страницы — проверяем второй страницей
+                effective_limit = len(transactions)
+                confirmed = False
+
+        if not page_size and confirmed:
+            _bank_page_limits[bank_name] = effective_limit
+        return response, effective_limit, confirmed
+
+    raise last_error
+
+
+def _fetch_account_transactions(
+    bank_name: str,
+    acc_id: str,
+    consent_id: str,
+    from_date: str,
+    to_date: str,
+    your_bank_id: str,
+    acc_token: str,
+    base_url: str,
+    page_size: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Получает все транзакции по одному счёту.
+
+    Первая страница запрашивается с адаптивным limit. Если из метаданных известно количество страниц,
+    страницы 2..N загружаются параллельно, иначе — последовательно по ссылке next или до короткой страницы.
+
+    :raises AccountUnavailable: Банк ответил 403/404 на первую страницу — счёта нет в согласии
+    """
+    try:
+        response, limit, limit_confirmed = _fetch_first_page_adaptive(
+            bank_name, acc_id, consent_id, from_date, to_date,
+            your_bank_id, acc_token, base_url, page_size
+        )
+    except BANK_TIMEOUT_ERRORS:
+        # Банк не уложился в бюджет — решение о пропуске банка принимает fetch_all_transactions
+        raise
+    except requests.HTTPError as e:
+        print(f"❌ Ошибка на странице 1 для счёта {acc_id} в {bank_name}: {e}")
+        if e.response is not None and e.response.status_code in ACCOUNT_GONE_STATUSES:
+            raise AccountUnavailable(acc_id) from e
+        return []
+    except Exception as e:
+        print(f"❌ Ошибка на странице 1 для счёта {acc_id} в {bank_name}: {e}")
+        return []
+
+    transactions = response.get("data", {}).get("transaction", [])
+    if not transactions:
+        print(f"Закончен прием транзакций по счету {acc_id} в {bank_name}")
+        return []
+
+    pages = {1: transactions}
+    print(f"✅ Страница 1 (limit={limit}): получено {len(transactions)} транзакций по счёту {acc_id} в {bank_name}")
+
+    total_records = _extract_total_records(response)
+    total_pages = -(-total_records // limit) if total_records is not None else _extract_total_pages(response, limit)
+
+    if total_pages is not None:
+        # Количество страниц известно — догружаем оставшиеся параллельно
+        if total_pages > 1:
+            with ThreadPoolExecutor(max_workers=min(TRANSACTIONS_PREFETCH_WORKERS, total_pages - 1)) as executor:
+                futures = {
+                    tracing.submit(
+                        executor,
+                        _fetch_transactions_page,
+                        bank_name, acc_id, consent_id, from_date, to_date,
+                        page, limit, your_bank_id, acc_token, base_url
+                    ): page
+                    for page in range(2, total_pages + 1)
+                }
+                for future in as_completed(futures):
+                    page = futures[future]
+                    try:
+                        pages[page] = future.result().get("data", {}).get("transaction", [])
+                        print(f"✅ Страница {page}: получено {len(pages[page])} транзакций по счёту {acc_id} в {bank_name}")
+                    except BANK_TIMEOUT_ERRORS:
+                        raise
+                    except Exception as e:
+                        print(f"❌ Ошибка на странице {page} для счёта {acc_id} в {bank_name}: {e}")
+    else:
+        # Количество страниц неизвестно — идём последовательно
+        page = 1
+        while True:
+            has_next = _has_next_link(response)
+            if has_next is False or (has_next is None and len(pages[page]) < limit):
+                print(f"Получена последняя страница транзакций по счету {acc_id} в {bank_name}")
+                break
+
+            page += 1
+            try:
+                response = _fetch_transactions_page(
+                    bank_name, acc_id, consent_id, from_date, to_date,
+                    page, limit, your_bank_id, acc_token, base_url
+                )
+            except BANK_TIMEOUT_ERRORS:
+                raise
+            except Exception as e:
+                print(f"❌ Ошибка на странице {page} для счёта {acc_id} в {bank_name}: {e}")
+                break
+
+            transactions = response.get("data", {}).get("transaction", [])
+            if not transactions:
+                print(f"Закончен прием транзакций по счету {acc_id} в {bank_name}")
+                break
+
+            pages[page] = transactions
+            print(f"✅ Страница {page}: получено {len(transactions)} транзакций по счёту {acc_id} в {bank_name}")
+            if not limit_confirmed:
+                # За короткой первой страницей нашлись данные — банк урезает limit до этого размера
+                limit_confirmed = True
+                if not page_size:
+                    _bank_page_limits[bank_name] = limit
+                print(f"⚠️ Банк {bank_name} урезает страницу транзакций до {limit}")
+
+    metrics.TRANSACTION_PAGES.observe(len(pages), bank=bank_name)
+
+    account_transactions = []
+    for page in sorted(pages):
+        for tx in pages[page]:
+            # Добавляем мета-информацию
+            tx["_bank_name"] = bank_name
+            tx["_account_id"] = acc_id
+        account_transactions.extend(pages[page])
+
+    return account_transactions
 
 
 # Собираем транзакции из всех банков
@@ -431,101 +931,121 @@ def fetch_all_transactions(
     your_bank_id: str = "team089",
     db_path: str = "users.db",
     tokens_db_path: str = "bank_tokens.db",
-    page_size: int = 100
+    page_size: Optional[int] = None,
+    skipped_banks: list = None
 ) -> List[Dict[str, Any]]:
     """
     Получает ВСЕ транзакции пользователя со всех его счетов во всех подключённых банках,
     с поддержкой пагинации.
 
+    Банки загружаются параллельно и не дольше дедлайна текущего запроса (deadline.budget):
+    транзакции банков, не успевших к дедлайну или упавших с ошибкой, не попадают в результат,
+    а сами банки добавляются в skipped_banks.
+
     :param user_name: Имя пользователя
     :param from_date: Начало периода (ISO 8601, UTC)
     :param to_date: Конец периода (ISO 8601, UTC)
     :param your_bank_id: Идентификатор вашего банка (для заголовков)
     :param db_path: Путь к SQLite базе
     :param tokens_db_path: Путь к базе с токенами
-    :param page_size: Количество транзакций на странице (по умолчанию 100)
+    :param page_size: Количество транзакций на странице (по умолчанию подбирается максимальное для банка)
+    :param skipped_banks: Список, куда добавляются словари {'bank_name', 'reason'} пропущенных банков
     :return: Список всех транзакций с мета-полями _bank_name и _account_id
     """
+    by_bank = dict(iter_bank_transactions(
+        user_name, from_date, to_date, your_bank_id, db_path, tokens_db_path, page_size, skipped_banks
+    ))
+
+    # Порядок банков — по имени, как в БД, независимо от того, кто ответил первым
     all_transactions = []
+    for bank_name in sorted(by_bank):
+        all_transactions.extend(by_bank[bank_name])
+    return all_transactions
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
 
-    # Получаем активные банки с валидным consent_id и непустым account_id
-    cursor.execute("""
-        SELECT bank_name, consent_id, account_id
-        FROM user_banks
-        WHERE user_name = ? AND is_active = 1
-          AND consent_id IS NOT NULL AND consent_id LIKE 'consent-%'
-          AND account_id IS NOT NULL
-    """, (user_name,))
+def iter_bank_transactions(
+    user_name: str,
+    from_date: str = "2025-01-01T00:00:00Z",
+    to_date: str = "2025-12-31T23:59:59Z",
+    your_bank_id: str = "team089",
+    db_path: str = "users.db",
+    tokens_db_path: str = "bank_tokens.db",
+    page_size: Optional[int] = None,
+    skipped_banks: list = None
+) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    То же, что fetch_all_transactions, но выдаёт транзакции по банку сразу, как только банк загружен.
 
-    bank_rows = cursor.fetchall()
-    conn.close()
+    :return: Итератор пар (bank_name, транзакции банка) в порядке завершения загрузки
+    """
+    # Активные банки с валидным consent_id и их счета — одним запросом
+    bank_rows = active_bank_accounts(user_name, db_path)
 
     if not bank_rows:
         print(f"bank_rows у {user_name} пусто")
 
-    for bank_name, consent_id, account_ids_json in bank_rows:
-        try:
-            account_ids = json.loads(account_ids_json)
-        except (json.JSONDecodeError, TypeError):
-            print(f"⚠️ Некорректный account_id для банка {bank_name}: {account_ids_json}")
-            continue
+    calls = {
+        bank_name: functools.partial(
+            _fetch_bank_transactions, user_name, bank_name, consent_id, account_ids,
+            from_date, to_date, your_bank_id, tokens_db_path, page_size
+        )
+        for bank_name, consent_id, account_ids in bank_rows
+    }
+    for bank_name, (bank_transactions, synced_accounts) in _iter_banks(calls, skipped_banks):
+        # Курсоры и время синхронизации счетов банка — одной транзакцией
+        record_account_syncs(user_name, synced_accounts, db_path)
+        yield bank_name, bank_transactions
 
-        if not account_ids:
-            print(f"Нет account_ids для {bank_name} у {user_name}")
-            continue
 
-        # Получаем access_token для целевого банка из базы токенов
-        acc_token = get_token_for_bank(bank_name, tokens_db_path)
-        if not acc_token:
-            print(f"⚠️ Не найден access_token для банка {bank_name}. Пропускаем получение транзакций.")
-            continue
+def _fetch_bank_transactions(
+    user_name: str,
+    bank_name: str,
+    consent_id: str,
+    account_ids: List[str],
+    from_date: str,
+    to_date: str,
+    your_bank_id: str,
+    tokens_db_path: str,
+    page_size: Optional[int]
+) -> Tuple[List[Dict[str, Any]], List[Tuple[str, str, Optional[str]]]]:
+    """
+    Загружает транзакции по всем счетам одного банка.
 
-        base_url = f"https://{bank_name}.open.bankingapi.ru"
-
-        for acc_id in account_ids:
-            page = 1
-            while True:
-                try:
-                    response = GetAccountTransactionHistory(
-                        account_id=acc_id,
-                        consent_id=consent_id,
-                        from_booking_date_time=from_date,
-                        to_booking_date_time=to_date,
-                        page=page,
-                        limit=page_size,
-                        x_requesting_bank=your_bank_id,
-                        access_token=acc_token,
-                        base_url=base_url
-                    )
-
-                    transactions = response.get("data", {}).get("transaction", [])
-                    if not transactions:
-                        print(f"Закончен прием транзакций по счету {acc_id} в {bank_name}")
-                        break  # Больше нет данных
-
-                    # Добавляем мета-информацию
-                    for tx in transactions:
-                        tx["_bank_name"] = bank_name
-                        tx["_account_id"] = acc_id
-
-                    all_transactions.extend(transactions)
-                    print(f"✅ Страница {page}: получено {len(transactions)} транзакций по счёту {acc_id} в {bank_name}")
-
-                    # Если получено меньше, чем limit — значит, это последняя страница
-                    if len(transactions) < page_size:
-                        print(f"Получена последняя страница транзакций по счету {acc_id} в {bank_name}")
-                        break
-
-                    page += 1
-
-                except Exception as e:
-                    print(f"❌ Ошибка на странице {page} для счёта {acc_id} в {bank_name}: {e}")
-                    break  # Прерываем пагинацию для этого счёта
+    :return: Кортеж (транзакции, [(bank_name, account_id, курсор)] для record_account_syncs)
+    """
+    bank_transactions = []
+    synced_accounts = []
+
+    # Получаем access_token для целевого банка из базы токенов
+    acc_token = get_token_for_bank(bank_name, tokens_db_path)
+    if not acc_token:
+        print(f"⚠️ Не найден access_token для банка {bank_name}. Пропускаем получение транзакций.")
+        return bank_transactions, synced_accounts
+
+    base_url = bank_base_url(bank_name)
+
+    for acc_id in account_ids:
+        # Одинаковые одновременные загрузки (повторный запрос, перезагрузка страницы) делят один результат
+        flight_key = (bank_name, acc_id, consent_id, from_date, to_date, page_size)
+        with tracing.span("fetch_account_transactions", bank=bank_name, account_id=acc_id):
+            try:
+                account_transactions = transactions_flight.do(
+                    flight_key, _fetch_account_transactions,
+                    bank_name, acc_id, consent_id, from_date, to_date,
+                    your_bank_id, acc_token, base_url, page_size
+                )
+            except AccountUnavailable:
+                # Сохранённый счёт закрыт или выпал из согласия — список счетов устарел,
+                # следующий fetch_and_store_accounts запросит его у банка заново
+                print(f"⚠️ Счёт {acc_id} недоступен в {bank_name}: список счетов будет обновлён")
+                invalidate_accounts_cache(user_name, bank_name)
+                continue
+        bank_transactions.extend(account_transactions)
+        if account_transactions:
+            cursor = max(tx.get("bookingDateTime") or "" for tx in account_transactions) or None
+            synced_accounts.append((bank_name, acc_id, cursor))
 
-    return all_transactions
+    return bank_transactions, synced_accounts
 
 
 # Для дебага: печатает содержимое БД пользователя по имени
@@ -536,12 +1056,15 @@ def print_user_banks_info(user_name: str, db_path: str = "users.db"):
     :param user_name: Имя пользователя
     :param db_path: Путь к файлу SQLite базы
     """
-    conn = sqlite3.connect(db_path)
+    accounts = bank_accounts(user_name, db_path)
+    sync_state = account_sync_state(user_name, db_path)
+
+    conn = metrics.timed_connect(db_path)
     cursor = conn.cursor()
 
     # Получаем все записи пользователя
     cursor.execute("""
-        SELECT bank_name, account_id, consent_id, is_active
+        SELECT bank_name, consent_id, is_active
         FROM user_banks
         WHERE user_name = ?
         ORDER BY bank_name
@@ -556,14 +1079,20 @@ def print_user_banks_info(user_name: str, db_path: str = "users.db"):
 
     print(f"🏦 Информация о пользователе: {user_name}")
     print("-" * 80)
-    print(f"{'Банк':<15} {'Активен':<8} {'Consent ID / Request ID':<30} {'Account ID(s)':<20}")
+    print(f"{'Банк':<15} {'Активен':<8} {'Consent ID / Request ID':<30} {'Account ID(s)':<20} {'Синхронизация'}")
     print("-" * 80)
 
-    for bank_name, account_id, consent_id, is_active in rows:
+    for bank_name, consent_id, is_active in rows:
         status = "✅ Да" if is_active else "❌ Нет"
         consent = consent_id if consent_id else "—"
-        accounts = account_id if account_id else "—"
-        print(f"{bank_name:<15} {status:<8} {consent:<30} {accounts:<20}")
+        account_ids = accounts.get(bank_name) or ["—"]
+        for i, account_id in enumerate(account_ids):
+            _, last_synced_at = sync_state.get((bank_name, account_id), (None, None))
+            synced = datetime.fromtimestamp(last_synced_at, timezone.utc).strftime("%Y-%m-%d %H:%M") if last_synced_at else "—"
+            if i == 0:
+                print(f"{bank_name:<15} {status:<8} {consent:<30} {account_id:<20} {synced}")
+            else:
+                print(f"{'':<15} {'':<8} {'':<30} {account_id:<20} {synced}")
 
     print("-" * 80)
 
@@ -1,6 +1,17 @@
 from preparation import *
-from cashbacks_process import *
 from banks_access import *
+import os
+import deadline
+import tracing
+
+# Анализ тянет pandas, openpyxl и pyarrow (cashbacks_process, prediction_state, transaction_archive).
+# Они импортируются при первом анализе или в warm_up, чтобы воркер API стартовал без них.
+CASHBACKS_FILE = "Cashbacks.xlsx"
+
+# Часть бюджета запроса, которую оставляем на расчёт после загрузки данных из банков (секунды)
+ANALYSIS_COMPUTE_RESERVE_SECONDS = float(os.environ.get("ANALYSIS_COMPUTE_RESERVE_SECONDS", "3"))
+# Доля бюджета загрузки на списки счетов: зависший GetAccountsList не должен съесть время на транзакции
+ACCOUNTS_BUDGET_SHARE = 0.3
 
 #sync_user_banks("team089-1", ["sbank", "abank"])
 
@@ -30,6 +41,7 @@ def has_expired_bank(statuses_list: list) -> bool:
     """
     return any(item.get('status') == 'expired' for item in statuses_list if isinstance(item, dict))
 
+@tracing.traced()
 def push_consents_to_banks(user_name: str, banks_list: list):
     update_expired_tokens()
     sync_user_banks(user_name, banks_list)
@@ -43,10 +55,106 @@ def push_consents_to_banks(user_name: str, banks_list: list):
 
     return statuses_list
 
-def analyze_best_cashbacks(user_name: str):
-    fetch_and_store_accounts(user_name)
-    transactions_data = fetch_all_transactions(user_name)
-    l = extract_columns_from_excel("Cashbacks.xlsx")
-    df = json_transactions_to_best_cashbacks(transactions_data, "Cashbacks.xlsx", "2025-10-01")
-    return process_dataframe_and_rules(df, l)
+def warm_up():
+    """
+    Импортирует тяжёлые модули анализа и читает каталог кешбеков в кеш,
+    чтобы первый запрос анализа не платил за это. Вызывается в фоне при старте API.
+    """
+    with tracing.span("warm_up"):
+        from cashbacks_process import extract_columns_from_excel
+        import prediction_state
+        import transaction_archive
+        if os.path.exists(CASHBACKS_FILE):
+            extract_columns_from_excel(CASHBACKS_FILE)
+
+
+def analyze_best_cashbacks(user_name: str, skipped_banks: list = None):
+    """
+    Подбирает лучшие кешбеки пользователя по транзакциям из всех подключённых банков.
+
+    Если вызов идёт внутри deadline.budget, загрузка из банков укладывается в бюджет
+    за вычетом ANALYSIS_COMPUTE_RESERVE_SECONDS; банки, не успевшие к дедлайну, пропускаются
+    и добавляются в skipped_banks, а анализ строится по пришедшим данным.
+
+    :param user_name: Имя пользователя
+    :param skipped_banks: Список, куда добавляются словари {'bank_name', 'reason'} пропущенных банков
+    :return: Рекомендации process_dataframe_and_rules
+    """
+    from cashbacks_process import extract_columns_from_excel
+
+    # Каждый этап — отдельный span; трасса сохраняется в tracing.TRACE_DIR
+    with tracing.span("analyze_best_cashbacks", user=user_name):
+        with deadline.reserve(ANALYSIS_COMPUTE_RESERVE_SECONDS):
+            with tracing.span("fetch_and_store_accounts"), deadline.share(ACCOUNTS_BUDGET_SHARE):
+                fetch_and_store_accounts(user_name, skipped_banks=skipped_banks)
+            with tracing.span("fetch_all_transactions") as stage:
+                transactions_data = fetch_all_transactions(user_name, skipped_banks=skipped_banks)
+                if stage:
+                    stage.set_attribute("transactions", len(transactions_data))
+        with tracing.span("extract_columns_from_excel"):
+            l = extract_columns_from_excel(CASHBACKS_FILE)
+        state = _ingest_transactions(user_name, transactions_data, l)
+        return _recommendations(state, l)
+
+
+def analyze_best_cashbacks_progressive(user_name: str, on_update, skipped_banks: list = None):
+    """
+    Потоковый вариант analyze_best_cashbacks: рекомендации уточняются по мере ответа банков.
+
+    Сначала on_update получает рекомендации по сохранённому состоянию прогноза (без запросов к банкам),
+    затем — пересчитанные после каждого банка, чьи транзакции пришли.
+
+    :param user_name: Имя пользователя
+    :param on_update: Вызывается с {'stage': 'cached'|'bank', 'bank_name', 'results'} (из потока анализа)
+    :param skipped_banks: Список, куда добавляются словари {'bank_name', 'reason'} пропущенных банков
+    :return: Итоговые рекомендации (по всем пришедшим банкам)
+    """
+    from cashbacks_process import extract_columns_from_excel
+    from prediction_state import load_prediction_state
+
+    with tracing.span("analyze_best_cashbacks_progressive", user=user_name):
+        with tracing.span("extract_columns_from_excel"):
+            l = extract_columns_from_excel(CASHBACKS_FILE)
+
+        # Первый ответ — по уже накопленному состоянию, пока банки ещё не опрошены
+        state = load_prediction_state(user_name)
+        results = None
+        if state.head_month is not None:
+            results = _recommendations(state, l)
+            on_update({'stage': 'cached', 'bank_name': None, 'results': results})
+
+        with deadline.reserve(ANALYSIS_COMPUTE_RESERVE_SECONDS):
+            with tracing.span("fetch_and_store_accounts"), deadline.share(ACCOUNTS_BUDGET_SHARE):
+                fetch_and_store_accounts(user_name, skipped_banks=skipped_banks)
+            for bank_name, transactions_data in iter_bank_transactions(user_name, skipped_banks=skipped_banks):
+                state = _ingest_transactions(user_name, transactions_data, l)
+                results = _recommendations(state, l)
+                on_update({'stage': 'bank', 'bank_name': bank_name, 'results': results})
+
+        if results is None:
+            # Ни состояния, ни ответивших банков — рекомендации по пустой истории
+            results = _recommendations(state, l)
+        return results
+
+
+def _ingest_transactions(user_name: str, transactions_data: list, rules: list):
+    """Передаёт транзакции в фоновую запись архива и учитывает новые в состоянии прогноза пользователя."""
+    from prediction_state import update_prediction_state
+    from transaction_archive import archive_in_background
+
+    known_categories = {str(rule['category']).strip().title() for rule in rules}
+    # Архив нужен только аналитике: ответ пользователю не ждёт записи и не ломается от её сбоев
+    archive_in_background(user_name, transactions_data, known_categories)
+    with tracing.span("update_prediction_state"):
+        # В состояние попадают только ещё не учтённые транзакции (окно сверки по id), прогноз считается по месячным суммам
+        return update_prediction_state(user_name, transactions_data, known_categories)
+
+
+def _recommendations(state, rules: list):
+    """Прогноз по состоянию и выбор кешбеков в формате ответа API."""
+    from cashbacks_process import process_dataframe_and_rules, state_to_best_cashbacks
 
+    with tracing.span("state_to_best_cashbacks"):
+        df = state_to_best_cashbacks(state, CASHBACKS_FILE, "2025-10-01")
+    with tracing.span("process_dataframe_and_rules"):
+        return process_dataframe_and_rules(df, rules)
@@ -0,0 +1,76 @@
+import threading
+import metrics
+from typing import Any, Callable, Dict, Hashable
+
+
+class _Call:
+    """Один выполняющийся вызов, результат которого ждут все участники."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Объединяет одинаковые одновременные вызовы (single-flight).
+
+    Пока вызов с ключом key выполняется, повторные вызовы с тем же ключом не идут
+    в банк, а дожидаются результата первого и получают тот же результат (или то же исключение).
+    После завершения ключ освобождается, результат не кешируется.
+    """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.shared_count = 0
+        self.executed_count = 0
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Выполняет fn(*args, **kwargs) или присоединяется к уже выполняющемуся вызову с тем же ключом.
+
+        :param key: Ключ вызова (например, (bank, account_id, consent_id, from_date, to_date))
+        :param fn: Функция, выполняющая запрос
+        :return: Результат fn
+        :raises: Исключение, выброшенное fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.shared_count += 1
+                metrics.cache_hit(f"singleflight_{self.name}")
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed_count += 1
+                metrics.cache_miss(f"singleflight_{self.name}")
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def in_flight(self) -> int:
+        """Количество выполняющихся сейчас вызовов."""
+        with self._lock:
+            return len(self._calls)
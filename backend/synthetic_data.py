@@ -0,0 +1,166 @@
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+# Категории трат, похожие на те, что приходят из песочниц банков
+DEFAULT_CATEGORIES = [
+    "Groceries", "Restaurants", "Cafe", "Transport", "Taxi", "Fuel", "Pharmacy", "Clothing",
+    "Electronics", "Entertainment", "Travel", "Hair Cut", "Books", "Sports", "Utilities", "Pets",
+]
+
+# Служебные операции, которые анализ отфильтровывает
+SERVICE_CATEGORIES = ["Transfer", "Payment"]
+
+DEFAULT_BANKS = ["abank", "sbank", "vbank"]
+
+
+def category_names(n_categories: int) -> List[str]:
+    """
+    Возвращает n_categories названий категорий: сначала стандартные, затем синтетические "Category N".
+    """
+    names = list(DEFAULT_CATEGORIES[:n_categories])
+    for i in range(len(names), n_categories):
+        names.append(f"Category {i + 1}")
+    return names
+
+
+def generate_transactions(
+    n_transactions: int,
+    account_id: str = "acc-1",
+    categories: Optional[Sequence[str]] = None,
+    from_date: str = "2024-10-01T00:00:00Z",
+    to_date: str = "2025-12-31T23:59:59Z",
+    seed: int = 0,
+    debit_share: float = 0.9,
+    service_share: float = 0.05
+) -> List[Dict[str, Any]]:
+    """
+    Генерирует транзакции в формате GetAccountTransactionHistory (data.transaction[*]).
+
+    У каждой категории своя "популярность" и средний чек, поэтому распределение трат по категориям
+    неравномерное, как у реальных пользователей. Транзакции отсортированы по bookingDateTime.
+
+    :param n_transactions: Количество транзакций
+    :param account_id: Идентификатор счёта (попадает в accountId и transactionId)
+    :param categories: Список категорий трат (по умолчанию DEFAULT_CATEGORIES)
+    :param from_date: Начало периода (ISO 8601, UTC)
+    :param to_date: Конец периода (ISO 8601, UTC)
+    :param seed: Зерно генератора — одинаковые параметры дают одинаковые данные
+    :param debit_share: Доля расходных операций (остальные — поступления)
+    :param service_share: Доля служебных операций (переводы, платежи) среди расходов
+    :return: Список транзакций
+    """
+    rng = random.Random(f"{seed}:{account_id}")
+    categories = list(categories) if categories else list(DEFAULT_CATEGORIES)
+
+    start = datetime.fromisoformat(from_date.replace('Z', '+00:00'))
+    end = datetime.fromisoformat(to_date.replace('Z', '+00:00'))
+    span_seconds = max(1, int((end - start).total_seconds()))
+
+    popularity = [rng.paretovariate(1.5) for _ in categories]
+    avg_check = [rng.uniform(150, 5000) for _ in categories]
+
+    timestamps = sorted(rng.randrange(span_seconds) for _ in range(n_transactions))
+
+    transactions = []
+    for i, offset in enumerate(timestamps):
+        booking_dt = start + timedelta(seconds=offset)
+        tx = {
+            "transactionId": f"tx-{account_id}-{i}",
+            "accountId": account_id,
+            "status": "completed",
+            "bookingDateTime": booking_dt.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "valueDateTime": booking_dt.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        }
+
+        if rng.random() >= debit_share:
+            tx["creditDebitIndicator"] = "Credit"
+            tx["transactionInformation"] = "Salary"
+            tx["amount"] = {"amount": f"{rng.uniform(30000, 150000):.2f}", "currency": "RUB"}
+        elif rng.random() < service_share:
+            tx["creditDebitIndicator"] = "Debit"
+            tx["transactionInformation"] = rng.choice(SERVICE_CATEGORIES)
+            tx["amount"] = {"amount": f"{rng.uniform(500, 20000):.2f}", "currency": "RUB"}
+        else:
+            index = rng.choices(range(len(categories)), weights=popularity)[0]
+            category = categories[index]
+            amount = max(10.0, rng.gauss(avg_check[index], avg_check[index] / 3))
+            tx["creditDebitIndicator"] = "Debit"
+            tx["transactionInformation"] = f"Оплата: {category}"
+            tx["merchant"] = {"name": f"{category} shop #{rng.randint(1, 20)}", "category": category}
+            tx["amount"] = {"amount": f"{amount:.2f}", "currency": "RUB"}
+
+        transactions.append(tx)
+
+    return transactions
+
+
+def generate_cashback_catalog(
+    banks: Optional[Sequence[str]] = None,
+    categories_per_bank: int = 10,
+    max_categories_in_bank: int = 3,
+    categories: Optional[Sequence[str]] = None,
+    seed: int = 0,
+    with_all_category: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Генерирует каталог кешбеков в формате Cashbacks.xlsx
+    (bank, category, percent, max_categories_in_bank, category_limit, bank_limit).
+
+    :param banks: Список банков (по умолчанию DEFAULT_BANKS)
+    :param categories_per_bank: Сколько категорий предлагает каждый банк
+    :param max_categories_in_bank: Сколько категорий можно выбрать в банке (k)
+    :param categories: Пул категорий (по умолчанию category_names(categories_per_bank))
+    :param seed: Зерно генератора
+    :param with_all_category: Добавлять ли каждому банку категорию "All" с низким процентом
+    :return: Список строк каталога
+    """
+    rng = random.Random(seed)
+    banks = list(banks) if banks else list(DEFAULT_BANKS)
+    pool = list(categories) if categories else category_names(categories_per_bank)
+
+    rows = []
+    for bank in banks:
+        bank_limit = rng.choice([3000, 5000, 10000])
+        for category in rng.sample(pool, min(categories_per_bank, len(pool))):
+            rows.append({
+                "bank": bank,
+                "category": category,
+                "percent": rng.choice([1, 2, 3, 5, 7, 10, 15]),
+                "max_categories_in_bank": max_categories_in_bank,
+                "category_limit": rng.choice([None, 1000, 2000, 3000]),
+                "bank_limit": bank_limit,
+            })
+        if with_all_category:
+            rows.append({
+                "bank": bank,
+                "category": "All",
+                "percent": 1,
+                "max_categories_in_bank": max_categories_in_bank,
+                "category_limit": None,
+                "bank_limit": bank_limit,
+            })
+    return rows
+
+
+def generate_user(
+    n_transactions: int,
+    banks: Optional[Sequence[str]] = None,
+    categories: Optional[Sequence[str]] = None,
+    seed: int = 0,
+    **kwargs
+) -> List[Dict[str, Any]]:
+    """
+    Генерирует все транзакции пользователя по нескольким банкам (по одному счёту в каждом)
+    с мета-полями _bank_name и _account_id, как их возвращает fetch_all_transactions.
+    """
+    banks = list(banks) if banks else list(DEFAULT_BANKS)
+    per_bank = max(1, n_transactions // len(banks))
+    all_transactions = []
+    for bank in banks:
+        account_id = f"{bank}-acc-{seed}"
+        for tx in generate_transactions(per_bank, account_id=account_id, categories=categories, seed=seed, **kwargs):
+            tx["_bank_name"] = bank
+            tx["_account_id"] = account_id
+            all_transactions.append(tx)
+    return all_transactions
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Модули backend лежат плоско и импортируются по имени, как при запуске из директории backend
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("TRACING_ENABLED", "0")
@@ -0,0 +1,90 @@
+import json
+import sqlite3
+import threading
+
+import pytest
+
+import accounts_store
+
+
+def _legacy_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE user_banks (
+            user_name TEXT NOT NULL,
+            bank_name TEXT NOT NULL,
+            account_id TEXT,
+            consent_id TEXT,
+            is_active INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (user_name, bank_name)
+        )
+    """)
+    conn.executemany("INSERT INTO user_banks (user_name, bank_name, account_id, consent_id) VALUES (?, ?, ?, ?)", [
+        ("alice", "abank", json.dumps(["acc-1", "acc-2"]), "consent-a"),
+        ("alice", "sbank", json.dumps(["acc-3"]), "consent-s"),
+        ("bob", "vbank", json.dumps(["acc-4"]), "consent-v"),
+    ])
+    conn.commit()
+    conn.close()
+
+
+def _tables(path):
+    with sqlite3.connect(path) as conn:
+        return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+@pytest.fixture(autouse=True)
+def _fresh_ready_dbs():
+    accounts_store._ready_dbs.clear()
+    yield
+    accounts_store._ready_dbs.clear()
+
+
+def test_concurrent_migration_moves_accounts_once(tmp_path):
+    db_path = str(tmp_path / "users.db")
+    _legacy_db(db_path)
+    errors = []
+    start = threading.Barrier(8)
+
+    def worker():
+        # Отдельные соединения, как у разных воркеров: каждый видит старую схему до блокировки
+        conn = sqlite3.connect(db_path, timeout=10)
+        try:
+            start.wait()
+            accounts_store.ensure_user_tables(conn, "other-" + threading.current_thread().name)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert errors == []
+    assert _tables(db_path) == {"user_banks", "accounts"}
+    assert accounts_store.bank_accounts("alice", db_path) == {"abank": ["acc-1", "acc-2"], "sbank": ["acc-3"]}
+    assert accounts_store.bank_accounts("bob", db_path) == {"vbank": ["acc-4"]}
+
+
+def test_failed_migration_leaves_legacy_table_intact(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "users.db")
+    _legacy_db(db_path)
+
+    def broken_create(cursor):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(accounts_store, "_create_user_tables", broken_create)
+    conn = sqlite3.connect(db_path)
+    with pytest.raises(sqlite3.OperationalError):
+        accounts_store.ensure_user_tables(conn, db_path)
+    conn.close()
+
+    assert db_path not in accounts_store._ready_dbs
+    assert _tables(db_path) == {"user_banks"}
+    with sqlite3.connect(db_path) as conn:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(user_banks)")}
+        assert "account_id" in columns
+        assert conn.execute("SELECT COUNT(*) FROM user_banks").fetchone()[0] == 3
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import admission
+import backend
+from admission import AdmissionLimiter, Overloaded
+
+
+async def _wait_queued(limiter: AdmissionLimiter, count: int):
+    for _ in range(500):
+        if len(limiter._waiters) >= count:
+            return
+        await asyncio.sleep(0.002)
+    raise AssertionError(f"{limiter.endpoint}: в очереди меньше {count} запросов")
+
+
+def test_waiter_cancelled_after_handoff_passes_slot_on():
+    async def scenario():
+        limiter = AdmissionLimiter("test", max_concurrent=1, max_queue=4, max_wait=5)
+        first = await limiter.acquire()
+        handed = asyncio.create_task(limiter.acquire())
+        next_in_line = asyncio.create_task(limiter.acquire())
+        await _wait_queued(limiter, 2)
+
+        # Слот передан первому ожидающему, но клиент ушёл раньше, чем задача проснулась
+        limiter.release(first)
+        handed.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await handed
+
+        started = await asyncio.wait_for(next_in_line, 1)
+        assert limiter.active == 1
+        limiter.release(started)
+        assert limiter.active == 0
+        assert not limiter._waiters
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("offset", [-0.002, 0.0, 0.002])
+def test_timeout_racing_release_does_not_leak_slots(offset):
+    async def scenario():
+        limiter = AdmissionLimiter("test", max_concurrent=1, max_queue=4, max_wait=0.05)
+        loop = asyncio.get_running_loop()
+        outcomes = set()
+        for _ in range(20):
+            first = await limiter.acquire()
+            waiter = asyncio.create_task(limiter.acquire())
+            await _wait_queued(limiter, 1)
+            # Освобождение приходит примерно тогда же, когда истекает max_wait ожидающего
+            loop.call_later(limiter.max_wait + offset, limiter.release, first)
+            try:
+                limiter.release(await waiter)
+                outcomes.add("admitted")
+            except Overloaded:
+                outcomes.add("timeout")
+                await asyncio.sleep(2 * abs(offset) + 0.01)
+            # Кто бы ни выиграл гонку, слот не теряется и не выдаётся дважды
+            assert limiter.active == 0
+            assert not limiter._waiters
+        return outcomes
+
+    assert asyncio.run(scenario())
+
+
+def test_full_queue_returns_503_with_retry_after(monkeypatch):
+    limiter = AdmissionLimiter("analysis_results", max_concurrent=1, max_queue=0)
+    limiter.active = 1
+    limiter._avg_duration = 2.5
+    monkeypatch.setattr(backend, "analysis_limiter", limiter)
+    monkeypatch.setattr(backend, "analyze_best_cashbacks", pytest.fail)
+
+    response = TestClient(backend.app).get("/api/analysis_results/alice")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+    assert limiter.active == 1
+
+
+def test_overloaded_retry_after_grows_with_queue():
+    limiter = AdmissionLimiter("test", max_concurrent=2, max_queue=8)
+    limiter._avg_duration = 4.0
+    assert limiter.retry_after() == 2
+    limiter._waiters.extend([None] * 3)
+    assert limiter.retry_after() == 8
+    with pytest.raises(admission.Overloaded) as error:
+        limiter._reject("rejected")
+    assert error.value.retry_after == 8
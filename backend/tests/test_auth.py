@@ -0,0 +1,51 @@
+import pytest
+from fastapi import HTTPException
+
+import auth
+import backend
+
+
+@pytest.fixture(autouse=True)
+def _session_secret(monkeypatch):
+    monkeypatch.setattr(auth, "_session_secret", b"test-secret")
+
+
+def test_session_token_round_trip():
+    token = auth.issue_session_token("alice")
+    assert auth.verify_session_token(token) == "alice"
+
+
+def test_expired_session_token_is_rejected():
+    assert auth.verify_session_token(auth.issue_session_token("alice", ttl_seconds=-1)) is None
+
+
+def test_tampered_session_token_is_rejected():
+    payload, signature = auth.issue_session_token("alice").split(".")
+    forged_payload = auth.issue_session_token("mallory").split(".")[0]
+
+    assert auth.verify_session_token(f"{forged_payload}.{signature}") is None
+    assert auth.verify_session_token(f"{payload}.{signature[:-2]}AA") is None
+
+
+def test_token_signed_with_another_secret_is_rejected(monkeypatch):
+    token = auth.issue_session_token("alice")
+    monkeypatch.setattr(auth, "_session_secret", b"rotated-secret")
+    assert auth.verify_session_token(token) is None
+
+
+@pytest.mark.parametrize("token", [None, "", "abc", "a.b.c", "é.x", "e30.x"])
+def test_malformed_session_token_is_rejected(token):
+    assert auth.verify_session_token(token) is None
+
+
+def test_endpoints_check_session_owner(monkeypatch):
+    monkeypatch.setattr(backend, "AUTH_REQUIRED", True)
+    token = auth.issue_session_token("alice")
+
+    backend.authorize("alice", f"Bearer {token}")
+    with pytest.raises(HTTPException) as error:
+        backend.authorize("bob", f"Bearer {token}")
+    assert error.value.status_code == 403
+    with pytest.raises(HTTPException) as error:
+        backend.authorize("alice", token)
+    assert error.value.status_code == 401
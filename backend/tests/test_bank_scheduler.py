@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import bank_scheduler
+import deadline
+from bank_scheduler import BATCH, INTERACTIVE, RENEWAL, HostScheduler
+
+
+def _wait_queued(scheduler: HostScheduler, priority_class: str, count: int):
+    for _ in range(500):
+        with scheduler._lock:
+            if len(scheduler._queues[priority_class]) >= count:
+                return
+        time.sleep(0.002)
+    raise AssertionError(f"{priority_class}: в очереди меньше {count} запросов")
+
+
+def test_batch_leaves_reserved_slots_to_interactive():
+    scheduler = HostScheduler("bank", max_concurrent=4)
+
+    # batch не занимает последние 2 слота, renewal — последний
+    assert scheduler.acquire(BATCH, 0)
+    assert scheduler.acquire(BATCH, 0)
+    assert not scheduler.acquire(BATCH, 0.01)
+    assert scheduler.acquire(RENEWAL, 0)
+    assert not scheduler.acquire(RENEWAL, 0.01)
+
+    # Пользовательский запрос получает слот сразу, хотя фоновые забрали всё, что им доступно
+    started = time.perf_counter()
+    assert scheduler.acquire(INTERACTIVE, 0)
+    assert time.perf_counter() - started < 0.05
+    assert scheduler.active == 4
+    assert scheduler.active_by_class == {INTERACTIVE: 1, RENEWAL: 1, BATCH: 2}
+    assert not scheduler.acquire(INTERACTIVE, 0.01)
+
+    scheduler.release(BATCH)
+    assert scheduler.acquire(INTERACTIVE, 0)
+
+
+def test_batch_uses_all_spare_capacity_when_interactive_is_idle():
+    scheduler = HostScheduler("bank", max_concurrent=1)
+    # Для очень маленького лимита фоновым всё равно доступен один слот
+    assert scheduler.acquire(BATCH, 0)
+    scheduler.release(BATCH)
+    assert scheduler.acquire(RENEWAL, 0)
+
+
+def test_free_slots_are_shared_by_class_weights():
+    scheduler = HostScheduler("bank", max_concurrent=1)
+    assert scheduler.acquire(INTERACTIVE, 0)
+
+    order = []
+
+    def worker(priority_class: str):
+        assert scheduler.acquire(priority_class, 5)
+        order.append(priority_class)
+        scheduler.release(priority_class)
+
+    waiting = {BATCH: 4, RENEWAL: 8, INTERACTIVE: 32}
+    threads = []
+    for priority_class, count in waiting.items():
+        for i in range(count):
+            thread = threading.Thread(target=worker, args=(priority_class,))
+            thread.start()
+            threads.append(thread)
+            _wait_queued(scheduler, priority_class, i + 1)
+
+    scheduler.release(INTERACTIVE)
+    for thread in threads:
+        thread.join(5)
+
+    assert Counter(order) == Counter(waiting)
+    # Пока ждут все классы, слоты делятся примерно 16 : 4 : 1
+    first = Counter(order[:21])
+    assert first[INTERACTIVE] >= 15
+    assert 3 <= first[RENEWAL] <= 5
+    assert first[BATCH] <= 2
+    # Фоновые не голодают: batch обслуживается раньше, чем закончатся пользовательские запросы
+    assert order.index(BATCH) < len(order) - waiting[BATCH]
+
+
+def test_slot_wait_is_bounded_by_deadline():
+    scheduler = bank_scheduler.scheduler_for("deadline-test-bank")
+    for _ in range(scheduler.max_concurrent):
+        assert scheduler.acquire(INTERACTIVE, 0)
+    try:
+        with deadline.budget(0.05), pytest.raises(deadline.DeadlineExceeded):
+            with bank_scheduler.slot("deadline-test-bank"):
+                pass
+        with scheduler._lock:
+            assert not scheduler._queues[INTERACTIVE]
+    finally:
+        for _ in range(scheduler.max_concurrent):
+            scheduler.release(INTERACTIVE)
+
+
+def test_priority_is_inherited_by_worker_threads():
+    import tracing
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=1) as pool, bank_scheduler.priority(RENEWAL):
+        assert tracing.submit(pool, bank_scheduler.current_priority).result() == RENEWAL
+    assert bank_scheduler.current_priority() == INTERACTIVE
+
+    with pytest.raises(ValueError):
+        with bank_scheduler.priority("urgent"):
+            pass
@@ -0,0 +1,171 @@
+import itertools
+import random
+import time
+
+import pytest
+
+import deadline
+from cashback_optimizer import INF, BankTerms, _max_linear, allocate_spend, joint_assignment, split_assignment
+
+
+def _random_case(rng: random.Random):
+    categories = [f"c{i}" for i in range(rng.randint(2, 8))]
+    spend = {category: rng.choice([0, rng.uniform(100, 20000)]) for category in categories}
+    terms = []
+    for b in range(rng.randint(1, 4)):
+        rules = {category: (rng.choice([1, 2, 3, 5, 7, 10]), rng.choice([INF, rng.uniform(50, 1500)]))
+                 for category in rng.sample(categories, rng.randint(1, len(categories)))}
+        all_rule = ("All", rng.choice([1, 1.5, 2]), rng.choice([INF, rng.uniform(100, 2000)])) if rng.random() < 0.3 else None
+        terms.append(BankTerms(f"bank{b}", rng.randint(1, 3), rng.choice([INF, rng.uniform(100, 3000)]), rules, all_rule))
+    return spend, terms
+
+
+def test_allocation_is_optimal_when_bank_limit_binds():
+    # По проценту жадно: все траты X на A (10%) упираются в bank_limit, Y и B не дают ничего — 100.
+    # Оптимум: Y целиком на A (8%), остаток лимита A — на X, остальное X — на B (9%)
+    terms = {
+        "A": BankTerms("A", 2, 100, {"X": (10, INF), "Y": (8, INF)}, None),
+        "B": BankTerms("B", 1, INF, {"X": (9, INF)}, None),
+    }
+    value, allocation = allocate_spend({"X": 1000, "Y": 1000}, {"A": ["X", "Y"], "B": ["X"]}, set(), terms)
+
+    assert value == pytest.approx(172)
+    assert allocation[("A", "Y")] == pytest.approx((1000, 80))
+    assert allocation[("A", "X")] == pytest.approx((200, 20))
+    assert allocation[("B", "X")] == pytest.approx((800, 72))
+
+
+def test_allocation_respects_category_and_all_limits():
+    terms = {
+        "A": BankTerms("A", 1, INF, {"X": (10, 30)}, None),
+        "B": BankTerms("B", 1, 500, {}, ("All", 2, 15)),
+    }
+    value, allocation = allocate_spend({"X": 1000, "Y": 400}, {"A": ["X"]}, {"B"}, terms)
+
+    assert allocation[("A", "X")] == pytest.approx((300, 30))
+    assert sum(cashback for bank_category, (_, cashback) in allocation.items() if bank_category[0] == "B") == pytest.approx(15)
+    assert value == pytest.approx(45)
+
+
+def _linear_value(spend, selection, all_banks, terms):
+    """Оптимум распределения, посчитанный симплексом напрямую — эталон для allocate_spend."""
+    pairs = [(bank, category, *terms[bank].rules[category]) for bank, categories in selection.items()
+             for category in categories]
+    pairs += [(bank, category, terms[bank].all_rule[1], INF) for bank in all_banks for category in spend]
+    rows, bounds = [], []
+    for category, amount in spend.items():
+        rows.append([float(pair[1] == category) for pair in pairs])
+        bounds.append(amount)
+    for bank in {pair[0] for pair in pairs}:
+        t = terms[bank]
+        room = min(t.bank_limit, t.all_rule[2]) if bank in all_banks else t.bank_limit
+        if room < INF:
+            rows.append([pair[2] / 100 if pair[0] == bank else 0.0 for pair in pairs])
+            bounds.append(room)
+    for i, (_, _, percent, category_limit) in enumerate(pairs):
+        if category_limit < INF:
+            rows.append([float(j == i) for j in range(len(pairs))])
+            bounds.append(category_limit * 100 / percent)
+    amounts, _ = _max_linear([pair[2] / 100 for pair in pairs], rows, bounds)
+    return sum(amount * pair[2] / 100 for amount, pair in zip(amounts, pairs))
+
+
+def test_allocation_by_rate_matches_linear_program():
+    # Заполнение по проценту без упора в bank_limit и симплекс при упоре дают один и тот же оптимум
+    rng = random.Random(3)
+    for _ in range(300):
+        spend, terms = _random_case(rng)
+        by_bank = {t.name: t for t in terms}
+        # Карта либо с "all", либо с обычными категориями
+        all_banks = {t.name for t in terms if t.all_rule and rng.random() < 0.5}
+        selection = {t.name: rng.sample(sorted(t.rules), min(t.max_categories, len(t.rules)))
+                     for t in terms if t.name not in all_banks}
+        value, allocation = allocate_spend(spend, selection, all_banks, by_bank)
+
+        assert value == pytest.approx(_linear_value(spend, selection, all_banks, by_bank), rel=1e-6, abs=1e-6)
+        assert sum(cashback for _, cashback in allocation.values()) == pytest.approx(value)
+
+
+def test_split_is_never_worse_than_joint():
+    rng = random.Random(1)
+    for _ in range(500):
+        spend, terms = _random_case(rng)
+        joint = joint_assignment(spend, terms)
+        split = split_assignment(spend, terms)
+
+        assert split.value >= joint.value - 1e-6
+        assert sum(row['total_cb'] for row in split.rows) == pytest.approx(split.value)
+        # В рекомендации только категории, на которые действительно стоит нести траты
+        assert all(row['recommended_spend'] > 0 for row in split.rows)
+
+
+def _brute_force(spend, terms):
+    """Полный перебор режимов банков и назначений «категория → банк» для маленьких случаев."""
+    categories = [category for category, amount in spend.items() if amount > 0]
+    best = 0.0
+    for modes in itertools.product(*[(False, True) if t.all_rule else (False,) for t in terms]):
+        for assignment in itertools.product(range(-1, len(terms)), repeat=len(categories)):
+            totals = [0.0] * len(terms)
+            counts = [0] * len(terms)
+            for category, b in zip(categories, assignment):
+                if b < 0:
+                    continue
+                t = terms[b]
+                if modes[b]:
+                    totals[b] += spend[category] * t.all_rule[1] / 100
+                elif category in t.rules:
+                    counts[b] += 1
+                    totals[b] += min(spend[category] * t.rules[category][0] / 100, t.rules[category][1])
+            if any(count > t.max_categories for count, t in zip(counts, terms)):
+                continue
+            value = sum(min(total, min(t.all_rule[2], t.bank_limit) if use_all else t.bank_limit)
+                        for total, t, use_all in zip(totals, terms, modes))
+            best = max(best, value)
+    return best
+
+
+def test_joint_assignment_matches_brute_force():
+    rng = random.Random(7)
+    for _ in range(150):
+        spend, terms = _random_case(rng)
+        spend = dict(list(spend.items())[:6])
+        solution = joint_assignment(spend, terms[:3])
+
+        assert solution.exact
+        assert solution.value == pytest.approx(_brute_force(spend, terms[:3]))
+
+
+def _large_case(seed: int):
+    rng = random.Random(seed)
+    categories = [f"c{i}" for i in range(50)]
+    spend = {category: rng.lognormvariate(0, 1) * 3000 for category in categories}
+    terms = [
+        BankTerms(f"bank{b}", 3, rng.choice([3000, 5000, 10000]),
+                  {category: (rng.choice([1, 2, 3, 5, 7, 10, 15]), rng.choice([INF, 1000, 2000, 3000]))
+                   for category in categories},
+                  ("All", 1, INF))
+        for b in range(8)
+    ]
+    return spend, terms
+
+
+def test_search_stops_at_time_budget_with_greedy_fallback():
+    spend, terms = _large_case(1)
+
+    started = time.monotonic()
+    limited = joint_assignment(spend, terms, max_seconds=0.05)
+    elapsed = time.monotonic() - started
+    with deadline.budget(0.05):
+        # Внутри запроса перебор не выходит за остаток его бюджета
+        started = time.monotonic()
+        within_deadline = joint_assignment(spend, terms)
+        elapsed_within_deadline = time.monotonic() - started
+
+    assert elapsed < 1 and elapsed_within_deadline < 1
+    assert not limited.exact
+    exact = joint_assignment(spend, terms, max_seconds=60)
+    assert exact.exact
+    # Остановленный перебор возвращает лучшее найденное решение — не хуже жадного и близкое к оптимуму
+    for solution in (limited, within_deadline):
+        assert solution.assignment
+        assert 0.9 * exact.value <= solution.value <= exact.value + 1e-6
@@ -0,0 +1,150 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import accounts_store
+import bank_scheduler
+import consent_scheduler
+import preparation
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "users.db")
+    accounts_store._ready_dbs.discard(path)
+    with sqlite3.connect(path) as conn:
+        accounts_store.ensure_user_tables(conn, path)
+    return path
+
+
+def _add_consent(db_path, user_name, bank_name, consent_id, expires_in, due=True):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("INSERT INTO user_banks (user_name, bank_name, consent_id, is_active) VALUES (?, ?, ?, 1)",
+                     (user_name, bank_name, consent_id))
+    expiration_dt = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+    preparation.schedule_consent_renewal(user_name, bank_name, consent_id, expiration_dt, db_path)
+    if due:
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("UPDATE consent_schedule SET next_check_at = 0 WHERE user_name = ? AND bank_name = ?",
+                         (user_name, bank_name))
+
+
+def _schedule(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("""
+            SELECT user_name, bank_name, consent_id, next_check_at, pending_request_id, attempts FROM consent_schedule
+        """).fetchall()
+
+
+def _consent(db_path, user_name, bank_name):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT consent_id FROM user_banks WHERE user_name = ? AND bank_name = ?",
+                            (user_name, bank_name)).fetchone()[0]
+
+
+def test_concurrent_workers_claim_each_consent_once(db_path):
+    for i in range(40):
+        _add_consent(db_path, f"user-{i}", "abank", f"consent-{i}", expires_in=86400)
+    claimed = []
+    start = threading.Barrier(4)
+
+    def worker():
+        start.wait()
+        # Каждый поток — как отдельный воркер uvicorn со своим соединением к общему users.db
+        while True:
+            rows = consent_scheduler.claim_due_consents(limit=3, db_path=db_path)
+            if not rows:
+                return
+            claimed.extend(rows)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert sorted(row[0] for row in claimed) == sorted(f"user-{i}" for i in range(40))
+    # Захваченные записи скрыты до конца аренды
+    lease_end = int(time.time()) + consent_scheduler.CONSENT_CLAIM_LEASE_SECONDS
+    assert all(lease_end - 5 <= row[3] <= lease_end for row in _schedule(db_path))
+    assert consent_scheduler.claim_due_consents(db_path=db_path) == []
+
+
+def test_pending_renewal_is_handed_over_after_expiry(db_path, monkeypatch):
+    _add_consent(db_path, "alice", "abank", "consent-old", expires_in=-60)
+    monkeypatch.setattr(consent_scheduler, "GetConsentByID", pytest.fail)
+
+    (row,) = consent_scheduler.claim_due_consents(db_path=db_path)
+    user_name, bank_name, consent_id, _, attempts, expires_at = row
+    result = consent_scheduler.renew_consent(user_name, bank_name, consent_id, "req-new", attempts, expires_at,
+                                             db_path=db_path)
+
+    assert result == "expired"
+    assert _schedule(db_path) == []
+    # Неподтверждённый запрос дальше проверяет refresh_user_consents
+    assert _consent(db_path, "alice", "abank") == "req-new"
+
+
+def test_pending_renewal_is_rechecked_before_expiry(db_path, monkeypatch):
+    _add_consent(db_path, "alice", "abank", "consent-old", expires_in=3600)
+    monkeypatch.setattr(consent_scheduler, "get_token_for_bank", lambda bank_name, tokens_db_path: "token")
+    monkeypatch.setattr(consent_scheduler, "GetConsentByID",
+                        lambda **kwargs: {"data": {"status": "AwaitingAuthorization", "consentId": kwargs["consent_id"]}})
+
+    row = consent_scheduler.claim_due_consents(db_path=db_path)[0]
+    result = consent_scheduler.renew_consent(*row[:3], "req-new", *row[4:], db_path=db_path)
+
+    assert result == "pending"
+    (scheduled,) = _schedule(db_path)
+    assert scheduled[4] == "req-new"
+    assert scheduled[3] >= int(time.time()) + consent_scheduler.CONSENT_PENDING_RECHECK_SECONDS - 5
+    assert _consent(db_path, "alice", "abank") == "consent-old"
+
+
+def test_authorized_renewal_replaces_consent(db_path, monkeypatch):
+    _add_consent(db_path, "alice", "abank", "consent-old", expires_in=3600)
+    expiration = (datetime.now(timezone.utc) + timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    monkeypatch.setattr(consent_scheduler, "get_token_for_bank", lambda bank_name, tokens_db_path: "token")
+    monkeypatch.setattr(consent_scheduler, "_request_consent", lambda *args: "req-new")
+    monkeypatch.setattr(consent_scheduler, "GetConsentByID", lambda **kwargs: {"data": {
+        "status": "Authorized", "consentId": "consent-new", "expirationDateTime": expiration,
+    }})
+
+    row = consent_scheduler.claim_due_consents(db_path=db_path)[0]
+    assert consent_scheduler.renew_consent(*row, db_path=db_path) == "renewed"
+
+    assert _consent(db_path, "alice", "abank") == "consent-new"
+    ((_, _, consent_id, next_check_at, pending_request_id, attempts),) = _schedule(db_path)
+    assert (consent_id, pending_request_id, attempts) == ("consent-new", None, 0)
+    assert next_check_at > int(time.time()) + 20 * 24 * 3600
+
+
+def test_failed_renewal_backs_off(db_path, monkeypatch):
+    _add_consent(db_path, "alice", "abank", "consent-old", expires_in=3600)
+    monkeypatch.setattr(consent_scheduler, "get_token_for_bank", lambda bank_name, tokens_db_path: None)
+
+    for attempt in range(3):
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("UPDATE consent_schedule SET next_check_at = 0")
+        row = consent_scheduler.claim_due_consents(db_path=db_path)[0]
+        assert consent_scheduler.renew_consent(*row, db_path=db_path) == "failed"
+        ((*_, next_check_at, _, attempts),) = _schedule(db_path)
+        assert attempts == attempt + 1
+        delay = consent_scheduler.CONSENT_RETRY_BASE_SECONDS * 2 ** attempt
+        assert abs(next_check_at - int(time.time()) - delay) <= 5
+    assert _consent(db_path, "alice", "abank") == "consent-old"
+
+
+def test_due_renewals_run_with_renewal_priority(db_path, monkeypatch):
+    _add_consent(db_path, "alice", "abank", "consent-a", expires_in=3600)
+    _add_consent(db_path, "bob", "sbank", "consent-b", expires_in=30 * 24 * 3600, due=False)
+    priorities = []
+    monkeypatch.setattr(consent_scheduler, "update_expired_tokens", lambda: None)
+    monkeypatch.setattr(consent_scheduler, "renew_consent",
+                        lambda *args, **kwargs: priorities.append((args[0], bank_scheduler.current_priority())) or "pending")
+
+    assert consent_scheduler.run_due_renewals(db_path=db_path) == 1
+    assert priorities == [("alice", bank_scheduler.RENEWAL)]
@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import backend
+import deadline
+import preparation
+
+
+def test_nested_budget_cannot_extend_outer():
+    with deadline.budget(0.5):
+        with deadline.budget(10):
+            assert deadline.remaining() <= 0.5
+        with deadline.share(0.5):
+            assert deadline.remaining() <= 0.25
+    assert deadline.remaining() is None
+
+
+def test_exhausted_budget_stops_bank_calls():
+    with deadline.budget(0):
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.timeout(10)
+
+
+def test_slow_and_failing_banks_are_skipped_with_partial_results():
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        return "slow"
+
+    def failing():
+        raise ValueError("bank is down")
+
+    def out_of_budget():
+        raise deadline.DeadlineExceeded("budget")
+
+    calls = {"abank": lambda: "fast", "sbank": slow, "vbank": failing, "tbank": out_of_budget}
+    skipped = []
+    started = time.monotonic()
+    try:
+        with deadline.budget(0.3):
+            results = dict(preparation._iter_banks(calls, skipped))
+    finally:
+        release.set()
+
+    assert time.monotonic() - started < 2
+    assert results == {"abank": "fast"}
+    assert sorted(skipped, key=lambda item: item["bank_name"]) == [
+        {"bank_name": "sbank", "reason": "deadline"},
+        {"bank_name": "tbank", "reason": "deadline"},
+        {"bank_name": "vbank", "reason": "error"},
+    ]
+
+
+def test_analysis_endpoint_passes_deadline_and_reports_partial(monkeypatch):
+    seen_budget = []
+
+    def analyze(user_login, skipped_banks):
+        # Дедлайн ручки доходит до потока анализа через contextvars
+        seen_budget.append(deadline.remaining())
+        skipped_banks.append({"bank_name": "sbank", "reason": "deadline"})
+        return [{"bank_name": "abank", "category": "Кафе"}]
+
+    monkeypatch.setattr(backend, "analyze_best_cashbacks", analyze)
+
+    response = TestClient(backend.app).get("/api/analysis_results/alice")
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "results": [{"bank_name": "abank", "category": "Кафе"}],
+        "partial": True,
+        "skipped_banks": [{"bank_name": "sbank", "reason": "deadline"}],
+    }
+    assert 0 < seen_budget[0] <= backend.ANALYSIS_DEADLINE_SECONDS
@@ -0,0 +1,78 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import optimizer_cache
+from analysis_try4 import choose_best_cashback
+
+MODES = ('per_bank', 'joint', 'split')
+
+
+def _catalog():
+    return pd.DataFrame([
+        ("abank", "Супермаркеты", 5.0, 1000.0, 2, 3000.0),
+        ("abank", "Кафе", 10.0, 500.0, 2, 3000.0),
+        ("abank", "Аптеки", 3.0, 1000.0, 2, 3000.0),
+        ("sbank", "Супермаркеты", 3.0, 2000.0, 1, 2000.0),
+        ("sbank", "All", 1.0, 800.0, 1, 2000.0),
+        ("vbank", "Кафе", 7.0, 300.0, 1, 1000.0),
+        ("vbank", "Аптеки", 6.0, 100.0, 1, 1000.0),
+    ], columns=['bank', 'category', 'percent', 'category_limit', 'max_categories_in_bank', 'bank_limit'])
+
+
+def _prediction(spend):
+    return pd.DataFrame(list(spend.items()), columns=['category', 'predicted_amount'])
+
+
+def _comparable(df):
+    return df.sort_values(['bank', 'category']).reset_index(drop=True)
+
+
+@pytest.fixture(autouse=True)
+def _fresh_cache():
+    optimizer_cache.clear()
+    yield
+    optimizer_cache.clear()
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_miss_optimizes_exact_prediction(mode):
+    # Аптеки округляются до 0 в ключе, но в результате должны остаться с точной суммой
+    prediction = _prediction({"Супермаркеты": 12340.0, "Кафе": 4170.0, "Аптеки": 40.0})
+
+    cached = choose_best_cashback(prediction, _catalog(), mode=mode, use_cache=True)
+    exact = choose_best_cashback(prediction, _catalog(), mode=mode, use_cache=False)
+
+    pd.testing.assert_frame_equal(_comparable(cached), _comparable(exact))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_hit_recomputes_values_for_exact_prediction(mode):
+    catalog = _catalog()
+    choose_best_cashback(_prediction({"Супермаркеты": 12340.0, "Кафе": 4170.0, "Аптеки": 1010.0}), catalog,
+                         mode=mode, use_cache=True)
+    # Тот же квантованный ключ, другие точные суммы
+    close = _prediction({"Супермаркеты": 12310.0, "Кафе": 4190.0, "Аптеки": 980.0})
+    assert optimizer_cache.cache_key(mode, close, catalog) in optimizer_cache._memory_cache._items
+
+    cached = choose_best_cashback(close, catalog, mode=mode, use_cache=True)
+    exact = choose_best_cashback(close, catalog, mode=mode, use_cache=False)
+
+    pd.testing.assert_frame_equal(_comparable(cached), _comparable(exact))
+
+
+def test_disk_cache_is_trimmed_to_max_rows(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "optimizer_cache.db")
+    monkeypatch.setattr(optimizer_cache, "OPTIMIZER_CACHE_DB_TRIM_EVERY", 10)
+    monkeypatch.setattr(optimizer_cache, "_disk_puts", 0)
+    result = pd.DataFrame([{"bank": "abank", "category": "Кафе", "total_cb": 1.0}])
+
+    for i in range(95):
+        optimizer_cache._disk_put(db_path, ("joint:v2", "catalog", ("abank",), (("Кафе", float(i)),)), result,
+                                  max_rows=20)
+
+    with sqlite3.connect(db_path) as conn:
+        count = conn.execute("SELECT COUNT(*) FROM optimizer_cache").fetchone()[0]
+    # Обрезка раз в 10 записей: после последней (90-я запись) осталось 20, затем добавилось ещё 5
+    assert count == 25
@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+from analysis_try4 import booking_month_index, direct_model, month_index, parse_transactions_json_to_dataframe
+
+CATALOG = pd.DataFrame({"category": ["Кафе"]})
+
+
+def _spend(month: str, amount: float) -> dict:
+    return {
+        "transactionId": f"tx-{month}",
+        "bookingDateTime": f"{month}-15T12:00:00Z",
+        "amount": {"amount": str(amount)},
+        "creditDebitIndicator": "Debit",
+        "status": "completed",
+        "merchant": {"category": "Кафе"},
+    }
+
+
+def test_direct_model_weights_each_window_by_its_own_average():
+    # Последние 3 месяца — по 300, месяцы 4..6 назад — пусто, 7..12 назад — по 600:
+    # средние за 3, 6 и 12 месяцев — 300, 150 и 375
+    transactions = [_spend(month, 300) for month in ("2025-07", "2025-08", "2025-09")]
+    transactions += [_spend(month, 600) for month in ("2024-10", "2024-11", "2024-12", "2025-01", "2025-02", "2025-03")]
+    data = parse_transactions_json_to_dataframe(transactions, CATALOG)
+
+    prediction = direct_model(data, "2025-10-01", w_3=0.6, w_6=0.3, w_12=0.1)
+
+    assert prediction['direct_prediction'].iloc[0] == pytest.approx(0.6 * 300 + 0.3 * 150 + 0.1 * 375)
+    # Вес w_6 действует только на среднее за 6 месяцев
+    only_6 = direct_model(data, "2025-10-01", w_3=0.0, w_6=1.0, w_12=0.0)
+    assert only_6['direct_prediction'].iloc[0] == pytest.approx(150)
+
+
+@pytest.mark.parametrize("booking_date_time, expected", [
+    ("2025-01-05T10:00:00Z", "2025-01-01"),
+    ("2025-12", "2025-12-01"),
+    ("20250105", "2025-01-01"),
+    ("20251231T235959Z", "2025-12-01"),
+    ("2025-03-01T01:00:00+03:00", "2025-03-01"),
+])
+def test_booking_month_index_handles_compact_and_extended_iso(booking_date_time, expected):
+    assert booking_month_index(booking_date_time) == month_index(expected)
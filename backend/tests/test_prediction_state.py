@@ -0,0 +1,67 @@
+from analysis_try4 import month_index
+from prediction_state import PredictionState
+
+
+def _tx(tx_id, booking, amount, account="acc-1"):
+    return {
+        "transactionId": tx_id,
+        "bookingDateTime": booking,
+        "amount": {"amount": str(amount)},
+        "creditDebitIndicator": "Debit",
+        "status": "completed",
+        "merchant": {"category": "Супермаркеты"},
+        "_bank_name": "abank",
+        "_account_id": account,
+    }
+
+
+def _spent(state, month):
+    return state.monthly_totals().get(month_index(month), 0.0)
+
+
+def test_refetch_does_not_double_count():
+    history = [_tx(f"tx-{i}", f"2025-0{i % 6 + 1}-10T10:00:00Z", 100) for i in range(30)]
+    state = PredictionState()
+
+    assert state.ingest(history, ["Супермаркеты"]) == 30
+    assert state.ingest(history, ["Супермаркеты"]) == 0
+    assert sum(state.monthly_totals().values()) == 3000
+
+
+def test_late_and_missed_transactions_inside_window_are_counted():
+    state = PredictionState()
+    state.ingest([_tx("tx-1", "2025-05-20T10:00:00Z", 100), _tx("tx-2", "2025-06-15T10:00:00Z", 200)], [])
+
+    # Проведённая задним числом и со страницы, не загрузившейся в прошлый раз, — старше курсора, но в окне
+    late = [_tx("tx-3", "2025-06-01T10:00:00Z", 50), _tx("tx-4", "2025-05-02T10:00:00Z", 70)]
+    assert state.ingest([_tx("tx-1", "2025-05-20T10:00:00Z", 100), _tx("tx-2", "2025-06-15T10:00:00Z", 200)] + late, []) == 2
+
+    assert _spent(state, "2025-05") == 170
+    assert _spent(state, "2025-06") == 250
+
+
+def test_transactions_before_window_are_treated_as_counted():
+    state = PredictionState()
+    state.ingest([_tx("tx-1", "2025-01-10T10:00:00Z", 100), _tx("tx-2", "2025-06-15T10:00:00Z", 200)], [])
+
+    assert state.ingest([_tx("tx-old", "2025-03-10T10:00:00Z", 999)], []) == 0
+    # id старых месяцев не копятся в состоянии
+    assert set(state.cursors["abank:acc-1"]["seen"]) == {"tx-2"}
+
+
+def test_new_account_is_counted_in_full():
+    state = PredictionState()
+    state.ingest([_tx("tx-1", "2025-06-15T10:00:00Z", 200)], [])
+
+    assert state.ingest([_tx("tx-9", "2025-01-10T10:00:00Z", 300, account="acc-2")], []) == 1
+    assert _spent(state, "2025-01") == 300
+
+
+def test_state_round_trips_through_json():
+    state = PredictionState()
+    state.ingest([_tx("tx-1", "2025-06-15T10:00:00Z", 200)], [])
+
+    restored = PredictionState.from_json(state.to_json())
+
+    assert restored.ingest([_tx("tx-1", "2025-06-15T10:00:00Z", 200)], []) == 0
+    assert restored.monthly_totals() == state.monthly_totals()
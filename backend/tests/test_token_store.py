@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+
+import pytest
+
+import token_store
+
+
+def _legacy_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bank_name TEXT,
+            client_id TEXT,
+            access_token TEXT,
+            token_type TEXT,
+            algorithm TEXT,
+            expires_in INTEGER,
+            add_time TEXT
+        )
+    """)
+    rows = []
+    for bank in ("abank", "sbank", "vbank"):
+        for i in range(3):
+            rows.append((bank, "team089", f"{bank}-token-{i}", "bearer", "HS256", 3600, f"2025-01-0{i + 1} 10:00:00"))
+    conn.executemany("""
+        INSERT INTO tokens (bank_name, client_id, access_token, token_type, algorithm, expires_in, add_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.close()
+
+
+def _tables(path):
+    with sqlite3.connect(path) as conn:
+        return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+@pytest.fixture(autouse=True)
+def _fresh_ready_dbs():
+    token_store._ready_dbs.clear()
+    yield
+    token_store._ready_dbs.clear()
+
+
+def test_concurrent_migration_keeps_latest_token_per_bank(tmp_path):
+    db_path = str(tmp_path / "bank_tokens.db")
+    _legacy_db(db_path)
+    errors = []
+    start = threading.Barrier(8)
+
+    def worker():
+        # Отдельные соединения, как у разных воркеров: каждый видит старую схему до блокировки
+        conn = sqlite3.connect(db_path, timeout=10)
+        try:
+            start.wait()
+            token_store.ensure_token_table(conn, "other-" + threading.current_thread().name)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert errors == []
+    assert "tokens_legacy" not in _tables(db_path)
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute("SELECT bank_name, access_token FROM tokens ORDER BY bank_name").fetchall()
+    assert rows == [("abank", "abank-token-2"), ("sbank", "sbank-token-2"), ("vbank", "vbank-token-2")]
+
+
+def test_failed_migration_leaves_legacy_table_intact(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "bank_tokens.db")
+    _legacy_db(db_path)
+
+    def broken_create(cursor):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(token_store, "_create_token_table", broken_create)
+    conn = sqlite3.connect(db_path)
+    with pytest.raises(sqlite3.OperationalError):
+        token_store.ensure_token_table(conn, db_path)
+    conn.close()
+
+    assert db_path not in token_store._ready_dbs
+    assert _tables(db_path) == {"tokens", "sqlite_sequence"}
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tokens").fetchone()[0] == 9
+
+
+def test_save_token_after_migration(tmp_path):
+    db_path = str(tmp_path / "bank_tokens.db")
+    _legacy_db(db_path)
+    token_store.save_token("abank", "team089", "fresh", "bearer", "HS256", 3600, db_path)
+
+    assert token_store.get_token("abank", db_path) == "fresh"
+    assert set(token_store.token_expirations(db_path)) == {
+        ("abank", "team089"), ("sbank", "team089"), ("vbank", "team089"),
+    }
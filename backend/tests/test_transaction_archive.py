@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import transaction_archive
+
+
+def _transactions(ids):
+    return [{
+        "transactionId": f"tx-{i}",
+        "bookingDateTime": f"2025-{i % 3 + 1:02d}-{i % 28 + 1:02d}T10:00:00Z",
+        "amount": {"amount": str(100 + i)},
+        "creditDebitIndicator": "Debit",
+        "status": "completed",
+        "merchant": {"category": "Супермаркеты"},
+        "_bank_name": "abank",
+        "_account_id": "acc-1",
+    } for i in ids]
+
+
+def _archived_ids(root):
+    table = transaction_archive.scan(["transaction_id"], users=["user"], spend_only=False, root=root)
+    return table.column("transaction_id").to_pylist()
+
+
+def test_concurrent_writes_keep_every_row(tmp_path):
+    root = str(tmp_path)
+    errors = []
+    barrier = threading.Barrier(4)
+
+    def worker(offset):
+        barrier.wait()
+        try:
+            for batch in range(5):
+                # Пересекающиеся пачки: часть транзакций пишут сразу несколько потоков
+                start = offset * 40 + batch * 20
+                transaction_archive.archive_transactions("user", _transactions(range(start, start + 60)), set(), root)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+
+    assert not errors
+    ids = _archived_ids(root)
+    expected = {f"tx-{i}" for i in range(3 * 40 + 4 * 20 + 60)}
+    assert len(ids) == len(expected)
+    assert set(ids) == expected
+    # Временные файлы не остаются в партициях
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_repeated_archive_adds_only_new_rows(tmp_path):
+    root = str(tmp_path)
+    assert transaction_archive.archive_transactions("user", _transactions(range(30)), set(), root) == 30
+    assert transaction_archive.archive_transactions("user", _transactions(range(30)), set(), root) == 0
+    assert transaction_archive.archive_in_background("user", _transactions(range(20, 40)), set(), root).result(30) == 10
+    assert sorted(_archived_ids(root)) == sorted(f"tx-{i}" for i in range(40))
@@ -0,0 +1,82 @@
+import pytest
+import requests
+
+import preparation
+
+
+class SilentlyCappingBank:
+    """Банк без метаданных пагинации, который молча урезает limit до max_limit."""
+
+    def __init__(self, total: int, max_limit: int):
+        self.transactions = [{"transactionId": f"tx-{i}"} for i in range(total)]
+        self.max_limit = max_limit
+        self.requests = []
+
+    def __call__(self, bank_name, acc_id, consent_id, from_date, to_date, page, limit, *args):
+        self.requests.append((page, limit))
+        limit = min(limit, self.max_limit)
+        return {"data": {"transaction": self.transactions[(page - 1) * limit:page * limit]}}
+
+
+@pytest.fixture
+def bank(monkeypatch):
+    monkeypatch.setattr(preparation, "_bank_page_limits", {})
+
+    def install(total: int, max_limit: int) -> SilentlyCappingBank:
+        fake = SilentlyCappingBank(total, max_limit)
+        monkeypatch.setattr(preparation, "_fetch_transactions_page", fake)
+        return fake
+    return install
+
+
+def _fetch():
+    return preparation._fetch_account_transactions(
+        "abank", "acc-1", "consent-1", "2025-01-01T00:00:00Z", "2025-12-31T23:59:59Z", "team089", "token", "http://bank"
+    )
+
+
+def test_silent_cap_does_not_truncate_history(bank):
+    fake = bank(total=250, max_limit=100)
+
+    transactions = _fetch()
+
+    assert [tx["transactionId"] for tx in transactions] == [f"tx-{i}" for i in range(250)]
+    assert preparation._bank_page_limits == {"abank": 100}
+    # Следующий счёт сразу запрашивается с подтверждённым limit
+    fake.requests.clear()
+    assert len(_fetch()) == 250
+    assert fake.requests[0] == (1, 100)
+
+
+def test_short_account_does_not_lower_remembered_limit(bank):
+    fake = bank(total=40, max_limit=1000)
+
+    assert len(_fetch()) == 40
+    # Вторая страница подтвердила конец данных, а не урезание — limit банка не запоминается
+    assert fake.requests == [(1, preparation.PAGE_SIZE_CANDIDATES[0]), (2, 40)]
+    assert preparation._bank_page_limits == {}
+
+
+def test_forbidden_account_invalidates_account_list(bank, monkeypatch):
+    fake = bank(total=30, max_limit=1000)
+
+    def fetch_page(bank_name, acc_id, *args):
+        if acc_id == "acc-closed":
+            response = requests.Response()
+            response.status_code = 404
+            raise requests.HTTPError("404 Not Found", response=response)
+        return fake(bank_name, acc_id, *args)
+
+    monkeypatch.setattr(preparation, "_fetch_transactions_page", fetch_page)
+    monkeypatch.setattr(preparation, "get_token_for_bank", lambda bank_name, tokens_db_path: "token")
+    monkeypatch.setattr(preparation, "_accounts_fetched_at", {})
+    preparation._mark_accounts_fetched("alice", "abank", "consent-1")
+
+    transactions, synced = preparation._fetch_bank_transactions(
+        "alice", "abank", "consent-1", ["acc-closed", "acc-1"],
+        "2025-01-01T00:00:00Z", "2025-12-31T23:59:59Z", "team089", "bank_tokens.db", None
+    )
+
+    assert len(transactions) == 30
+    assert [account_id for _, account_id, _ in synced] == ["acc-1"]
+    assert not preparation._accounts_cache_fresh("alice", "abank", "consent-1")
@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+TOKENS_DB = "bank_tokens.db"
+
+# За сколько секунд до истечения токен считается истёкшим и обновляется заранее
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get("TOKEN_REFRESH_MARGIN_SECONDS", "60"))
+
+# БД, в которых таблица уже создана/перенесена в этом процессе
+_ready_dbs = set()
+
+
+def _migrate_legacy_tokens(cursor):
+    """
+    Переносит старую таблицу tokens (id AUTOINCREMENT, строка на каждое обновление, add_time строкой)
+    в новую схему: остаётся только последний токен каждой пары (bank_name, client_id), срок — в expires_at.
+    """
+    cursor.execute("PRAGMA table_info(tokens)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if not columns or "expires_at" in columns:
+        return
+
+    cursor.execute("ALTER TABLE tokens RENAME TO tokens_legacy")
+    _create_token_table(cursor)
+    cursor.execute("""
+        SELECT bank_name, client_id, access_token, token_type, algorithm, expires_in, add_time
+        FROM tokens_legacy
+        ORDER BY add_time, id
+    """)
+    latest = {}
+    for bank_name, client_id, access_token, token_type, algorithm, expires_in, add_time in cursor.fetchall():
+        try:
+            added = datetime.fromisoformat(str(add_time).replace(' ', 'T'))
+        except ValueError:
+            continue
+        expires_at = int((added + timedelta(seconds=expires_in or 0)).timestamp())
+        latest[(bank_name, client_id)] = (bank_name, client_id, access_token, token_type, algorithm,
+                                          expires_in, expires_at, int(added.timestamp()))
+    cursor.executemany("""
+        INSERT OR REPLACE INTO tokens (
+            bank_name, client_id, access_token, token_type, algorithm, expires_in, expires_at, updated_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, list(latest.values()))
+    cursor.execute("DROP TABLE tokens_legacy")
+    print(f"Таблица tokens перенесена в новую схему: {len(latest)} актуальных токенов")
+
+
+def _create_token_table(cursor):
+    # Один токен на (bank_name, client_id): обновление заменяет строку, а не дописывает новую
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tokens (
+            bank_name TEXT NOT NULL,
+            client_id TEXT NOT NULL,
+            access_token TEXT NOT NULL,
+            token_type TEXT NOT NULL,
+            algorithm TEXT,
+            expires_in INTEGER,
+            expires_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (bank_name, client_id)
+        ) WITHOUT ROWID
+    """)
+    # Поиск истекающих токенов идёт по индексу, а не полным просмотром
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tokens_expires_at ON tokens (expires_at)")
+
+
+def ensure_token_table(conn: sqlite3.Connection, db_path: str = TOKENS_DB):
+    """Создаёт таблицу tokens (или переносит старую) один раз за процесс для каждой БД."""
+    if db_path in _ready_dbs:
+        return
+    cursor = conn.cursor()
+    # Перенос и создание — одной транзакцией с блокировкой записи: другой воркер дождётся её и увидит
+    # уже новую схему, а сбой посередине не оставит tokens_legacy
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        _migrate_legacy_tokens(cursor)
+        _create_token_table(cursor)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    _ready_dbs.add(db_path)
+
+
+def save_token(bank_name: str, client_id: str, access_token: str, token_type: str, algorithm: Optional[str],
+               expires_in: int, db_path: str = TOKENS_DB):
+    """Сохраняет токен банка, заменяя предыдущий токен той же пары (bank_name, client_id)."""
+    now = int(time.time())
+    with metrics.timed_connect(db_path) as conn:
+        ensure_token_table(conn, db_path)
+        conn.execute("""
+            INSERT INTO tokens (
+                bank_name, client_id, access_token, token_type, algorithm, expires_in, expires_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(bank_name, client_id) DO UPDATE SET
+                access_token = excluded.access_token,
+                token_type = excluded.token_type,
+                algorithm = excluded.algorithm,
+                expires_in = excluded.expires_in,
+                expires_at = excluded.expires_at,
+                updated_at = excluded.updated_at
+        """, (bank_name, client_id, access_token, token_type, algorithm, expires_in, now + int(expires_in), now))
+        conn.commit()
+
+
+def get_token(bank_name: str, db_path: str = TOKENS_DB) -> Optional[str]:
+    """
+    Самый свежий access_token банка (поиск по префиксу первичного ключа).
+
+    :return: access_token или None, если токена нет
+    """
+    with metrics.timed_connect(db_path) as conn:
+        ensure_token_table(conn, db_path)
+        row = conn.execute("""
+            SELECT access_token FROM tokens WHERE bank_name = ? ORDER BY expires_at DESC LIMIT 1
+        """, (bank_name,)).fetchone()
+    return row[0] if row else None
+
+
+def get_tokens(bank_names: List[str], db_path: str = TOKENS_DB) -> Dict[str, str]:
+    """Самые свежие access_token для нескольких банков одним запросом: bank_name -> access_token."""
+    if not bank_names:
+        return {}
+    placeholders = ", ".join("?" for _ in bank_names)
+    with metrics.timed_connect(db_path) as conn:
+        ensure_token_table(conn, db_path)
+        rows = conn.execute(f"""
+            SELECT bank_name, access_token FROM tokens WHERE bank_name IN ({placeholders}) ORDER BY expires_at
+        """, list(bank_names)).fetchall()
+    # Строки идут от старых к новым — у каждого банка остаётся последний токен
+    return dict(rows)
+
+
+def token_expirations(db_path: str = TOKENS_DB) -> Dict[Tuple[str, str], int]:
+    """(bank_name, client_id) -> expires_at (epoch) для всех сохранённых токенов."""
+    with metrics.timed_connect(db_path) as conn:
+        ensure_token_table(conn, db_path)
+        rows = conn.execute("SELECT bank_name, client_id, expires_at FROM tokens").fetchall()
+    return {(bank_name, client_id): expires_at for bank_name, client_id, expires_at in rows}
+
+
+def expiring_tokens(within_seconds: int = TOKEN_REFRESH_MARGIN_SECONDS, db_path: str = TOKENS_DB) -> List[Tuple[str, str, int]]:
+    """
+    Токены, которые истекают в ближайшие within_seconds (или уже истекли), от самых срочных.
+
+    :return: Список (bank_name, client_id, expires_at)
+    """
+    with metrics.timed_connect(db_path) as conn:
+        ensure_token_table(conn, db_path)
+        return conn.execute("""
+            SELECT bank_name, client_id, expires_at FROM tokens WHERE expires_at <= ? ORDER BY expires_at
+        """, (int(time.time()) + within_seconds,)).fetchall()
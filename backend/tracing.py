@@ -0,0 +1,173 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+
+# Каталог для трасс в формате Chrome trace (открываются в chrome://tracing, Perfetto, speedscope)
+TRACE_DIR = os.environ.get("TRACE_DIR", "traces")
+
+# Сохраняем только трассы, корневой span которых длился не меньше порога (мс)
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "1000"))
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "1") == "1"
+
+
+class Span:
+    """Один интервал трассы: этап обработки или исходящий запрос к банку."""
+
+    def __init__(self, trace: "Trace", name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.thread_id = threading.get_ident()
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+
+class Trace:
+    """Набор span'ов одного запроса. Span'ы могут завершаться в разных потоках."""
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_chrome_trace(self) -> dict:
+        """Экспортирует трассу в формате Chrome trace (события 'X' с длительностью)."""
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = []
+        for span in spans:
+            if span.end_ns is None:
+                continue
+            args = {key: _jsonable(value) for key, value in span.attributes.items()}
+            args["span_id"] = span.span_id
+            if span.parent_id:
+                args["parent_id"] = span.parent_id
+            if span.error:
+                args["error"] = span.error
+            events.append({
+                "name": span.name,
+                "cat": span.attributes.get("category", "stage"),
+                "ph": "X",
+                "ts": span.start_ns / 1000,
+                "dur": (span.end_ns - span.start_ns) / 1000,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": args,
+            })
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"trace_id": self.trace_id, "name": self.name},
+        }
+
+
+def _jsonable(value: Any):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    """Возвращает активный span текущего контекста (или None)."""
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Открывает span в текущем контексте.
+
+    Если активного span'а нет, создаётся новая трасса, и по завершении корневого span'а
+    она сохраняется в TRACE_DIR (если длилась не меньше TRACE_SLOW_MS).
+
+    :param name: Название этапа (например, "fetch_all_transactions")
+    :param attributes: Дополнительные атрибуты (bank, account_id, ...)
+    """
+    if not TRACING_ENABLED:
+        yield None
+        return
+
+    parent = _current_span.get()
+    trace = parent.trace if parent else Trace(name)
+    current = Span(trace, name, parent, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        trace.add(current)
+        _current_span.reset(token)
+        if parent is None and current.duration_ms >= TRACE_SLOW_MS:
+            export_trace(trace)
+
+
+def traced(name: Optional[str] = None, **attributes):
+    """Декоратор: выполняет функцию внутри span'а с её именем."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def submit(executor, fn, *args, **kwargs):
+    """
+    executor.submit с передачей текущего контекста (активного span'а) в поток пула.
+    ThreadPoolExecutor сам контекст не копирует, в отличие от asyncio.to_thread.
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
+
+
+def export_trace(trace: Trace, trace_dir: Optional[str] = None) -> Optional[str]:
+    """
+    Сохраняет трассу в JSON-файл формата Chrome trace.
+
+    :return: Путь к файлу или None при ошибке
+    """
+    trace_dir = trace_dir or TRACE_DIR
+    try:
+        os.makedirs(trace_dir, exist_ok=True)
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(trace_dir, f"{timestamp}_{trace.name}_{trace.trace_id[:8]}.json")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(trace.to_chrome_trace(), file, ensure_ascii=False)
+        return path
+    except OSError as e:
+        print(f"Ошибка при сохранении трассы {trace.trace_id}: {e}")
+        return None
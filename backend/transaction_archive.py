@@ -0,0 +1,356 @@
+"""
+Колоночный архив транзакций пользователей (Arrow IPC).
+
+Сырые транзакции из fetch_all_transactions раскладываются по партициям
+
+  <TRANSACTION_ARCHIVE_DIR>/user=<user>/month=<YYYY-MM>/data.arrow
+
+Категория, банк, счёт, статус и признак списания хранятся как словарные колонки, месяц — int32 month_index.
+Чтение идёт через pyarrow.dataset с memory-mapping: отбор партиций по user/month и чтение только нужных колонок
+(projection pushdown), без JSON и object-колонок pandas.
+
+Партиция дописывается под блокировкой (потоки и воркеры), новый файл пишется во временный и подменяет старый.
+Анализ передаёт транзакции в archive_in_background и не ждёт записи.
+
+  python transaction_archive.py --import-json user1.json --user team089-1
+  python transaction_archive.py --summary
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows: остаётся только блокировка внутри процесса
+    fcntl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+except ImportError:  # архив необязателен: без pyarrow анализ работает как раньше
+    pa = None
+
+from analysis_try4 import (
+    booking_month_index,
+    excluded_category_set,
+    month_from_index,
+    transaction_category,
+    typed_transactions,
+)
+
+# Корень архива; пустая строка отключает запись из боевого пайплайна
+TRANSACTION_ARCHIVE_DIR = os.environ.get("TRANSACTION_ARCHIVE_DIR", "transactions_archive")
+
+PARTITION_FILE = "data.arrow"
+# Файл блокировки партиции; имена с точкой pyarrow.dataset не читает
+LOCK_FILE = ".lock"
+
+# Блокировки партиций внутри процесса (между процессами — flock на LOCK_FILE)
+_partition_locks: Dict[str, threading.Lock] = {}
+_partition_locks_guard = threading.Lock()
+# path -> (версия файла _file_version, transaction_id партиции) для последних ARCHIVE_SEEN_CACHE_PARTITIONS партиций:
+# неизменившиеся партиции не перечитываются при каждом анализе
+ARCHIVE_SEEN_CACHE_PARTITIONS = int(os.environ.get("ARCHIVE_SEEN_CACHE_PARTITIONS", "1024"))
+_seen_ids: "OrderedDict[str, Tuple[Optional[Tuple[int, int, int]], Set[Optional[str]]]]" = OrderedDict()
+# Запись из боевого пайплайна идёт в одном фоновом потоке, не задерживая ответ пользователю
+_archive_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+
+if pa is not None:
+    SCHEMA = pa.schema([
+        ("transaction_id", pa.string()),
+        ("bank", pa.dictionary(pa.int16(), pa.string())),
+        ("account_id", pa.dictionary(pa.int32(), pa.string())),
+        ("booking_date_time", pa.string()),
+        ("month_index", pa.int32()),
+        ("category", pa.dictionary(pa.int32(), pa.string())),
+        ("amount", pa.float64()),
+        ("credit_debit", pa.dictionary(pa.int8(), pa.string())),
+        ("status", pa.dictionary(pa.int8(), pa.string())),
+    ])
+
+
+def available() -> bool:
+    """Установлен ли pyarrow."""
+    return pa is not None
+
+
+def _month_label(month: int) -> str:
+    return month_from_index(month).strftime("%Y-%m")
+
+
+def _partition_dir(root: str, user_name: str, month: int) -> str:
+    return os.path.join(root, f"user={urllib.parse.quote(user_name, safe='')}", f"month={_month_label(month)}")
+
+
+def _to_records(transactions: Iterable[dict], known_categories: Iterable[str]) -> Dict[int, List[dict]]:
+    """Сырые транзакции -> строки архива, сгруппированные по month_index."""
+    known = set(known_categories)
+    by_month: Dict[int, List[dict]] = {}
+    for tx in transactions:
+        if not tx.get("bookingDateTime"):
+            continue
+        month = booking_month_index(tx["bookingDateTime"])
+        by_month.setdefault(month, []).append({
+            "transaction_id": tx.get("transactionId"),
+            "bank": tx.get("_bank_name"),
+            "account_id": tx.get("_account_id"),
+            "booking_date_time": tx["bookingDateTime"],
+            "month_index": month,
+            "category": transaction_category(tx, known),
+            "amount": abs(float(tx["amount"]["amount"])),
+            "credit_debit": tx.get("creditDebitIndicator"),
+            "status": tx.get("status"),
+        })
+    return by_month
+
+
+def _read_file(path: str) -> "pa.Table":
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _write_file(path: str, table: "pa.Table"):
+    """Атомарная запись: новый файл подменяет старый только после полной записи."""
+    # Уникальное имя в той же директории: os.replace атомарен только в пределах файловой системы
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{PARTITION_FILE}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def _partition_lock(directory: str):
+    """Эксклюзивная блокировка партиции на время чтения-изменения-записи."""
+    with _partition_locks_guard:
+        lock = _partition_locks.setdefault(directory, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(directory, LOCK_FILE), "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def _file_version(path: str) -> Optional[Tuple[int, int, int]]:
+    """Версия файла партиции: каждая запись создаёт новый файл (os.replace), поэтому меняется и inode."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _cached_seen(path: str, version: Optional[Tuple[int, int, int]]) -> Optional[Set[Optional[str]]]:
+    with _partition_locks_guard:
+        cached = _seen_ids.get(path)
+        if cached is None or cached[0] != version:
+            return None
+        _seen_ids.move_to_end(path)
+        return cached[1]
+
+
+def _remember_seen(path: str, version: Optional[Tuple[int, int, int]], seen: Set[Optional[str]]):
+    with _partition_locks_guard:
+        _seen_ids[path] = (version, seen)
+        _seen_ids.move_to_end(path)
+        while len(_seen_ids) > ARCHIVE_SEEN_CACHE_PARTITIONS:
+            _seen_ids.popitem(last=False)
+
+
+def archive_transactions(user_name: str, transactions: List[dict], known_categories: Iterable[str],
+                         root: Optional[str] = None) -> int:
+    """
+    Дописывает транзакции пользователя в архив (повторы по transactionId внутри месяца отбрасываются).
+
+    :param transactions: Транзакции из fetch_all_transactions (с _bank_name/_account_id)
+    :param known_categories: Категории каталога кешбеков (Title Case) для transaction_category
+    :return: Количество новых строк
+    """
+    root = TRANSACTION_ARCHIVE_DIR if root is None else root
+    if not available() or not root:
+        return 0
+
+    added = 0
+    for month, records in _to_records(transactions, known_categories).items():
+        directory = _partition_dir(root, user_name, month)
+        path = os.path.join(directory, PARTITION_FILE)
+        os.makedirs(directory, exist_ok=True)
+        with _partition_lock(directory):
+            added += _append_partition(path, records)
+    return added
+
+
+def _append_partition(path: str, records: List[dict]) -> int:
+    """Дописывает в партицию строки с новыми transaction_id (вызывается под _partition_lock)."""
+    version = _file_version(path)
+    seen = _cached_seen(path, version)
+    if seen is None:
+        seen = set(_read_file(path).column("transaction_id").to_pylist()) if version is not None else set()
+
+    fresh = []
+    for record in records:
+        if record["transaction_id"] is None or record["transaction_id"] not in seen:
+            fresh.append(record)
+    if not fresh:
+        _remember_seen(path, version, seen)
+        return 0
+
+    table = pa.Table.from_pylist(fresh, schema=SCHEMA)
+    if version is not None:
+        # Словари колонок объединяются, чтобы в файле был один словарь на колонку
+        table = pa.concat_tables([_read_file(path), table]).unify_dictionaries().combine_chunks()
+    _write_file(path, table)
+    _remember_seen(path, _file_version(path), seen | {record["transaction_id"] for record in fresh})
+    return len(fresh)
+
+
+def archive_in_background(user_name: str, transactions: List[dict], known_categories: Iterable[str],
+                          root: Optional[str] = None) -> Future:
+    """
+    archive_transactions в фоновом потоке архива: запросы анализа не ждут записи,
+    а записи разных запросов выполняются по очереди. Ошибки записи только логируются.
+    """
+    known = set(known_categories)
+
+    def run():
+        try:
+            return archive_transactions(user_name, transactions, known, root)
+        except Exception as e:
+            print(f"⚠️ Не удалось записать транзакции {user_name} в архив: {e}")
+            return 0
+
+    return _archive_pool.submit(run)
+
+
+def dataset(root: Optional[str] = None) -> "ds.Dataset":
+    """Весь архив как pyarrow.dataset с hive-партициями user/month и memory-mapped чтением."""
+    root = TRANSACTION_ARCHIVE_DIR if root is None else root
+    partitioning = ds.partitioning(pa.schema([("user", pa.string()), ("month", pa.string())]), flavor="hive")
+    return ds.dataset(
+        root, format="ipc", partitioning=partitioning,
+        filesystem=pafs.LocalFileSystem(use_mmap=True), exclude_invalid_files=True,
+    )
+
+
+def scan(columns: Sequence[str], users: Optional[Sequence[str]] = None, from_month: Optional[int] = None,
+         to_month: Optional[int] = None, spend_only: bool = True, root: Optional[str] = None) -> "pa.Table":
+    """
+    Читает из архива только нужные колонки и партиции.
+
+    Фильтры по user и month отбирают партиции по путям, остальные файлы не открываются.
+
+    :param columns: Колонки результата (плюс партиционные колонки user/month, если нужны)
+    :param users: Пользователи (None — все)
+    :param from_month: Нижняя граница month_index включительно
+    :param to_month: Верхняя граница month_index включительно
+    :param spend_only: Только завершённые списания (как в parse_transactions_json_to_dataframe)
+    """
+    if not available():
+        raise RuntimeError("Для архива транзакций нужен pyarrow")
+
+    condition = None
+
+    def add(expression):
+        nonlocal condition
+        condition = expression if condition is None else condition & expression
+
+    if users is not None:
+        add(ds.field("user").isin(list(users)))
+    if from_month is not None:
+        add(ds.field("month") >= _month_label(from_month))
+    if to_month is not None:
+        add(ds.field("month") <= _month_label(to_month))
+    if spend_only:
+        add((ds.field("status") == "completed") & (ds.field("credit_debit") == "Debit"))
+    return dataset(root).to_table(columns=list(columns), filter=condition)
+
+
+def spend_by_month(users: Optional[Sequence[str]] = None, root: Optional[str] = None,
+                   exclude_categories=None) -> pd.DataFrame:
+    """
+    Траты (user, month_index, category, amount), агрегированные в Arrow по месяцам и категориям.
+    Исключаемые категории отбрасываются, как в filter_out_categories.
+    """
+    table = scan(["user", "month_index", "category", "amount"], users=users, root=root)
+    excluded = list(excluded_category_set(exclude_categories))
+    # У каждого файла свой словарь категорий — перед агрегацией приводим их к общему
+    table = table.unify_dictionaries()
+    table = table.filter(pc.invert(pc.is_in(table.column("category").cast(pa.string()), value_set=pa.array(excluded))))
+    grouped = table.group_by(["user", "month_index", "category"]).aggregate([("amount", "sum")])
+    return grouped.rename_columns(["user", "month_index", "category", "amount"]).to_pandas()
+
+
+def history_frame(user_name: str, root: Optional[str] = None, exclude_categories=None) -> pd.DataFrame:
+    """
+    История пользователя в формате parse_transactions_json_to_dataframe + filter_out_categories
+    (typed_transactions: month — month_index, category — categorical) — вход для prediction_model.
+    """
+    frame = spend_by_month([user_name], root, exclude_categories)
+    # Словарные колонки Arrow приходят в pandas уже как categorical
+    return typed_transactions(frame["month_index"].to_numpy(), frame["category"], frame["amount"].to_numpy(),
+                              frame["category"].dtype if not frame.empty else None)
+
+
+def users(root: Optional[str] = None) -> List[str]:
+    """Пользователи, у которых есть партиции в архиве."""
+    root = TRANSACTION_ARCHIVE_DIR if root is None else root
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        urllib.parse.unquote(name[len("user="):]) for name in os.listdir(root) if name.startswith("user=")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Колоночный архив транзакций")
+    parser.add_argument("--root", default=TRANSACTION_ARCHIVE_DIR)
+    parser.add_argument("--import-json", nargs="*", default=[], help="JSON-файлы с транзакциями (список или data.transaction)")
+    parser.add_argument("--user", help="Пользователь для --import-json (по умолчанию — имя файла)")
+    parser.add_argument("--cashbacks", default="Cashbacks.xlsx", help="Каталог для сопоставления категорий")
+    parser.add_argument("--summary", action="store_true", help="Траты по пользователям и месяцам")
+    args = parser.parse_args()
+
+    if not available():
+        parser.error("Нужен pyarrow: pip install pyarrow")
+
+    known = set()
+    if args.import_json and os.path.exists(args.cashbacks):
+        from analysis_try4 import load_cashbacks
+        known = set(load_cashbacks(args.cashbacks)['category'])
+    for path in args.import_json:
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        transactions = data.get("data", {}).get("transaction", []) if isinstance(data, dict) else data
+        user_name = args.user or os.path.splitext(os.path.basename(path))[0]
+        print(f"{user_name}: добавлено {archive_transactions(user_name, transactions, known, args.root)} транзакций")
+
+    if args.summary:
+        summary = spend_by_month(root=args.root).groupby(["user", "month_index"])["amount"].sum()
+        for (user_name, month), amount in summary.items():
+            print(f"{user_name:<24} {month_from_index(month):%Y-%m} {amount:14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+"""
+Подбор параметров prediction_model (w_3/w_6/w_12, веса share_model, w_share/w_direct) перебором
+по сетке или случайным поиском на популяции пользователей.
+
+Матрицы трат (категория × месяц) всех пользователей один раз кладутся в разделяемую память,
+процессы пула подключаются к ней и считают только прогнозы и кешбек — без повторного разбора транзакций.
+Лучший набор выбирается по суммарному реализованному кешбеку, который считается так же, как в backtest:
+выбор — choose_best_cashback (per_bank), реализация — backtest.realized_cashback (траты категории на одну карту).
+
+  python tune_weights.py --synthetic-users 50 --search random --samples 300
+  python tune_weights.py --transactions u1.json u2.json --cashbacks Cashbacks.xlsx --search grid --grid-step 0.2
+"""
+import os
+
+os.environ.setdefault("TRACING_ENABLED", "0")
+
+import argparse
+import itertools
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from backtest import (
+    DEFAULT_PARAMS,
+    HistoryMatrix,
+    load_cashbacks,
+    month_range,
+    predict_all_months,
+    prepare_history,
+)
+
+
+class BankArrays:
+    """
+    Каталог одного банка в виде массивов, привязанных к категориям конкретного пользователя.
+
+    Кешбек по категории не зависит от остальных выбранных категорий банка, поэтому лучшая комбинация
+    из k категорий — это k категорий с наибольшим кешбеком (bank_limit лишь обрезает сумму).
+    Это тот же выбор, что перебор комбинаций в choose_best_cashback (per_bank), но за O(n log n);
+    когда в bank_limit упирается несколько комбинаций, берётся первая в порядке перебора, как там.
+    """
+
+    def __init__(self, rows: pd.DataFrame, categories: List[str]):
+        position = {category: i for i, category in enumerate(categories)}
+        is_all = rows['category'].astype(str).str.strip().str.lower() == 'all'
+        # Для повторяющихся категорий — первая строка, пустой лимит — без ограничения (как в catalog_terms)
+        regular = rows[~is_all].drop_duplicates('category')
+
+        self.k = int(rows['max_categories_in_bank'].iloc[0])
+        self.bank_limit = _limit(rows['bank_limit'].iloc[0])
+        self.index = np.array([position.get(category, -1) for category in regular['category']], dtype=int)
+        self.percent = regular['percent'].to_numpy(dtype=float)
+        self.category_limit = np.nan_to_num(regular['category_limit'].to_numpy(dtype=float), nan=np.inf)
+
+        self.all_percent = float(rows[is_all]['percent'].iloc[0]) if is_all.any() else None
+        self.all_limit = _limit(rows[is_all]['category_limit'].iloc[0]) if is_all.any() else None
+
+    def _values(self, spend: np.ndarray) -> np.ndarray:
+        category_spend = np.where(self.index >= 0, spend[np.maximum(self.index, 0)], 0.0)
+        return np.minimum(category_spend * self.percent / 100, self.category_limit)
+
+    def choose(self, predicted: np.ndarray) -> Tuple[Optional[np.ndarray], bool]:
+        """
+        Выбор категорий по прогнозу.
+
+        :return: (позиции выбранных категорий в каталоге банка, выбрана ли стратегия "all")
+        """
+        best_value = -1.0
+        choice, use_all = None, False
+        if self.all_percent is not None:
+            best_value = min(predicted.sum() * self.all_percent / 100, self.all_limit, self.bank_limit)
+            use_all = True
+        if len(self.index):
+            values = self._values(predicted)
+            k = min(self.k, len(values))
+            order = np.argsort(-values, kind='stable')
+            chosen = order[:k]
+            if values[chosen].sum() > self.bank_limit:
+                chosen = _first_combination(values.tolist(), k, self.bank_limit)
+            elif k < len(values) and values[order[k]] == values[order[k - 1]]:
+                chosen = _tied_combination(values.tolist(), k)
+            if min(values[chosen].sum(), self.bank_limit) > best_value:
+                choice, use_all = chosen, False
+        return choice, use_all
+
+
+def _first_combination(values: List[float], k: int, target: float) -> np.ndarray:
+    """
+    Первая в порядке itertools.combinations комбинация k позиций с суммой не меньше target:
+    позиция берётся, если вместе с лучшими k оставшимися после неё сумма ещё достигает target.
+    """
+    chosen: List[int] = []
+    acc = 0.0
+    start = 0
+    for slot in range(k):
+        need = k - slot - 1
+        for i in range(start, len(values) - need):
+            rest = sum(sorted(values[i + 1:], reverse=True)[:need])
+            if acc + values[i] + rest >= target:
+                chosen.append(i)
+                acc += values[i]
+                start = i + 1
+                break
+    return np.array(chosen, dtype=int)
+
+
+def _tied_combination(values: List[float], k: int) -> np.ndarray:
+    """
+    Лучшая комбинация k позиций, когда на границе top-k есть равные значения, — так же, как в переборе
+    per_bank_best_cashback: суммы считаются в порядке позиций (равноценные комбинации могут отличаться
+    в последнем знаке float), из равных побеждает первая в порядке itertools.combinations.
+    """
+    boundary = sorted(values, reverse=True)[k - 1]
+    fixed = [i for i, value in enumerate(values) if value > boundary]
+    tied = [i for i, value in enumerate(values) if value == boundary]
+    best, best_total = None, -1.0
+    for combo in sorted(tuple(sorted(fixed + list(extra))) for extra in itertools.combinations(tied, k - len(fixed))):
+        total = 0.0
+        for i in combo:
+            total += values[i]
+        if total > best_total:
+            best, best_total = combo, total
+    return np.array(best, dtype=int)
+
+
+def _limit(value) -> float:
+    return float('inf') if pd.isna(value) else float(value)
+
+
+def catalog_for_user(cashback_df: pd.DataFrame, categories: List[str]) -> List[BankArrays]:
+    return [BankArrays(rows, categories) for _, rows in cashback_df.groupby('bank')]
+
+
+def realized_total(banks: List[BankArrays], choices: List[Tuple[Optional[np.ndarray], bool]], actual: np.ndarray) -> float:
+    """
+    Кешбек выбора всех банков при фактических тратах — то же, что backtest.realized_cashback.
+
+    Траты категории уходят на одну карту: из банков, выбравших категорию, — туда, где кешбек больше
+    (при равенстве — в банк, идущий позже по имени); траты невыбранных категорий — на карту с "all"
+    с наибольшим процентом. Затем к каждому банку применяется bank_limit.
+
+    :param choices: Результаты BankArrays.choose в порядке banks
+    """
+    n = len(actual)
+    best_value = np.full(n, -1.0)
+    best_bank = np.full(n, -1, dtype=int)
+    all_card = None
+    for b, (bank, (choice, use_all)) in enumerate(zip(banks, choices)):
+        if use_all:
+            if all_card is None or bank.all_percent > banks[all_card].all_percent:
+                all_card = b
+            continue
+        if choice is None:
+            continue
+        index = bank.index[choice]
+        values = bank._values(actual)[choice]
+        known = index >= 0
+        index, values = index[known], values[known]
+        better = values >= best_value[index]
+        best_value[index[better]] = values[better]
+        best_bank[index[better]] = b
+
+    spent = actual > 0
+    chosen = spent & (best_bank >= 0)
+    per_bank = np.bincount(best_bank[chosen], weights=best_value[chosen], minlength=len(banks))
+    if all_card is not None:
+        on_all = actual[spent & (best_bank < 0)].sum() * banks[all_card].all_percent / 100
+        per_bank[all_card] += min(on_all, banks[all_card].all_limit)
+    return float(sum(min(value, bank.bank_limit) for value, bank in zip(per_bank, banks)))
+
+
+def evaluate_history(history: HistoryMatrix, banks: List[BankArrays], targets: Sequence[int], params: dict) -> Tuple[float, float, float]:
+    """
+    Реализованный и оптимальный кешбек, а также суммарная абсолютная ошибка прогноза по всем целевым месяцам.
+    """
+    predictions = predict_all_months(history, targets, params)
+    realized = optimal = abs_error = 0.0
+    for i, target in enumerate(targets):
+        predicted = predictions[:, i]
+        actual = history.actual(target)
+        abs_error += float(np.abs(predicted - actual).sum())
+        realized += realized_total(banks, [bank.choose(predicted) for bank in banks], actual)
+        optimal += realized_total(banks, [bank.choose(actual) for bank in banks], actual)
+    return realized, optimal, abs_error
+
+
+# --- Разделяемая память и процессы пула ---
+
+_worker_state: Dict[str, object] = {}
+
+
+def pack_histories(histories: List[HistoryMatrix]) -> Tuple[shared_memory.SharedMemory, List[dict]]:
+    """
+    Кладёт матрицы всех пользователей подряд в один блок разделяемой памяти.
+
+    :return: (блок памяти, описание расположения матриц)
+    """
+    total = sum(history.amounts.size for history in histories)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, total) * 8)
+    buffer = np.ndarray((total,), dtype=np.float64, buffer=shm.buf)
+
+    layout = []
+    offset = 0
+    for history in histories:
+        size = history.amounts.size
+        buffer[offset:offset + size] = history.amounts.ravel()
+        layout.append({
+            "offset": offset,
+            "shape": history.amounts.shape,
+            "first_month": history.first_month,
+            "categories": history.categories,
+        })
+        offset += size
+    return shm, layout
+
+
+def _init_worker(shm_name: str, layout: List[dict], catalog_records: List[dict], targets: List[int]):
+    """Подключается к разделяемой памяти и строит представления матриц без копирования."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    total = sum(int(np.prod(item["shape"])) for item in layout)
+    buffer = np.ndarray((total,), dtype=np.float64, buffer=shm.buf)
+    cashback_df = pd.DataFrame(catalog_records)
+
+    histories, catalogs = [], []
+    for item in layout:
+        size = int(np.prod(item["shape"]))
+        amounts = buffer[item["offset"]:item["offset"] + size].reshape(item["shape"])
+        histories.append(HistoryMatrix(item["categories"], item["first_month"], amounts))
+        catalogs.append(catalog_for_user(cashback_df, item["categories"]))
+
+    _worker_state.update(shm=shm, histories=histories, catalogs=catalogs, targets=targets)
+
+
+def _evaluate(params: dict) -> dict:
+    realized = optimal = abs_error = 0.0
+    for history, banks in zip(_worker_state["histories"], _worker_state["catalogs"]):
+        r, o, e = evaluate_history(history, banks, _worker_state["targets"], params)
+        realized += r
+        optimal += o
+        abs_error += e
+    return {
+        "params": params,
+        "realized_cashback": realized,
+        "optimal_cashback": optimal,
+        "cashback_ratio": realized / optimal if optimal else None,
+        "abs_error": abs_error,
+    }
+
+
+# --- Пространство поиска ---
+
+def simplex_grid(parts: int, step: float) -> List[Tuple[float, ...]]:
+    """Все наборы из parts неотрицательных весов с шагом step и суммой 1."""
+    n_steps = int(round(1 / step))
+    points = []
+    for combo in itertools.product(range(n_steps + 1), repeat=parts - 1):
+        if sum(combo) <= n_steps:
+            points.append(tuple(c / n_steps for c in combo) + ((n_steps - sum(combo)) / n_steps,))
+    return points
+
+
+def grid_candidates(step: float) -> List[dict]:
+    candidates = []
+    for w_3, w_6, w_12 in simplex_grid(3, step):
+        for share_weights in simplex_grid(3, step):
+            for w_share, w_direct in simplex_grid(2, step):
+                candidates.append({
+                    "w_3": w_3, "w_6": w_6, "w_12": w_12,
+                    "share_weights": share_weights,
+                    "w_share": w_share, "w_direct": w_direct,
+                })
+    return candidates
+
+
+def random_candidates(n_samples: int, seed: int = 0) -> List[dict]:
+    rng = random.Random(seed)
+
+    def weights(parts):
+        raw = [rng.random() for _ in range(parts)]
+        return tuple(round(value / sum(raw), 4) for value in raw)
+
+    candidates = [dict(DEFAULT_PARAMS)]
+    for _ in range(n_samples):
+        w_3, w_6, w_12 = weights(3)
+        w_share, w_direct = weights(2)
+        candidates.append({
+            "w_3": w_3, "w_6": w_6, "w_12": w_12,
+            "share_weights": weights(3),
+            "w_share": w_share, "w_direct": w_direct,
+        })
+    return candidates
+
+
+def search(
+    histories: List[HistoryMatrix],
+    cashback_df: pd.DataFrame,
+    targets: List[int],
+    candidates: List[dict],
+    workers: Optional[int] = None
+) -> List[dict]:
+    """
+    Оценивает всех кандидатов в пуле процессов.
+
+    :return: Результаты, отсортированные по убыванию реализованного кешбека
+    """
+    shm, layout = pack_histories(histories)
+    try:
+        catalog_records = cashback_df.to_dict(orient='records')
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(shm.name, layout, catalog_records, targets),
+        ) as executor:
+            chunksize = max(1, len(candidates) // ((workers or os.cpu_count() or 1) * 4))
+            results = list(executor.map(_evaluate, candidates, chunksize=chunksize))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return sorted(results, key=lambda row: (-row["realized_cashback"], row["abs_error"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Подбор параметров prediction_model")
+    parser.add_argument("--transactions", nargs="*", default=[], help="JSON-файлы с транзакциями пользователей")
+    parser.add_argument("--synthetic-users", type=int, default=0)
+    parser.add_argument("--synthetic-size", type=int, default=2000)
+    parser.add_argument("--cashbacks", default="Cashbacks.xlsx")
+    parser.add_argument("--from", dest="from_month", default="2025-04-01")
+    parser.add_argument("--to", dest="to_month", default="2025-12-01")
+    parser.add_argument("--search", choices=("grid", "random"), default="random")
+    parser.add_argument("--grid-step", type=float, default=0.25)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--output", help="Сохранить все результаты в JSON")
+    args = parser.parse_args()
+
+    from synthetic_data import DEFAULT_BANKS, category_names, generate_cashback_catalog, generate_user
+
+    if os.path.exists(args.cashbacks):
+        cashbacks = load_cashbacks(args.cashbacks)
+    else:
+        cashbacks = pd.DataFrame(generate_cashback_catalog(DEFAULT_BANKS, categories_per_bank=8, categories=category_names(16)))
+        cashbacks['category'] = cashbacks['category'].astype(str).str.strip().str.title()
+        cashbacks['category_limit'] = cashbacks['category_limit'].fillna(float('inf'))
+
+    histories = []
+    for path in args.transactions:
+        with open(path, encoding="utf-8") as file:
+            histories.append(HistoryMatrix.from_dataframe(prepare_history(json.load(file), cashbacks)))
+    for i in range(args.synthetic_users):
+        histories.append(HistoryMatrix.from_dataframe(prepare_history(generate_user(args.synthetic_size, seed=i), cashbacks)))
+    if not histories:
+        parser.error("Нужно указать --transactions или --synthetic-users")
+
+    candidates = grid_candidates(args.grid_step) if args.search == "grid" else random_candidates(args.samples, args.seed)
+    print(f"Пользователей: {len(histories)}, кандидатов: {len(candidates)}")
+
+    start = time.perf_counter()
+    results = search(histories, cashbacks, month_range(args.from_month, args.to_month), candidates, args.workers)
+    print(f"Поиск занял {time.perf_counter() - start:.1f} с")
+
+    for row in results[:args.top]:
+        print(f"{row['realized_cashback']:14.2f}  ratio={row['cashback_ratio']:.4f}  {row['params']}")
+
+    best = results[0]
+    print("Лучший набор параметров:")
+    print(json.dumps(best["params"], ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"best": best, "results": results}, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()